@@ -1,943 +1,2909 @@
-import sys
-import json
-import os
-import shutil
-from datetime import datetime
-import zhconv  
-from PySide6.QtCore import Qt, Signal, QSize
-from PySide6.QtGui import QAction, QTextCursor, QTextCharFormat, QColor, QCloseEvent, QIntValidator, QFont
-from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget,
-                               QHBoxLayout, QVBoxLayout, QListWidget, QTextEdit, 
-                               QLineEdit, QFormLayout, QFileDialog, QListWidgetItem,
-                               QCheckBox, QSpinBox, QMessageBox, QTabWidget, QComboBox,
-                               QPushButton, QAbstractItemView, QDialog, QInputDialog, QFrame, QLabel)
-
-# ================= 现代蓝白主题 (日间模式) =================
-MODERN_BLUE_THEME = """
-QWidget {
-    font-family: "Segoe UI Variable", "Microsoft YaHei", "PingFang SC", sans-serif;
-    font-size: 13px;
-    color: #2C3E50;
-    outline: none;
-}
-QMainWindow, QDialog { background-color: #F2F7FB; }
-#SidePanel, #MainTabs::pane { background-color: #FFFFFF; border-radius: 10px; border: 1px solid #E1E8EE; }
-QLineEdit, QTextEdit, QSpinBox, QComboBox { background-color: #F8FAFC; border: 1px solid #D2DCE6; border-radius: 6px; padding: 6px 10px; selection-background-color: #75C2F6; }
-QLineEdit:hover, QTextEdit:hover, QSpinBox:hover, QComboBox:hover { border: 1px solid #75C2F6; background-color: #FFFFFF; }
-QLineEdit:focus, QTextEdit:focus, QSpinBox:focus, QComboBox:focus { border: 2px solid #59B4FF; background-color: #FFFFFF; }
-QComboBox::drop-down { subcontrol-origin: padding; subcontrol-position: top right; width: 20px; border-left: none; }
-QComboBox QAbstractItemView { border: 1px solid #D2DCE6; border-radius: 6px; background-color: #FFFFFF; selection-background-color: #ECF5FF; selection-color: #59B4FF; padding: 4px; }
-QPushButton { background-color: #59B4FF; color: #FFFFFF; border: none; border-radius: 6px; padding: 8px 14px; font-weight: bold; }
-QPushButton:hover { background-color: #75C2F6; }
-QPushButton:pressed { background-color: #4A9EE0; padding-top: 9px; padding-bottom: 7px; }
-QPushButton#SecondaryBtn { background-color: #F0F4F8; color: #59B4FF; border: 1px solid #D2DCE6; }
-QPushButton#SecondaryBtn:hover { background-color: #E1EDF7; border: 1px solid #59B4FF; }
-QListWidget { background-color: transparent; border: none; }
-QListWidget::item { padding: 10px; margin: 2px 5px; border-radius: 6px; color: #34495E; }
-QListWidget::item:hover { background-color: #E8F2FA; }
-QListWidget::item:selected { background-color: #59B4FF; color: #FFFFFF; font-weight: bold; }
-QTabWidget::pane { top: -1px; }
-QTabBar::tab { background: transparent; color: #7F8C8D; padding: 10px 20px; border-bottom: 3px solid transparent; font-size: 14px; font-weight: bold; }
-QTabBar::tab:hover { color: #59B4FF; }
-QTabBar::tab:selected { color: #59B4FF; border-bottom: 3px solid #59B4FF; }
-QCheckBox { spacing: 8px; }
-QCheckBox::indicator { width: 18px; height: 18px; border-radius: 4px; border: 1px solid #D2DCE6; background: #F8FAFC; }
-QCheckBox::indicator:hover { border: 1px solid #59B4FF; }
-QCheckBox::indicator:checked { background: #59B4FF; border: 1px solid #59B4FF; }
-QScrollBar:vertical { border: none; background: transparent; width: 8px; margin: 0px; }
-QScrollBar::handle:vertical { background: #CBD5E1; min-height: 20px; border-radius: 4px; }
-QScrollBar::handle:vertical:hover { background: #94A3B8; }
-QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical { height: 0px; }
-QMenuBar { background-color: #FFFFFF; border-bottom: 1px solid #D2DCE6; }
-QMenuBar::item:selected { background-color: #F2F7FB; }
-QMenu { background-color: #FFFFFF; border: 1px solid #D2DCE6; }
-QMenu::item:selected { background-color: #59B4FF; color: #FFFFFF; }
-QLabel#FormLabel, QCheckBox#FormLabel { font-weight: bold; color: #34495E; }
-"""
-
-# ================= 深邃暗黑主题 (夜间模式) =================
-DARK_THEME = """
-QWidget { font-family: "Segoe UI Variable", "Microsoft YaHei", "PingFang SC", sans-serif; font-size: 13px; color: #E0E0E0; outline: none; }
-QMainWindow, QDialog { background-color: #121212; }
-#SidePanel, #MainTabs::pane { background-color: #1E1E1E; border-radius: 10px; border: 1px solid #333333; }
-QLineEdit, QTextEdit, QSpinBox, QComboBox { background-color: #2D2D30; border: 1px solid #3E3E42; border-radius: 6px; padding: 6px 10px; selection-background-color: #007ACC; color: #E0E0E0; }
-QLineEdit:hover, QTextEdit:hover, QSpinBox:hover, QComboBox:hover { border: 1px solid #007ACC; background-color: #333337; }
-QLineEdit:focus, QTextEdit:focus, QSpinBox:focus, QComboBox:focus { border: 2px solid #007ACC; background-color: #1E1E1E; }
-QComboBox::drop-down { subcontrol-origin: padding; subcontrol-position: top right; width: 20px; border-left: none; }
-QComboBox QAbstractItemView { border: 1px solid #3E3E42; border-radius: 6px; background-color: #2D2D30; selection-background-color: #3E3E42; selection-color: #59B4FF; padding: 4px; color: #E0E0E0; }
-QPushButton { background-color: #007ACC; color: #FFFFFF; border: none; border-radius: 6px; padding: 8px 14px; font-weight: bold; }
-QPushButton:hover { background-color: #1F8AD2; }
-QPushButton:pressed { background-color: #005A9E; padding-top: 9px; padding-bottom: 7px; }
-QPushButton#SecondaryBtn { background-color: #2D2D30; color: #007ACC; border: 1px solid #3E3E42; }
-QPushButton#SecondaryBtn:hover { background-color: #3E3E42; border: 1px solid #007ACC; }
-QListWidget { background-color: transparent; border: none; }
-QListWidget::item { padding: 10px; margin: 2px 5px; border-radius: 6px; color: #CCCCCC; }
-QListWidget::item:hover { background-color: #2A2D30; }
-QListWidget::item:selected { background-color: #007ACC; color: #FFFFFF; font-weight: bold; }
-QTabWidget::pane { top: -1px; }
-QTabBar::tab { background: transparent; color: #858585; padding: 10px 20px; border-bottom: 3px solid transparent; font-size: 14px; font-weight: bold; }
-QTabBar::tab:hover { color: #007ACC; }
-QTabBar::tab:selected { color: #007ACC; border-bottom: 3px solid #007ACC; }
-QCheckBox { spacing: 8px; }
-QCheckBox::indicator { width: 18px; height: 18px; border-radius: 4px; border: 1px solid #3E3E42; background: #2D2D30; }
-QCheckBox::indicator:hover { border: 1px solid #007ACC; }
-QCheckBox::indicator:checked { background: #007ACC; border: 1px solid #007ACC; }
-QScrollBar:vertical { border: none; background: transparent; width: 8px; margin: 0px; }
-QScrollBar::handle:vertical { background: #424242; min-height: 20px; border-radius: 4px; }
-QScrollBar::handle:vertical:hover { background: #686868; }
-QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical { height: 0px; }
-QMenuBar { background-color: #1E1E1E; border-bottom: 1px solid #333333; }
-QMenuBar::item:selected { background-color: #333337; }
-QMenu { background-color: #1E1E1E; border: 1px solid #333333; }
-QMenu::item:selected { background-color: #007ACC; color: #FFFFFF; }
-QLabel#FormLabel, QCheckBox#FormLabel { font-weight: bold; color: #CCCCCC; }
-"""
-
-# ================= 自定义组件 =================
-class PopoutEditorDialog(QDialog):
-    def __init__(self, initial_text, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle("沉浸式内容编辑器 - 支持自由调整窗口与字体大小")
-        self.resize(800, 600) 
-        self.setWindowFlags(self.windowFlags() | Qt.WindowMaximizeButtonHint | Qt.WindowMinimizeButtonHint)
-
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(15, 15, 15, 15)
-        layout.setSpacing(10)
-
-        toolbar = QHBoxLayout()
-        toolbar.addWidget(QLabel("🔠 字体大小:"))
-        
-        self.font_spinbox = QSpinBox()
-        self.font_spinbox.setRange(8, 72)
-        self.font_spinbox.setValue(16) 
-        self.font_spinbox.valueChanged.connect(self.change_font)
-        toolbar.addWidget(self.font_spinbox)
-        
-        toolbar.addStretch()
-
-        self.btn_apply = QPushButton("✔️ 确认并返回")
-        self.btn_apply.clicked.connect(self.accept)
-        toolbar.addWidget(self.btn_apply)
-
-        layout.addLayout(toolbar)
-
-        self.text_edit = QTextEdit()
-        self.text_edit.setPlainText(initial_text)
-        self.change_font(self.font_spinbox.value())
-        layout.addWidget(self.text_edit)
-
-    def change_font(self, size):
-        self.text_edit.setStyleSheet(f"QTextEdit {{ font-size: {size}pt; }}")
-
-    def get_text(self):
-        return self.text_edit.toPlainText()
-
-class DragListWidget(QListWidget):
-    itemsReordered = Signal() 
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setDragDropMode(QAbstractItemView.InternalMove)
-        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
-        
-    def dropEvent(self, event):
-        super().dropEvent(event)
-        self.itemsReordered.emit() 
-
-class ContentEditorWidget(QWidget):
-    textChanged = Signal()
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.setSpacing(10)
-
-        tools_layout = QHBoxLayout()
-        self.find_input = QLineEdit()
-        self.find_input.setPlaceholderText("🔍 查找内容...")
-        
-        self.btn_find = QPushButton("查找下一个")
-        self.btn_find.setObjectName("SecondaryBtn")
-        
-        self.replace_input = QLineEdit()
-        self.replace_input.setPlaceholderText("📝 替换为...")
-        
-        self.btn_replace = QPushButton("替换")
-        self.btn_replace.setObjectName("SecondaryBtn")
-        
-        self.btn_replace_all = QPushButton("全部替换")
-        self.btn_replace_all.setObjectName("SecondaryBtn")
-
-        self.btn_popout = QPushButton("🗔 独立窗口编辑")
-        self.btn_popout.setObjectName("SecondaryBtn")
-
-        tools_layout.addWidget(self.find_input)
-        tools_layout.addWidget(self.btn_find)
-        tools_layout.addWidget(self.replace_input)
-        tools_layout.addWidget(self.btn_replace)
-        tools_layout.addWidget(self.btn_replace_all)
-        tools_layout.addWidget(self.btn_popout)
-
-        self.text_edit = QTextEdit()
-        self.text_edit.setMinimumHeight(150)
-        
-        layout.addLayout(tools_layout)
-        layout.addWidget(self.text_edit)
-
-        self.btn_find.clicked.connect(self.find_next)
-        self.btn_replace.clicked.connect(self.replace_current)
-        self.btn_replace_all.clicked.connect(self.replace_all)
-        self.btn_popout.clicked.connect(self.open_popout) 
-        self.find_input.textChanged.connect(self.highlight_all) 
-        self.text_edit.textChanged.connect(self.textChanged.emit)
-
-    def open_popout(self):
-        dialog = PopoutEditorDialog(self.text_edit.toPlainText(), self)
-        if dialog.exec() == QDialog.Accepted:
-            self.text_edit.setPlainText(dialog.get_text())
-            self.highlight_all() 
-            self.textChanged.emit() 
-
-    def highlight_all(self):
-        search_text = self.find_input.text()
-        selections = []
-        if search_text:
-            fmt = QTextCharFormat()
-            fmt.setBackground(QColor("#FF7676")) 
-            fmt.setForeground(QColor("#FFFFFF")) 
-            
-            cursor = QTextCursor(self.text_edit.document())
-            while not cursor.isNull() and not cursor.atEnd():
-                cursor = self.text_edit.document().find(search_text, cursor)
-                if not cursor.isNull():
-                    sel = QTextEdit.ExtraSelection()
-                    sel.format = fmt
-                    sel.cursor = cursor
-                    selections.append(sel)
-        self.text_edit.setExtraSelections(selections)
-
-    def find_next(self):
-        search_text = self.find_input.text()
-        if not search_text: return
-        found = self.text_edit.find(search_text)
-        if not found:
-            self.text_edit.moveCursor(QTextCursor.Start)
-            self.text_edit.find(search_text)
-
-    def replace_current(self):
-        cursor = self.text_edit.textCursor()
-        if cursor.hasSelection() and cursor.selectedText() == self.find_input.text():
-            fmt = QTextCharFormat()
-            fmt.setBackground(QColor("#007ACC")) 
-            fmt.setForeground(QColor("#FFFFFF"))
-            cursor.insertText(self.replace_input.text(), fmt)
-            self.highlight_all() 
-            self.find_next()
-
-    def replace_all(self):
-        search_text = self.find_input.text()
-        replace_text = self.replace_input.text()
-        if not search_text: return
-        
-        cursor = QTextCursor(self.text_edit.document())
-        cursor.beginEditBlock()
-        count = 0
-        fmt = QTextCharFormat()
-        fmt.setBackground(QColor("#007ACC"))
-        fmt.setForeground(QColor("#FFFFFF"))
-        
-        while not cursor.isNull() and not cursor.atEnd():
-            cursor = self.text_edit.document().find(search_text, cursor)
-            if not cursor.isNull():
-                cursor.insertText(replace_text, fmt)
-                count += 1
-        cursor.endEditBlock()
-        self.highlight_all()
-        QMessageBox.information(self, "替换完毕", f"共替换了 {count} 处内容。")
-
-    def toPlainText(self): return self.text_edit.toPlainText()
-    def setText(self, t): self.text_edit.setText(t); self.highlight_all()
-    def clear(self): self.text_edit.clear()
-
-class ConvertDialog(QDialog):
-    def __init__(self, mode_name, parent=None):
-        super().__init__(parent)
-        self.setWindowTitle(f"选择要转换为 {mode_name} 的字段")
-        self.setMinimumWidth(300)
-        layout = QVBoxLayout(self)
-        layout.setSpacing(15)
-        layout.setContentsMargins(20, 20, 20, 20)
-        
-        self.chk_title = QCheckBox("条目标题/备忘录 (Comment)")
-        self.chk_keys = QCheckBox("主要关键字和可选过滤器 (Keys & Filters)")
-        self.chk_content = QCheckBox("条目内容 (Content)")
-        
-        self.chk_title.setChecked(True)
-        self.chk_keys.setChecked(True)
-        self.chk_content.setChecked(True)
-        
-        layout.addWidget(self.chk_title)
-        layout.addWidget(self.chk_keys)
-        layout.addWidget(self.chk_content)
-        
-        btn_layout = QHBoxLayout()
-        btn_ok = QPushButton("确定")
-        btn_cancel = QPushButton("取消")
-        btn_cancel.setObjectName("SecondaryBtn")
-        btn_ok.clicked.connect(self.accept)
-        btn_cancel.clicked.connect(self.reject)
-        btn_layout.addWidget(btn_ok)
-        btn_layout.addWidget(btn_cancel)
-        layout.addLayout(btn_layout)
-
-    def get_selection(self):
-        return self.chk_title.isChecked(), self.chk_keys.isChecked(), self.chk_content.isChecked()
-
-# ================= 主窗口 =================
-class MainWindow(QMainWindow):
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("SillyTavern 世界书本地编辑器")
-        self.resize(1150, 800)
-
-        self.is_dark_mode = False 
-        self.setStyleSheet(MODERN_BLUE_THEME)
-
-        self.current_file_path = None
-        self.world_info_data = {}
-        self.current_entry_key = None 
-        self.field_map = {} 
-        self.is_modified = False 
-
-        self.create_menu()
-
-        main_widget = QWidget()
-        self.setCentralWidget(main_widget)
-        layout = QHBoxLayout(main_widget)
-        layout.setContentsMargins(20, 20, 20, 20)
-        layout.setSpacing(20)
-
-        left_panel = QFrame()
-        left_panel.setObjectName("SidePanel") 
-        left_panel.setFixedWidth(300)
-        left_layout = QVBoxLayout(left_panel)
-        left_layout.setContentsMargins(15, 15, 15, 15)
-        left_layout.setSpacing(12)
-
-        self.search_bar = QLineEdit()
-        self.search_bar.setPlaceholderText("🔍 全局搜索 (标题/词/内容)...")
-        left_layout.addWidget(self.search_bar)
-
-        self.list_widget = DragListWidget()
-        left_layout.addWidget(self.list_widget)
-
-        btn_layout1 = QHBoxLayout()
-        self.btn_add = QPushButton("➕ 新增")
-        self.btn_del = QPushButton("❌ 批量删除")
-        self.btn_del.setObjectName("SecondaryBtn") 
-        self.btn_move = QPushButton("📍 批量移至...")
-        self.btn_move.setObjectName("SecondaryBtn")
-        btn_layout1.addWidget(self.btn_add)
-        btn_layout1.addWidget(self.btn_move)
-        btn_layout1.addWidget(self.btn_del)
-        left_layout.addLayout(btn_layout1)
-        
-        btn_layout2 = QHBoxLayout()
-        self.btn_simp = QPushButton("🇨🇳 简")
-        self.btn_trad = QPushButton("🇭🇰 繁")
-        self.btn_simp.setObjectName("SecondaryBtn")
-        self.btn_trad.setObjectName("SecondaryBtn")
-        
-        self.btn_theme = QPushButton("🌙 暗黑模式")
-        self.btn_theme.setObjectName("SecondaryBtn")
-
-        btn_layout2.addWidget(self.btn_simp)
-        btn_layout2.addWidget(self.btn_trad)
-        btn_layout2.addWidget(self.btn_theme)
-        left_layout.addLayout(btn_layout2)
-
-        layout.addWidget(left_panel)
-
-        self.tabs = QTabWidget()
-        self.tabs.setObjectName("MainTabs")
-        layout.addWidget(self.tabs)
-
-        self.setup_tabs()
-        
-        self.field_map['position']['widget'].currentIndexChanged.connect(self.update_position_ui)
-        self.field_map['delayUntilRecursion']['widget'].toggled.connect(self.update_recursion_ui)
-        self.list_widget.itemClicked.connect(self.on_item_clicked)
-        self.search_bar.textChanged.connect(self.filter_list)
-        self.btn_add.clicked.connect(self.add_entry)
-        self.btn_del.clicked.connect(self.delete_entry)
-        
-        self.list_widget.itemsReordered.connect(self.on_items_reordered)
-        
-        self.btn_move.clicked.connect(self.move_to_index)
-        self.btn_simp.clicked.connect(lambda: self.convert_chinese('zh-cn'))
-        self.btn_trad.clicked.connect(lambda: self.convert_chinese('zh-tw'))
-        self.btn_theme.clicked.connect(self.toggle_theme)
-
-    def toggle_theme(self):
-        self.is_dark_mode = not self.is_dark_mode
-        if self.is_dark_mode:
-            self.setStyleSheet(DARK_THEME)
-            self.btn_theme.setText("☀️ 日间模式")
-        else:
-            self.setStyleSheet(MODERN_BLUE_THEME)
-            self.btn_theme.setText("🌙 暗黑模式")
-
-    def set_modified(self):
-        if not self.is_modified:
-            self.is_modified = True
-            title = self.windowTitle()
-            if not title.endswith("*"):
-                self.setWindowTitle(title + " *")
-
-    def create_menu(self):
-        menubar = self.menuBar()
-        file_menu = menubar.addMenu("文件 (File)")
-
-        new_action = QAction("新建", self)
-        new_action.setShortcut("Ctrl+N")
-        new_action.triggered.connect(self.new_file)
-        file_menu.addAction(new_action)
-
-        open_action = QAction("打开", self)
-        open_action.setShortcut("Ctrl+O")
-        open_action.triggered.connect(self.open_file_dialog)
-        file_menu.addAction(open_action)
-        
-        save_action = QAction("保存", self)
-        save_action.setShortcut("Ctrl+S")
-        save_action.triggered.connect(self.save_file)
-        file_menu.addAction(save_action)
-        
-        save_as_action = QAction("另存为", self) 
-        save_as_action.setShortcut("Ctrl+Shift+S")
-        save_as_action.triggered.connect(self.save_as_file)
-        file_menu.addAction(save_as_action)
-
-    def add_field(self, layout, label, json_key, widget_type, **kwargs):
-        label_widget = None
-        if widget_type == 'text':
-            w = QLineEdit()
-            w.textChanged.connect(lambda _: self.set_modified())
-            layout.addRow(label, w)
-        elif widget_type == 'content_editor': 
-            w = ContentEditorWidget()
-            w.textChanged.connect(self.set_modified)
-            layout.addRow(label, w)
-        elif widget_type == 'bool' or widget_type == 'invert_bool':
-            w = QCheckBox(label)
-            w.toggled.connect(lambda _: self.set_modified())
-            layout.addRow("", w)
-        elif widget_type == 'int':
-            w = QSpinBox()
-            w.setRange(kwargs.get('min', 0), kwargs.get('max', 99999))
-            w.valueChanged.connect(lambda _: self.set_modified())
-            layout.addRow(label, w)
-        elif widget_type == 'nullable_int':
-            w = QLineEdit()
-            w.setPlaceholderText("为空则使用全局设置")
-            w.setValidator(QIntValidator(0, 99999, w)) 
-            w.textChanged.connect(lambda _: self.set_modified())
-            layout.addRow(label, w)
-        elif widget_type == 'combo' or widget_type == 'strategy_combo':
-            w = QComboBox()
-            w.addItems(kwargs.get('items', []))
-            w.currentIndexChanged.connect(lambda _: self.set_modified())
-            layout.addRow(label, w)
-        elif widget_type == 'tristate_combo':
-            w = QComboBox()
-            w.addItems(["使用全局 (Global)", "是 (Yes)", "否 (No)"])
-            w.currentIndexChanged.connect(lambda _: self.set_modified())
-            layout.addRow(label, w)
-        elif widget_type == 'multicheck':
-            w = QWidget()
-            h_layout = QHBoxLayout(w)
-            h_layout.setContentsMargins(0, 0, 0, 0)
-            h_layout.setSpacing(15) 
-            w.checkboxes = {}
-            for val, txt in kwargs.get('options', {}).items():
-                cb = QCheckBox(txt)
-                cb.toggled.connect(lambda _: self.set_modified())
-                w.checkboxes[val] = cb
-                h_layout.addWidget(cb)
-            layout.addRow(label, w)
-
-        if label: 
-            label_widget = layout.labelForField(w)
-            if label_widget:
-                label_widget.setObjectName("FormLabel")
-            elif isinstance(w, QCheckBox):
-                w.setObjectName("FormLabel")
-
-        self.field_map[json_key] = {'widget': w, 'type': widget_type, 'label_widget': label_widget}
-
-    def toggle_visibility(self, json_key, visible):
-        if json_key in self.field_map:
-            config = self.field_map[json_key]
-            config['widget'].setVisible(visible)
-            if config['label_widget']: config['label_widget'].setVisible(visible)
-
-    def update_position_ui(self):
-        idx = self.field_map['position']['widget'].currentIndex()
-        self.toggle_visibility('depth', idx == 6)
-        self.toggle_visibility('role', idx == 6)
-        self.toggle_visibility('outletName', idx == 7)
-
-    def update_recursion_ui(self):
-        self.toggle_visibility('recursionLevel', self.field_map['delayUntilRecursion']['widget'].isChecked())
-
-    def _create_tab_widget(self):
-        tab = QWidget()
-        layout = QFormLayout(tab)
-        layout.setContentsMargins(25, 25, 25, 25)
-        layout.setSpacing(18) 
-        return tab, layout
-
-    def setup_tabs(self):
-        tab_basic, layout_basic = self._create_tab_widget()
-        self.add_field(layout_basic, "条目标题/备忘录 (Comment):", "comment", "text")
-        self.add_field(layout_basic, "主要关键字 (Keys) [逗号分隔]:", "key", "text") 
-        self.add_field(layout_basic, "可选过滤器 (Optional Filter):", "keysecondary", "text") 
-        self.add_field(layout_basic, "过滤器逻辑:", "selectiveLogic", "combo", items=["AND ANY (包含任一)", "AND ALL (包含所有)", "NOT ANY (不包含任一)", "NOT ALL (不包含所有)"])
-        self.add_field(layout_basic, "条目内容 (Content):", "content", "content_editor") 
-        self.add_field(layout_basic, "自动化 ID (Automation ID):", "automationId", "text") 
-        
-        layout_basic.addRow(QLabel("")) 
-        self.add_field(layout_basic, "✅ 启用此条目 (Enable)", "disable", "invert_bool") 
-        self.add_field(layout_basic, "生效策略 (Strategy):", "strategy", "strategy_combo", items=["条件触发 (🟢 默认)", "常驻 (🔵 始终插入)", "向量化匹配 (🔗 相似度)"]) 
-        self.tabs.addTab(tab_basic, "基础设定")
-
-        tab_insert, layout_insert = self._create_tab_widget()
-        self.add_field(layout_insert, "顺序 (Order):", "order", "int") 
-        self.add_field(layout_insert, "触发策略/插入位置:", "position", "combo", items=["角色定义前", "角色定义后", "示例消息前", "示例消息后", "作者注释顶", "作者注释底", "@ D", "锚点 (Outlet)"]) 
-        self.add_field(layout_insert, "↳ 深度在 (@ D):", "depth", "int") 
-        self.add_field(layout_insert, "↳ 扮演角色 (Role):", "role", "combo", items=["⚙️ [系统]", "👤 [用户]", "🤖 [AI]"]) 
-        self.add_field(layout_insert, "↳ 锚点名称 (Outlet Name):", "outletName", "text") 
-        
-        layout_insert.addRow(QLabel("")) 
-        self.add_field(layout_insert, "扫描深度 (Scan Depth):", "scanDepth", "nullable_int") 
-        self.add_field(layout_insert, "触发概率 (Trigger %):", "probability", "int", max=100) 
-        self.add_field(layout_insert, "区分大小写 (Case Sensitive)", "caseSensitive", "tristate_combo") 
-        self.add_field(layout_insert, "完整单词/全字匹配 (Match Whole Words)", "matchWholeWords", "tristate_combo") 
-        
-        layout_insert.addRow(QLabel("")) 
-        self.add_field(layout_insert, "包含组 (Group):", "group", "text") 
-        self.add_field(layout_insert, "组权重 (Group Weight):", "groupWeight", "int", max=10000) 
-        self.add_field(layout_insert, "确定优先级 (Prioritize Inclusion)", "groupOverride", "bool") 
-        self.add_field(layout_insert, "组评分 (Use Group Scoring)", "useGroupScoring", "tristate_combo") 
-        
-        layout_insert.addRow(QLabel("")) 
-        self.add_field(layout_insert, "绑定到角色或标签 (Character Filter):", "characterFilter", "text") 
-        self.add_field(layout_insert, "排除 (Exclude Filter)", "characterFilterExclude", "bool") 
-        self.tabs.addTab(tab_insert, "插入与匹配")
-
-        tab_adv, layout_adv = self._create_tab_widget()
-        self.add_field(layout_adv, "筛选生成触发器 (Triggers):", "triggers", "multicheck", options={"normal": "正常", "continue": "继续", "impersonate": "扮演", "swipe": "滑动", "regenerate": "重新生成", "quiet": "静默"})
-        
-        layout_adv.addRow(QLabel("")) 
-        self.add_field(layout_adv, "黏性 (Sticky):", "sticky", "int") 
-        self.add_field(layout_adv, "冷却 (Cooldown):", "cooldown", "int") 
-        self.add_field(layout_adv, "延迟 (Delay):", "delay", "int") 
-        
-        layout_adv.addRow(QLabel("")) 
-        self.add_field(layout_adv, "不可递归 (不会被其他条目激活) (Exclude Recursion)", "excludeRecursion", "bool")
-        self.add_field(layout_adv, "无视回复限额 (Ignore Budget)", "ignoreBudget", "bool")
-        self.add_field(layout_adv, "防止进一步递归 (Prevent Recursion)", "preventRecursion", "bool") 
-        self.add_field(layout_adv, "延迟到递归", "delayUntilRecursion", "bool") 
-        self.add_field(layout_adv, "↳ 递归等级 (Recursion Level):", "recursionLevel", "int") 
-        
-        layout_adv.addRow(QLabel("")) 
-        self.add_field(layout_adv, "匹配角色描述", "matchCharacterDescription", "bool") 
-        self.add_field(layout_adv, "匹配角色备注", "matchCharacterDepthPrompt", "bool") 
-        self.add_field(layout_adv, "匹配角色性格", "matchCharacterPersonality", "bool") 
-        self.add_field(layout_adv, "匹配情景", "matchScenario", "bool") 
-        self.add_field(layout_adv, "匹配用户设定描述", "matchPersonaDescription", "bool") 
-        self.add_field(layout_adv, "匹配创作者注释", "matchCreatorNotes", "bool") 
-        self.tabs.addTab(tab_adv, "其他")
-
-    def new_file(self):
-        if not self.check_unsaved_changes(): return
-        self.world_info_data = {}
-        self.current_file_path = None
-        self.current_entry_key = None
-        self.is_modified = False
-        self.refresh_list()
-        self.clear_form()
-        self.setWindowTitle("SillyTavern 世界书编辑器 - [未命名新文件]")
-
-    def open_file_dialog(self):
-        if not self.check_unsaved_changes(): return
-        file_path, _ = QFileDialog.getOpenFileName(self, "选择世界书文件", "", "JSON Files (*.json);;All Files (*)")
-        if file_path:
-            self.current_file_path = file_path
-            self.load_data(file_path)
-
-    def load_data(self, file_path):
-        self.current_entry_key = None 
-        try:
-            backup_path = file_path + f".backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            shutil.copy2(file_path, backup_path)
-            
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                self.world_info_data = data.get("entries", {})
-            self.refresh_list()
-            self.setWindowTitle(f"SillyTavern 世界书编辑器 - {file_path}")
-            self.is_modified = False 
-        except Exception as e:
-            QMessageBox.critical(self, "读取错误", f"无法读取文件:\n{str(e)}")
-
-    # ================= [核心修复] 保持刷新列表时滚动条位置不动 =================
-    def refresh_list(self):
-        # 记录当前滚动条位置
-        v_scrollbar = self.list_widget.verticalScrollBar()
-        current_scroll = v_scrollbar.value()
-        
-        self.list_widget.clear()
-        for key in self.world_info_data.keys():
-            item = QListWidgetItem()
-            item.setData(Qt.UserRole, key)
-            self.list_widget.addItem(item)
-        self.update_list_display()
-        
-        # 恢复滚动条位置，防止列表乱跳
-        v_scrollbar.setValue(current_scroll)
-
-    def update_list_display(self):
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            key = item.data(Qt.UserRole)
-            entry = self.world_info_data.get(key, {})
-            
-            display_name = entry.get("comment", "")
-            if not display_name:
-                keys = entry.get("key", [])
-                display_name = ", ".join(keys) if keys else f"未命名条目 {key}"
-                
-            item.setText(f"[{i + 1}] {display_name}")
-
-    def filter_list(self, text):
-        search_text = text.lower()
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            entry_key = item.data(Qt.UserRole)
-            entry = self.world_info_data.get(entry_key, {})
-            
-            title = entry.get("comment", "").lower()
-            keys = ", ".join(entry.get("key", [])).lower()
-            keys_sec = ", ".join(entry.get("keysecondary", [])).lower()
-            content = entry.get("content", "").lower()
-            
-            if search_text in title or search_text in keys or search_text in keys_sec or search_text in content:
-                item.setHidden(False)
-            else:
-                item.setHidden(True)
-
-    def on_items_reordered(self):
-        self.save_current_ui_to_memory()
-        new_keys = []
-        for i in range(self.list_widget.count()):
-            new_keys.append(self.list_widget.item(i).data(Qt.UserRole))
-            
-        new_dict = {k: self.world_info_data[k] for k in new_keys}
-        self.world_info_data = new_dict
-        
-        self.set_modified()
-        self.update_list_display() 
-
-    def move_to_index(self):
-        selected_items = self.list_widget.selectedItems()
-        if not selected_items: 
-            QMessageBox.warning(self, "提示", "请先选择要移动的条目！")
-            return
-            
-        selected_rows = sorted([self.list_widget.row(item) for item in selected_items])
-        selected_keys = [self.list_widget.item(row).data(Qt.UserRole) for row in selected_rows]
-        
-        total = self.list_widget.count()
-        new_row, ok = QInputDialog.getInt(self, "批量移动", f"您选中了 {len(selected_items)} 个条目。\n输入它们要插入的目标位置 (1 到 {total}):", selected_rows[0] + 1, 1, total, 1)
-        
-        if ok:
-            self.save_current_ui_to_memory()
-            target_index = new_row - 1
-            
-            keys = list(self.world_info_data.keys())
-            
-            for k in selected_keys:
-                keys.remove(k)
-            
-            target_index = min(target_index, len(keys))
-            for i, k in enumerate(selected_keys):
-                keys.insert(target_index + i, k)
-                
-            new_dict = {k: self.world_info_data[k] for k in keys}
-            self.world_info_data = new_dict
-            
-            self.set_modified()
-            self.refresh_list()
-            
-            # [新增体验优化] 移动后自动滚动并高亮选中的条目
-            self.list_widget.clearSelection()
-            last_item = None
-            for i in range(self.list_widget.count()):
-                item = self.list_widget.item(i)
-                if item.data(Qt.UserRole) in selected_keys:
-                    item.setSelected(True)
-                    last_item = item
-            if last_item:
-                self.list_widget.scrollToItem(last_item)
-
-    def convert_chinese(self, target_lang):
-        selected_items = self.list_widget.selectedItems()
-        if not selected_items:
-            QMessageBox.warning(self, "提示", "请先选择要转换的条目！(支持按住 Ctrl/Shift 多选)")
-            return
-            
-        mode_str = "简体" if target_lang == 'zh-cn' else "繁体"
-        dialog = ConvertDialog(mode_str, self)
-        if dialog.exec() != QDialog.Accepted: return
-            
-        conv_title, conv_keys, conv_content = dialog.get_selection()
-        self.save_current_ui_to_memory()
-        
-        selected_rows = sorted([self.list_widget.row(item) for item in selected_items])
-        selected_keys = [self.list_widget.item(row).data(Qt.UserRole) for row in selected_rows]
-        
-        keys_list = list(self.world_info_data.keys())
-        new_keys_added = [] # 记录新生成的条目ID
-        
-        for original_key in selected_keys:
-            original_data = self.world_info_data[original_key]
-            new_data = json.loads(json.dumps(original_data)) 
-            
-            existing_keys = [int(k) for k in self.world_info_data.keys() if k.isdigit()]
-            new_id = str(max(existing_keys) + 1) if existing_keys else "0"
-            new_data["uid"] = int(new_id)
-            
-            suffix = " - 简" if target_lang == 'zh-cn' else " - 繁"
-
-            try:
-                if conv_title:
-                    new_data["comment"] = zhconv.convert(new_data.get("comment", ""), target_lang) + suffix
-                else:
-                    new_data["comment"] = new_data.get("comment", "") + suffix
-                    
-                if conv_keys:
-                    new_data["key"] = [zhconv.convert(k, target_lang) for k in new_data.get("key", [])]
-                    new_data["keysecondary"] = [zhconv.convert(k, target_lang) for k in new_data.get("keysecondary", [])]
-                    
-                if conv_content:
-                    new_data["content"] = zhconv.convert(new_data.get("content", ""), target_lang)
-            except Exception as e:
-                QMessageBox.critical(self, "转换失败", f"简繁转换过程中发生错误 (可能是打包时丢失了字典文件)：\n{str(e)}")
-                return
-
-            insert_idx = keys_list.index(original_key) + 1
-            keys_list.insert(insert_idx, new_id)
-            self.world_info_data[new_id] = new_data
-            new_keys_added.append(new_id)
-            
-        new_dict = {k: self.world_info_data.get(k) for k in keys_list}
-        self.world_info_data = new_dict
-        
-        self.set_modified()
-        self.refresh_list()
-
-        # [新增体验优化] 自动选中最新生成的简繁条目，并智能跟随滚动！
-        self.list_widget.clearSelection()
-        last_item = None
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            if item.data(Qt.UserRole) in new_keys_added:
-                item.setSelected(True)
-                last_item = item
-                
-        if last_item:
-            self.list_widget.scrollToItem(last_item)
-
-    def add_entry(self):
-        existing_keys = [int(k) for k in self.world_info_data.keys() if k.isdigit()]
-        new_id = str(max(existing_keys) + 1) if existing_keys else "0"
-
-        new_entry = {
-            "uid": int(new_id), "key": [], "keysecondary": [], "comment": "新条目", "content": "",
-            "constant": False, "vectorized": False, "selective": True, "selectiveLogic": 0,
-            "addMemo": True, "order": 100, "position": 0, "disable": False, "ignoreBudget": False, 
-            "excludeRecursion": False, "preventRecursion": False, "delayUntilRecursion": False, "recursionLevel": 0,
-            "matchPersonaDescription": False, "matchCharacterDescription": False, "matchCharacterPersonality": False, 
-            "matchCharacterDepthPrompt": False, "matchScenario": False, "matchCreatorNotes": False, 
-            "probability": 100, "useProbability": True,
-            "depth": 4, "outletName": "", "group": "", "groupOverride": False, "groupWeight": 100, "useGroupScoring": None, 
-            "scanDepth": None, "automationId": "", "role": 0, "sticky": 0, "cooldown": 0, "delay": 0,
-            "characterFilter": [], "characterFilterExclude": False, "triggers": [],
-            "caseSensitive": None, "matchWholeWords": None 
-        }
-
-        self.world_info_data[new_id] = new_entry
-        self.set_modified()
-        self.refresh_list()
-        self.list_widget.setCurrentRow(self.list_widget.count() - 1)
-        self.on_item_clicked(self.list_widget.currentItem())
-
-    def delete_entry(self):
-        selected_items = self.list_widget.selectedItems()
-        if not selected_items: 
-            return
-            
-        count = len(selected_items)
-        reply = QMessageBox.question(self, '确认', f'确定要删除选中的 {count} 个条目吗？', QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-        
-        if reply == QMessageBox.Yes:
-            keys_to_del = [item.data(Qt.UserRole) for item in selected_items]
-            
-            for key in keys_to_del:
-                if key in self.world_info_data:
-                    del self.world_info_data[key]
-                    
-            if self.current_entry_key in keys_to_del:
-                self.current_entry_key = None
-                self.clear_form()
-                
-            self.set_modified()
-            self.refresh_list()
-
-    def clear_form(self):
-        for json_key, config in self.field_map.items():
-            w, w_type = config['widget'], config['type']
-            if w_type in ['text', 'content_editor', 'nullable_int']: w.clear() 
-            elif w_type in ['bool', 'invert_bool']: w.setChecked(w_type == 'invert_bool') 
-            elif w_type == 'int': w.setValue(0)
-            elif w_type in ['combo', 'strategy_combo', 'tristate_combo']: w.setCurrentIndex(0) 
-            elif w_type == 'multicheck':
-                for cb in w.checkboxes.values(): cb.setChecked(False)
-
-    def save_current_ui_to_memory(self):
-        if not self.current_entry_key or self.current_entry_key not in self.world_info_data: return
-        entry = self.world_info_data[self.current_entry_key]
-        
-        for json_key, config in self.field_map.items():
-            w, w_type = config['widget'], config['type']
-            
-            if w_type in ['text', 'content_editor']:
-                val = w.text() if w_type == 'text' else w.toPlainText()
-                if json_key in ['key', 'keysecondary', 'characterFilter']:
-                    entry[json_key] = [k.strip() for k in val.split(',')] if val.strip() else []
-                else:
-                    entry[json_key] = val
-            elif w_type == 'bool': entry[json_key] = w.isChecked()
-            elif w_type == 'invert_bool': entry[json_key] = not w.isChecked()
-            elif w_type == 'int': entry[json_key] = w.value()
-            elif w_type == 'nullable_int':
-                text_val = w.text().strip()
-                entry[json_key] = int(text_val) if text_val.isdigit() else None
-            elif w_type == 'combo': entry[json_key] = w.currentIndex()
-            elif w_type == 'tristate_combo':
-                idx = w.currentIndex()
-                if idx == 0: entry[json_key] = None     
-                elif idx == 1: entry[json_key] = True   
-                elif idx == 2: entry[json_key] = False  
-            elif w_type == 'strategy_combo':
-                idx = w.currentIndex()
-                if idx == 1:   entry['constant'], entry['vectorized'], entry['selective'] = True, False, False
-                elif idx == 2: entry['constant'], entry['vectorized'], entry['selective'] = False, True, True
-                else:          entry['constant'], entry['vectorized'], entry['selective'] = False, False, True
-            elif w_type == 'multicheck':
-                entry[json_key] = [val for val, cb in w.checkboxes.items() if cb.isChecked()]
-
-        self.update_list_display()
-
-    def on_item_clicked(self, item):
-        self.save_current_ui_to_memory()
-        self.current_entry_key = item.data(Qt.UserRole)
-        entry_data = self.world_info_data[self.current_entry_key]
-
-        for config in self.field_map.values(): config['widget'].blockSignals(True)
-
-        for json_key, config in self.field_map.items():
-            w, w_type = config['widget'], config['type']
-            val = entry_data.get(json_key)
-            
-            if w_type in ['text', 'content_editor']:
-                if json_key in ['key', 'keysecondary', 'characterFilter']:
-                    val_str = ", ".join(val) if isinstance(val, list) else ""
-                else:
-                    val_str = str(val) if val is not None else ""
-                w.setText(val_str)
-            elif w_type == 'bool': w.setChecked(bool(val))
-            elif w_type == 'invert_bool': w.setChecked(not bool(val))
-            elif w_type == 'int': w.setValue(int(val) if val is not None else 0)
-            elif w_type == 'nullable_int': 
-                w.setText(str(val) if val is not None else "")
-            elif w_type == 'combo': w.setCurrentIndex(int(val) if val is not None else 0)
-            elif w_type == 'tristate_combo':
-                if val is None: w.setCurrentIndex(0)
-                elif val is True: w.setCurrentIndex(1)
-                elif val is False: w.setCurrentIndex(2)
-            elif w_type == 'strategy_combo':
-                if entry_data.get('constant'): w.setCurrentIndex(1)
-                elif entry_data.get('vectorized'): w.setCurrentIndex(2)
-                else: w.setCurrentIndex(0)
-            elif w_type == 'multicheck':
-                val_list = val if isinstance(val, list) else []
-                for opt_val, cb in w.checkboxes.items():
-                    cb.setChecked(opt_val in val_list)
-        
-        for config in self.field_map.values(): config['widget'].blockSignals(False)
-        self.update_position_ui()
-        self.update_recursion_ui()
-
-    def save_file(self):
-        if not self.current_file_path:
-            return self.save_as_file()
-            
-        self.save_current_ui_to_memory()
-        save_data = {"entries": self.world_info_data}
-        try:
-            with open(self.current_file_path, "w", encoding="utf-8") as f:
-                json.dump(save_data, f, ensure_ascii=False, separators=(',', ':'))
-            self.is_modified = False
-            self.setWindowTitle(f"SillyTavern 世界书编辑器 - {self.current_file_path}")
-            QMessageBox.information(self, "成功", "世界书文件已成功保存！")
-            return True
-        except Exception as e:
-            QMessageBox.critical(self, "保存失败", f"错误信息:\n{str(e)}")
-            return False
-
-    def save_as_file(self):
-        file_path, _ = QFileDialog.getSaveFileName(self, "另存为", "", "JSON Files (*.json)")
-        if file_path:
-            self.current_file_path = file_path
-            return self.save_file()
-        return False
-
-    def check_unsaved_changes(self):
-        if not self.is_modified: return True
-        
-        msg_box = QMessageBox(self)
-        msg_box.setWindowTitle("未保存的更改")
-        msg_box.setText("您有未保存的更改。请问要如何处理？")
-        btn_save = msg_box.addButton("保存并退出", QMessageBox.AcceptRole)
-        btn_save_as = msg_box.addButton("另存为...", QMessageBox.AcceptRole)
-        btn_discard = msg_box.addButton("直接退出", QMessageBox.DestructiveRole)
-        btn_cancel = msg_box.addButton("取消", QMessageBox.RejectRole)
-        
-        msg_box.exec()
-        
-        if msg_box.clickedButton() == btn_save: return self.save_file()
-        elif msg_box.clickedButton() == btn_save_as: return self.save_as_file()
-        elif msg_box.clickedButton() == btn_discard: return True
-        else: return False
-
-    def closeEvent(self, event: QCloseEvent):
-        if self.check_unsaved_changes(): event.accept()
-        else: event.ignore()
-
-if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    window = MainWindow()
-    window.show()
-    sys.exit(app.exec())
+import time
+STARTUP_STARTED = time.perf_counter()  # 启动耗时从这里算起，必须在导入 PySide6 之前
+import sys
+import bisect
+import heapq
+import importlib.util
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import threading
+from datetime import datetime
+from worldinfo import (WorldInfoEntry, entry_display_name, LazyContent, ContentStore, LAZY_CONTENT_MIN_BYTES,
+                       LorebookStreamReader, EntrySearchIndex, ChangeJournal, UndoStack, UidAllocator,
+                       LorebookWriter, write_lorebook, build_save_data, EntryOrder, CONVERT_FIELDS,
+                       conversion_cache, field_snapshots, convert_entries, converted_entry,
+                       REPLACE_FIELDS, compile_find_pattern, count_matches, replace_matches, ActivationSimulator,
+                       ActivationGraph, trigger_snapshot, TokenBudget, budget_snapshot, BUDGET_FIELDS,
+                       DuplicateFinder, duplicate_snapshot, shingle_similarity)
+from PySide6.QtCore import (Qt, Signal, QSize, QAbstractListModel, QModelIndex, QItemSelection, QItemSelectionModel,
+                            QObject, QRunnable, QThreadPool, QTimer, QSettings)
+from PySide6.QtGui import (QAction, QTextCursor, QTextCharFormat, QColor, QCloseEvent, QIntValidator, QFont, QDrag,
+                           QSyntaxHighlighter, QTextDocument)
+from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget,
+                               QHBoxLayout, QVBoxLayout, QListView, QPlainTextEdit, QPlainTextDocumentLayout,
+                               QLineEdit, QFormLayout, QFileDialog,
+                               QCheckBox, QSpinBox, QMessageBox, QTabWidget, QComboBox,
+                               QPushButton, QAbstractItemView, QDialog, QInputDialog, QFrame, QLabel, QProgressBar,
+                               QProgressDialog, QTreeWidget, QTreeWidgetItem)
+
+# ================= 现代蓝白主题 (日间模式) =================
+MODERN_BLUE_THEME = """
+QWidget {
+    font-family: "Segoe UI Variable", "Microsoft YaHei", "PingFang SC", sans-serif;
+    font-size: 13px;
+    color: #2C3E50;
+    outline: none;
+}
+QMainWindow, QDialog { background-color: #F2F7FB; }
+#SidePanel, #MainTabs::pane { background-color: #FFFFFF; border-radius: 10px; border: 1px solid #E1E8EE; }
+QLineEdit, QTextEdit, QPlainTextEdit, QSpinBox, QComboBox { background-color: #F8FAFC; border: 1px solid #D2DCE6; border-radius: 6px; padding: 6px 10px; selection-background-color: #75C2F6; }
+QLineEdit:hover, QTextEdit:hover, QPlainTextEdit:hover, QSpinBox:hover, QComboBox:hover { border: 1px solid #75C2F6; background-color: #FFFFFF; }
+QLineEdit:focus, QTextEdit:focus, QPlainTextEdit:focus, QSpinBox:focus, QComboBox:focus { border: 2px solid #59B4FF; background-color: #FFFFFF; }
+QComboBox::drop-down { subcontrol-origin: padding; subcontrol-position: top right; width: 20px; border-left: none; }
+QComboBox QAbstractItemView { border: 1px solid #D2DCE6; border-radius: 6px; background-color: #FFFFFF; selection-background-color: #ECF5FF; selection-color: #59B4FF; padding: 4px; }
+QPushButton { background-color: #59B4FF; color: #FFFFFF; border: none; border-radius: 6px; padding: 8px 14px; font-weight: bold; }
+QPushButton:hover { background-color: #75C2F6; }
+QPushButton:pressed { background-color: #4A9EE0; padding-top: 9px; padding-bottom: 7px; }
+QPushButton#SecondaryBtn { background-color: #F0F4F8; color: #59B4FF; border: 1px solid #D2DCE6; }
+QPushButton#SecondaryBtn:hover { background-color: #E1EDF7; border: 1px solid #59B4FF; }
+QListView#EntryList { background-color: transparent; border: none; }
+QListView#EntryList::item { padding: 10px; margin: 2px 5px; border-radius: 6px; color: #34495E; }
+QListView#EntryList::item:hover { background-color: #E8F2FA; }
+QListView#EntryList::item:selected { background-color: #59B4FF; color: #FFFFFF; font-weight: bold; }
+QTabWidget::pane { top: -1px; }
+QTabBar::tab { background: transparent; color: #7F8C8D; padding: 10px 20px; border-bottom: 3px solid transparent; font-size: 14px; font-weight: bold; }
+QTabBar::tab:hover { color: #59B4FF; }
+QTabBar::tab:selected { color: #59B4FF; border-bottom: 3px solid #59B4FF; }
+QCheckBox { spacing: 8px; }
+QCheckBox::indicator { width: 18px; height: 18px; border-radius: 4px; border: 1px solid #D2DCE6; background: #F8FAFC; }
+QCheckBox::indicator:hover { border: 1px solid #59B4FF; }
+QCheckBox::indicator:checked { background: #59B4FF; border: 1px solid #59B4FF; }
+QScrollBar:vertical { border: none; background: transparent; width: 8px; margin: 0px; }
+QScrollBar::handle:vertical { background: #CBD5E1; min-height: 20px; border-radius: 4px; }
+QScrollBar::handle:vertical:hover { background: #94A3B8; }
+QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical { height: 0px; }
+QMenuBar { background-color: #FFFFFF; border-bottom: 1px solid #D2DCE6; }
+QMenuBar::item:selected { background-color: #F2F7FB; }
+QMenu { background-color: #FFFFFF; border: 1px solid #D2DCE6; }
+QMenu::item:selected { background-color: #59B4FF; color: #FFFFFF; }
+QLabel#FormLabel, QCheckBox#FormLabel { font-weight: bold; color: #34495E; }
+"""
+
+# ================= 深邃暗黑主题 (夜间模式) =================
+DARK_THEME = """
+QWidget { font-family: "Segoe UI Variable", "Microsoft YaHei", "PingFang SC", sans-serif; font-size: 13px; color: #E0E0E0; outline: none; }
+QMainWindow, QDialog { background-color: #121212; }
+#SidePanel, #MainTabs::pane { background-color: #1E1E1E; border-radius: 10px; border: 1px solid #333333; }
+QLineEdit, QTextEdit, QPlainTextEdit, QSpinBox, QComboBox { background-color: #2D2D30; border: 1px solid #3E3E42; border-radius: 6px; padding: 6px 10px; selection-background-color: #007ACC; color: #E0E0E0; }
+QLineEdit:hover, QTextEdit:hover, QPlainTextEdit:hover, QSpinBox:hover, QComboBox:hover { border: 1px solid #007ACC; background-color: #333337; }
+QLineEdit:focus, QTextEdit:focus, QPlainTextEdit:focus, QSpinBox:focus, QComboBox:focus { border: 2px solid #007ACC; background-color: #1E1E1E; }
+QComboBox::drop-down { subcontrol-origin: padding; subcontrol-position: top right; width: 20px; border-left: none; }
+QComboBox QAbstractItemView { border: 1px solid #3E3E42; border-radius: 6px; background-color: #2D2D30; selection-background-color: #3E3E42; selection-color: #59B4FF; padding: 4px; color: #E0E0E0; }
+QPushButton { background-color: #007ACC; color: #FFFFFF; border: none; border-radius: 6px; padding: 8px 14px; font-weight: bold; }
+QPushButton:hover { background-color: #1F8AD2; }
+QPushButton:pressed { background-color: #005A9E; padding-top: 9px; padding-bottom: 7px; }
+QPushButton#SecondaryBtn { background-color: #2D2D30; color: #007ACC; border: 1px solid #3E3E42; }
+QPushButton#SecondaryBtn:hover { background-color: #3E3E42; border: 1px solid #007ACC; }
+QListView#EntryList { background-color: transparent; border: none; }
+QListView#EntryList::item { padding: 10px; margin: 2px 5px; border-radius: 6px; color: #CCCCCC; }
+QListView#EntryList::item:hover { background-color: #2A2D30; }
+QListView#EntryList::item:selected { background-color: #007ACC; color: #FFFFFF; font-weight: bold; }
+QTabWidget::pane { top: -1px; }
+QTabBar::tab { background: transparent; color: #858585; padding: 10px 20px; border-bottom: 3px solid transparent; font-size: 14px; font-weight: bold; }
+QTabBar::tab:hover { color: #007ACC; }
+QTabBar::tab:selected { color: #007ACC; border-bottom: 3px solid #007ACC; }
+QCheckBox { spacing: 8px; }
+QCheckBox::indicator { width: 18px; height: 18px; border-radius: 4px; border: 1px solid #3E3E42; background: #2D2D30; }
+QCheckBox::indicator:hover { border: 1px solid #007ACC; }
+QCheckBox::indicator:checked { background: #007ACC; border: 1px solid #007ACC; }
+QScrollBar:vertical { border: none; background: transparent; width: 8px; margin: 0px; }
+QScrollBar::handle:vertical { background: #424242; min-height: 20px; border-radius: 4px; }
+QScrollBar::handle:vertical:hover { background: #686868; }
+QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical { height: 0px; }
+QMenuBar { background-color: #1E1E1E; border-bottom: 1px solid #333333; }
+QMenuBar::item:selected { background-color: #333337; }
+QMenu { background-color: #1E1E1E; border: 1px solid #333333; }
+QMenu::item:selected { background-color: #007ACC; color: #FFFFFF; }
+QLabel#FormLabel, QCheckBox#FormLabel { font-weight: bold; color: #CCCCCC; }
+"""
+
+# ================= 自定义组件 =================
+class PopoutEditorDialog(QDialog):
+    """独立窗口编辑正文。直接编辑主编辑框的文档，不来回复制字符串，改动即时生效，回到主窗口后仍可撤销。"""
+    def __init__(self, document, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("沉浸式内容编辑器 - 支持自由调整窗口与字体大小")
+        self.resize(800, 600) 
+        self.setWindowFlags(self.windowFlags() | Qt.WindowMaximizeButtonHint | Qt.WindowMinimizeButtonHint)
+        self.document = document
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(15, 15, 15, 15)
+        layout.setSpacing(10)
+
+        toolbar = QHBoxLayout()
+        toolbar.addWidget(QLabel("🔠 字体大小:"))
+        
+        self.font_spinbox = QSpinBox()
+        self.font_spinbox.setRange(8, 72)
+        self.font_spinbox.setValue(16) 
+        self.font_spinbox.valueChanged.connect(self.change_font)
+        toolbar.addWidget(self.font_spinbox)
+        
+        toolbar.addStretch()
+        self.count_label = QLabel()
+        toolbar.addWidget(self.count_label)
+
+        self.btn_apply = QPushButton("✔️ 确认并返回")
+        self.btn_apply.clicked.connect(self.accept)
+        toolbar.addWidget(self.btn_apply)
+
+        layout.addLayout(toolbar)
+
+        self.text_edit = QPlainTextEdit()
+        self.text_edit.setDocument(document)
+        self.change_font(self.font_spinbox.value())
+        layout.addWidget(self.text_edit)
+
+        # 行数、字数直接取文档已经维护好的计数，不用把全文转成字符串
+        document.contentsChanged.connect(self.update_counts)
+        self.update_counts()
+
+    def change_font(self, size):
+        # 字号写在文档的默认字体上，放大缩小时只重新排版，不用重新套用样式表
+        font = QFont(self.document.defaultFont())
+        font.setPointSize(size)
+        self.document.setDefaultFont(font)
+
+    def update_counts(self):
+        self.count_label.setText(f"{self.document.blockCount()} 行 · {self.document.characterCount() - 1} 字")
+
+    def showEvent(self, event):
+        # 编辑框套用样式表时会把文档字体重置成全局字号，显示之后再设一次
+        super().showEvent(event)
+        self.change_font(self.font_spinbox.value())
+
+    def done(self, result):
+        self.document.contentsChanged.disconnect(self.update_counts)
+        super().done(result)
+
+# ================= 后台任务 (读取、检索、保存、简繁转换、批量替换、建递归触发图等分析都在线程池里执行) =================
+class SearchSignals(QObject):
+    chunkReady = Signal(int, list, list)           # generation, 命中的 key, 未命中的 key
+    finished = Signal(int, str, list, int)         # generation, query, 全部命中的 key, 索引 revision
+
+class SearchTask(QRunnable):
+    """在线程池里扫描候选条目，每扫完一块就把结果发回界面；被 cancel() 后尽快退出。"""
+    CHUNK_SIZE = 1000
+
+    def __init__(self, generation, query, candidates, revision):
+        super().__init__()
+        self.generation = generation
+        self.query = query
+        self.candidates = candidates
+        self.revision = revision
+        self.cancelled = False
+        self.signals = SearchSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        self.query.prefilter()
+        match, hits = self.query.matches, set()
+        for start in range(0, len(self.candidates), self.CHUNK_SIZE):
+            if self.cancelled: return
+            matched, missed = [], []
+            for key, haystack in self.candidates[start:start + self.CHUNK_SIZE]:
+                (matched if match(key, haystack) else missed).append(key)
+            hits.update(matched)
+            self.signals.chunkReady.emit(self.generation, matched, missed)
+        if not self.cancelled:
+            self.signals.finished.emit(self.generation, self.query.plain or "", list(hits), self.revision)
+
+class LoadSignals(QObject):
+    batchReady = Signal(int, list)          # generation, [(key, entry)...]
+    progress = Signal(int, int, int)        # generation, 已读字节, 总字节
+    finished = Signal(int, dict, list)      # generation, 顶层其他字段, 顶层字段顺序
+    failed = Signal(int, str)
+
+class LoadTask(QRunnable):
+    """在线程池里备份并流式解析世界书文件，按批把条目发回界面。"""
+    BATCH_SIZE = 500
+
+    def __init__(self, generation, file_path):
+        super().__init__()
+        self.generation = generation
+        self.file_path = file_path
+        self.cancelled = False
+        self.signals = LoadSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            backup_path = self.file_path + f".backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            shutil.copy2(self.file_path, backup_path)
+
+            # 大文件的正文不常驻内存，改为从刚生成的备份副本里按需读取
+            store = ContentStore(backup_path) if os.path.getsize(self.file_path) >= LAZY_CONTENT_MIN_BYTES else None
+            reader = LorebookStreamReader(self.file_path, content_store=store)
+            batch = []
+            for item in reader.entries():
+                if self.cancelled: return
+                batch.append(item)
+                if len(batch) >= self.BATCH_SIZE:
+                    self.signals.batchReady.emit(self.generation, batch)
+                    self.signals.progress.emit(self.generation, reader.bytes_read, reader.total_bytes)
+                    batch = []
+            if batch:
+                self.signals.batchReady.emit(self.generation, batch)
+            self.signals.finished.emit(self.generation, reader.extras, reader.top_level_keys)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+
+class SaveSignals(QObject):
+    finished = Signal(int)
+
+class SaveTask(QRunnable):
+    """在线程池里写出保存快照；结果留在任务对象上，由界面线程取回。"""
+
+    def __init__(self, generation, path, clock, layout):
+        super().__init__()
+        self.generation = generation
+        self.path = path
+        self.clock = clock
+        self.layout = layout
+        self.fragments = {}
+        self.error = None
+        self.done = threading.Event()
+        self.signals = SaveSignals()
+
+    def run(self):
+        try:
+            write_lorebook(self.path, self.layout, self.fragments)
+        except Exception as e:
+            self.error = str(e)
+        self.signals.finished.emit(self.generation)
+        self.done.set()
+
+class ConvertSignals(QObject):
+    progress = Signal(int, int, int)
+    finished = Signal(int, list)
+    failed = Signal(int, str)
+
+class ConvertTask(QRunnable):
+    """在线程池里执行 convert_entries()，逐块汇报进度，可随时取消。"""
+
+    def __init__(self, generation, items, target_lang):
+        super().__init__()
+        self.generation = generation
+        self.items = items  # 界面线程取的快照 [(条目ID, {字段: 值})]，正文可能尚未读入
+        self.target_lang = target_lang
+        self.cancelled = False
+        self.signals = ConvertSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            results = convert_entries(self.items, self.target_lang,
+                                      progress=lambda done, total: self.signals.progress.emit(self.generation, done, total),
+                                      cancelled=lambda: self.cancelled)
+            if results is not None:
+                self.signals.finished.emit(self.generation, results)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+
+class ReplaceSignals(QObject):
+    finished = Signal(int, list)
+    failed = Signal(int, str)
+
+class ReplaceTask(QRunnable):
+    """在线程池里对字段快照执行批量查找 (预览时只统计匹配数) 或替换，结果交回界面线程统一写回。"""
+
+    def __init__(self, generation, items, pattern, replacement=None, regex=False):
+        super().__init__()
+        self.generation = generation
+        self.items = items
+        self.pattern = pattern
+        self.replacement = replacement  # 为 None 时只统计匹配数
+        self.regex = regex
+        self.cancelled = False
+        self.signals = ReplaceSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            if self.replacement is None:
+                results = count_matches(self.items, self.pattern, cancelled=lambda: self.cancelled)
+            else:
+                results = replace_matches(self.items, self.pattern, self.replacement, self.regex,
+                                          cancelled=lambda: self.cancelled)
+            if results is not None:
+                self.signals.finished.emit(self.generation, results)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+
+class BuildSignals(QObject):
+    progress = Signal(int, int, int)
+    finished = Signal(int, object)  # generation, 建好的对象
+    failed = Signal(int, str)
+
+class BuildTask(QRunnable):
+    """在线程池里用 factory() 新建对象，载入条目快照后调用它的 build()，建好后整个交给界面线程接管。"""
+
+    def __init__(self, generation, factory, snapshot):
+        super().__init__()
+        self.generation = generation
+        self.factory = factory
+        self.snapshot = snapshot  # *_snapshot() 复制出的字段，与界面线程里的条目互不影响
+        self.cancelled = False
+        self.signals = BuildSignals()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            result = self.factory()
+            result.rebuild(self.snapshot)
+            if result.build(progress=lambda done, total: self.signals.progress.emit(self.generation, done, total),
+                            cancelled=lambda: self.cancelled):
+                self.signals.finished.emit(self.generation, result)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+
+class BackgroundBuild(QObject):
+    """在后台建立、之后随条目改动增量维护的对象 (递归触发图、Token 预算、重复签名)。
+    result 是建好的对象 (带 update/remove)；后台建立期间改过的条目先记下来，建好后补上；discard() 后旧任务的结果一律丢弃。"""
+    progress = Signal(int, int)
+    built = Signal()
+    failed = Signal(str)
+
+    def __init__(self, entries, parent=None):
+        super().__init__(parent)
+        self.entries = entries  # 返回当前条目字典的函数 (换文件时字典会整个替换)
+        self.result = None
+        self._task = None
+        self._generation = 0
+        self._pending = {}  # 改过的条目 -> 改动的字段 (None 表示整条)
+
+    def is_building(self):
+        return self._task is not None
+
+    def start(self, factory, snapshot):
+        if self._task is not None: return
+        self._generation += 1
+        self._pending = {}
+        task = BuildTask(self._generation, factory, snapshot)
+        task.signals.progress.connect(self.on_progress)
+        task.signals.finished.connect(self.on_finished)
+        task.signals.failed.connect(self.on_failed)
+        self._task = task
+        QThreadPool.globalInstance().start(task)
+
+    def discard(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._generation += 1
+        self.result = None
+
+    def entry_changed(self, key, fields):
+        if self._task is not None:
+            # 后台用的是改动前的快照，记下来建好后补上
+            old = self._pending.get(key, set())
+            self._pending[key] = None if fields is None or old is None else old | fields
+        elif self.result is not None:
+            entry = self.entries().get(key)
+            if entry is None: self.result.remove(key)
+            else: self.result.update(key, entry, fields)
+
+    def on_progress(self, generation, done, total):
+        if generation == self._generation: self.progress.emit(done, total)
+
+    def on_failed(self, generation, message):
+        if generation != self._generation: return
+        self._task = None
+        self.failed.emit(message)
+
+    def on_finished(self, generation, result):
+        if generation != self._generation: return
+        self._task = None
+        self.result = result
+        pending, self._pending = self._pending, {}
+        for key, fields in pending.items():
+            self.entry_changed(key, fields)
+        self.built.emit()
+
+# ================= 条目列表模型 (直接绑定 entries 字典，按需计算显示文本) =================
+class EntryListModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._entries = {}
+        self.order = EntryOrder()  # 列表的顺序就是保存时条目的顺序
+
+    def set_entries(self, entries):
+        self.beginResetModel()
+        self._entries = entries
+        self.order.reset(entries.keys())
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.order)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid(): return None
+        key = self.order[index.row()]
+        if role == Qt.DisplayRole:
+            return f"[{index.row() + 1}] {entry_display_name(key, self._entries.get(key, {}))}"
+        if role == Qt.UserRole:
+            return key
+        return None
+
+    def flags(self, index):
+        if not index.isValid(): return Qt.ItemIsDropEnabled
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsDragEnabled
+
+    def supportedDropActions(self):
+        return Qt.MoveAction
+
+    def keys(self):
+        return list(self.order)
+
+    def key_at(self, row):
+        return self.order[row]
+
+    def row_of(self, key):
+        return self.order.index(key)
+
+    def refresh_key(self, key):
+        row = self.row_of(key)
+        if row >= 0:
+            idx = self.index(row)
+            self.dataChanged.emit(idx, idx, [Qt.DisplayRole])
+
+    def _refresh_rows(self, first, last):
+        # 序号 [i] 随位置变化，只通知受影响的区间，视图只会重绘其中可见的部分
+        last = min(last, len(self.order) - 1)
+        if first <= last:
+            self.dataChanged.emit(self.index(first), self.index(last), [Qt.DisplayRole])
+
+    def append_keys(self, keys):
+        if not keys: return
+        first = len(self.order)
+        self.beginInsertRows(QModelIndex(), first, first + len(keys) - 1)
+        self.order.extend(keys)
+        self.endInsertRows()
+
+    def insert_key(self, row, key):
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.order.insert(row, key)
+        self.endInsertRows()
+        self._refresh_rows(row + 1, len(self.order) - 1)
+
+    def remove_keys(self, keys):
+        rows = sorted((row for row in map(self.row_of, keys) if row >= 0), reverse=True)
+        if not rows: return
+        # 从后往前按连续区间删除，每段只发一次 rowsRemoved
+        i = 0
+        while i < len(rows):
+            last = first = rows[i]
+            while i + 1 < len(rows) and rows[i + 1] == first - 1:
+                i += 1
+                first = rows[i]
+            self.beginRemoveRows(QModelIndex(), first, last)
+            for row in range(last, first - 1, -1): self.order.pop(row)
+            self.endRemoveRows()
+            i += 1
+        self._refresh_rows(rows[-1], len(self.order) - 1)
+
+    def move_keys(self, keys, before_key=None):
+        """把 keys 按给定顺序连续地移动到 before_key 之前 (为 None 时移到末尾)。
+        返回实际发生的每一步 (key, 原行号, 新行号)，按顺序逐步执行即可复现这次移动。"""
+        steps = []
+        for key in keys:
+            src = self.row_of(key)
+            dst = self.row_of(before_key) if before_key is not None else len(self.order)
+            if src < 0 or src == dst - 1: continue
+            dst = dst - 1 if src < dst else dst
+            self.move_row(src, dst, refresh=False)
+            steps.append((key, src, dst))
+        if steps:
+            rows = [row for _, src, dst in steps for row in (src, dst)]
+            self._refresh_rows(min(rows), max(rows))
+        return steps
+
+    def move_row(self, src, dst, refresh=True):
+        # 把第 src 行挪到第 dst 行 (dst 为移动完成后的行号)
+        if src == dst: return
+        self.beginMoveRows(QModelIndex(), src, src, QModelIndex(), dst + 1 if src < dst else dst)
+        self.order.move(src, dst)
+        self.endMoveRows()
+        if refresh: self._refresh_rows(min(src, dst), max(src, dst))
+
+class DragListView(QListView):
+    rowsDropped = Signal(list, int)
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setObjectName("EntryList")
+        self.setUniformItemSizes(True)
+        self.setDragDropMode(QAbstractItemView.InternalMove)
+        self.setDefaultDropAction(Qt.MoveAction)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
+
+    def selected_rows(self):
+        return sorted(idx.row() for idx in self.selectionModel().selectedRows())
+
+    def startDrag(self, supportedActions):
+        # 移动由模型在 dropEvent 中完成，不走 QAbstractItemView 默认的“拖走即删除源行”
+        indexes = self.selectionModel().selectedRows()
+        if not indexes: return
+        drag = QDrag(self)
+        drag.setMimeData(self.model().mimeData(indexes))
+        drag.exec(Qt.MoveAction)
+
+    def dropEvent(self, event):
+        if event.source() is not self:
+            event.ignore()
+            return
+        index = self.indexAt(event.position().toPoint())
+        indicator = self.dropIndicatorPosition()
+        if not index.isValid() or indicator == QAbstractItemView.OnViewport:
+            target = self.model().rowCount()
+        elif indicator == QAbstractItemView.BelowItem:
+            target = index.row() + 1
+        else:
+            target = index.row()
+        event.setDropAction(Qt.MoveAction)
+        event.accept()
+        self.rowsDropped.emit(self.selected_rows(), target)
+
+class ContentHighlighter(QSyntaxHighlighter):
+    """正文高亮：ST 宏 ({{char}}、{{user}} 等) 和查找词。
+    只给可见的段落上色：载入正文时整篇跳过，由编辑框在显示、滚动或更换查找词后补上可见范围里还没按当前规则高亮的段落；
+    打字时 Qt 只重新高亮改动的段落。段落状态固定为 0，这样补高亮一个段落时 Qt 不会顺带把后面的段落全部重做一遍。"""
+    MACRO_RE = re.compile(r"\{\{[^{}\n]*\}\}")
+    ASTRAL_RE = re.compile("[\U00010000-\U0010FFFF]")  # Qt 的位置按 UTF-16 计数，这些字符各占两个单位
+    MAX_MATCHES_PER_BLOCK = 500  # 单个段落里最多标出的查找结果，超长段落不会堆出成千上万个格式区间
+
+    def __init__(self, document):
+        super().__init__(document)
+        self.pattern = None
+        self.suspended = False
+        self.highlighted = set()  # 已按当前规则高亮过的段落号
+        self._block_count = document.blockCount()
+        document.contentsChange.connect(self._on_contents_change)
+        self.macro_format = QTextCharFormat()
+        self.macro_format.setForeground(QColor("#B267E6"))
+        self.macro_format.setFontWeight(QFont.Bold)
+        self.match_format = QTextCharFormat()
+        self.match_format.setBackground(QColor("#FF7676"))
+        self.match_format.setForeground(QColor("#FFFFFF"))
+
+    def set_find_text(self, text):
+        # 与 QTextDocument.find 的默认行为一致：按纯文本、不区分大小写匹配
+        self.pattern = re.compile(re.escape(text), re.IGNORECASE) if text else None
+        self.highlighted.clear()
+
+    def _on_contents_change(self, position, removed, added):
+        # 增删了段落时后面的段落号整体移动，已高亮的记录全部作废，之后只补可见的段落
+        count = self.document().blockCount()
+        if count != self._block_count:
+            self._block_count = count
+            self.highlighted.clear()
+
+    def is_stale(self, block):
+        return block.blockNumber() not in self.highlighted
+
+    def highlightBlock(self, text):
+        self.setCurrentBlockState(0)
+        number = self.currentBlock().blockNumber()
+        if self.suspended:
+            self.highlighted.discard(number)
+            return
+        self.highlighted.add(number)
+        astral = None if text.isascii() else [m.start() for m in self.ASTRAL_RE.finditer(text)]
+        pos = (lambda i: i + bisect.bisect_left(astral, i)) if astral else (lambda i: i)
+        for m in self.MACRO_RE.finditer(text):
+            self.setFormat(pos(m.start()), pos(m.end()) - pos(m.start()), self.macro_format)
+        if self.pattern is None: return
+        for n, m in enumerate(self.pattern.finditer(text)):
+            if n >= self.MAX_MATCHES_PER_BLOCK: break
+            self.setFormat(pos(m.start()), pos(m.end()) - pos(m.start()), self.match_format)
+
+class ContentEditorWidget(QWidget):
+    textChanged = Signal()
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(10)
+
+        tools_layout = QHBoxLayout()
+        self.find_input = QLineEdit()
+        self.find_input.setPlaceholderText("🔍 查找内容...")
+        
+        self.btn_find = QPushButton("查找下一个")
+        self.btn_find.setObjectName("SecondaryBtn")
+        
+        self.replace_input = QLineEdit()
+        self.replace_input.setPlaceholderText("📝 替换为...")
+        
+        self.btn_replace = QPushButton("替换")
+        self.btn_replace.setObjectName("SecondaryBtn")
+        
+        self.btn_replace_all = QPushButton("全部替换")
+        self.btn_replace_all.setObjectName("SecondaryBtn")
+
+        self.btn_popout = QPushButton("🗔 独立窗口编辑")
+        self.btn_popout.setObjectName("SecondaryBtn")
+
+        tools_layout.addWidget(self.find_input)
+        tools_layout.addWidget(self.btn_find)
+        tools_layout.addWidget(self.replace_input)
+        tools_layout.addWidget(self.btn_replace)
+        tools_layout.addWidget(self.btn_replace_all)
+        tools_layout.addWidget(self.btn_popout)
+
+        self.text_edit = QPlainTextEdit()
+        self.text_edit.setMinimumHeight(150)
+        # 文档归本控件所有，独立窗口编辑时把它挂到弹窗的编辑框上，关掉弹窗再挂回来
+        self.document = QTextDocument(self)
+        self.document.setDocumentLayout(QPlainTextDocumentLayout(self.document))
+        self.text_edit.setDocument(self.document)
+        self.view = self.text_edit  # 当前显示文档的编辑框，高亮只补它可见的段落
+        
+        layout.addLayout(tools_layout)
+        layout.addWidget(self.text_edit)
+
+        self.btn_find.clicked.connect(self.find_next)
+        self.btn_replace.clicked.connect(self.replace_current)
+        self.btn_replace_all.clicked.connect(self.replace_all)
+        self.btn_popout.clicked.connect(self.open_popout) 
+        self.find_input.textChanged.connect(self.highlight_all) 
+        self.text_edit.textChanged.connect(self.on_text_changed)
+
+        self.highlighter = ContentHighlighter(self.document)
+        self._highlighting = False
+        # 滚动、改变大小后补上新露出来的段落；合并到下一轮事件循环里做一次
+        self.highlight_timer = QTimer(self)
+        self.highlight_timer.setSingleShot(True)
+        self.highlight_timer.setInterval(0)
+        self.highlight_timer.timeout.connect(self.highlight_visible)
+        self.text_edit.updateRequest.connect(lambda *_: self.highlight_timer.start())
+
+    def on_text_changed(self):
+        # 重新高亮段落也会让文档发出改动信号，这种情况不算用户修改
+        if not self._highlighting: self.textChanged.emit()
+
+    def open_popout(self):
+        # 同一个文档同时挂在两个编辑框上时，两边宽度不同会让排版来回重算，所以先换上一个空文档
+        cursor = self.text_edit.textCursor()
+        placeholder = QTextDocument(self)
+        placeholder.setDocumentLayout(QPlainTextDocumentLayout(placeholder))
+        self.text_edit.blockSignals(True)  # 换文档时编辑框会发出 textChanged，不算用户修改
+        self.text_edit.setDocument(placeholder)
+        self.text_edit.blockSignals(False)
+        dialog = PopoutEditorDialog(self.document, self)
+        dialog.text_edit.setTextCursor(cursor)
+        dialog.text_edit.updateRequest.connect(lambda *_: self.highlight_timer.start())
+        dialog.text_edit.textChanged.connect(self.on_text_changed)
+        self.view = dialog.text_edit
+        try:
+            dialog.exec()
+            cursor = dialog.text_edit.textCursor()
+        finally:
+            dialog.text_edit.blockSignals(True)
+            dialog.text_edit.setDocument(placeholder)
+            self.view = self.text_edit
+            self.document.setDefaultFont(self.text_edit.font())
+            self.text_edit.blockSignals(True)
+            self.text_edit.setDocument(self.document)
+            self.text_edit.blockSignals(False)
+            dialog.deleteLater()
+            placeholder.deleteLater()
+        self.text_edit.setTextCursor(cursor)
+        self.text_edit.ensureCursorVisible()
+
+    def highlight_all(self):
+        self.highlighter.set_find_text(self.find_input.text())
+        self.highlight_visible()
+
+    def highlight_visible(self):
+        editor = self.view
+        block, offset, bottom = editor.firstVisibleBlock(), editor.contentOffset(), editor.viewport().height()
+        self._highlighting = True
+        try:
+            while block.isValid() and editor.blockBoundingGeometry(block).translated(offset).top() <= bottom:
+                if self.highlighter.is_stale(block): self.highlighter.rehighlightBlock(block)
+                block = block.next()
+        finally:
+            self._highlighting = False
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.highlight_timer.start()
+
+    def find_next(self):
+        search_text = self.find_input.text()
+        if not search_text: return
+        found = self.text_edit.find(search_text)
+        if not found:
+            self.text_edit.moveCursor(QTextCursor.Start)
+            self.text_edit.find(search_text)
+
+    def replace_current(self):
+        cursor = self.text_edit.textCursor()
+        if cursor.hasSelection() and cursor.selectedText() == self.find_input.text():
+            fmt = QTextCharFormat()
+            fmt.setBackground(QColor("#007ACC")) 
+            fmt.setForeground(QColor("#FFFFFF"))
+            cursor.insertText(self.replace_input.text(), fmt)
+            self.highlight_all() 
+            self.find_next()
+
+    def replace_all(self):
+        search_text = self.find_input.text()
+        replace_text = self.replace_input.text()
+        if not search_text: return
+        
+        cursor = QTextCursor(self.text_edit.document())
+        cursor.beginEditBlock()
+        count = 0
+        fmt = QTextCharFormat()
+        fmt.setBackground(QColor("#007ACC"))
+        fmt.setForeground(QColor("#FFFFFF"))
+        
+        while not cursor.isNull() and not cursor.atEnd():
+            cursor = self.text_edit.document().find(search_text, cursor)
+            if not cursor.isNull():
+                cursor.insertText(replace_text, fmt)
+                count += 1
+        cursor.endEditBlock()
+        self.highlight_all()
+        QMessageBox.information(self, "替换完毕", f"共替换了 {count} 处内容。")
+
+    def toPlainText(self): return self.text_edit.toPlainText()
+    def setText(self, t):
+        # 按纯文本载入，正文里的 <标签> 不会被当成 HTML；载入时不逐段高亮，只补上可见的段落
+        self.highlighter.suspended = True
+        try: self.text_edit.setPlainText(t)
+        finally: self.highlighter.suspended = False
+        self.highlight_timer.start()
+    def clear(self): self.text_edit.clear()
+
+class ConvertDialog(QDialog):
+    def __init__(self, mode_name, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"选择要转换为 {mode_name} 的字段")
+        self.setMinimumWidth(300)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(15)
+        layout.setContentsMargins(20, 20, 20, 20)
+        
+        self.chk_title = QCheckBox("条目标题/备忘录 (Comment)")
+        self.chk_keys = QCheckBox("主要关键字和可选过滤器 (Keys & Filters)")
+        self.chk_content = QCheckBox("条目内容 (Content)")
+        
+        self.chk_title.setChecked(True)
+        self.chk_keys.setChecked(True)
+        self.chk_content.setChecked(True)
+        
+        layout.addWidget(self.chk_title)
+        layout.addWidget(self.chk_keys)
+        layout.addWidget(self.chk_content)
+        
+        btn_layout = QHBoxLayout()
+        btn_ok = QPushButton("确定")
+        btn_cancel = QPushButton("取消")
+        btn_cancel.setObjectName("SecondaryBtn")
+        btn_ok.clicked.connect(self.accept)
+        btn_cancel.clicked.connect(self.reject)
+        btn_layout.addWidget(btn_ok)
+        btn_layout.addWidget(btn_cancel)
+        layout.addLayout(btn_layout)
+
+    def get_selection(self):
+        return self.chk_title.isChecked(), self.chk_keys.isChecked(), self.chk_content.isChecked()
+
+class BulkReplaceDialog(QDialog):
+    """跨条目批量查找替换。对话框只负责收集选项和显示预览，查找替换由主窗口交给后台任务执行。"""
+    FIELD_LABELS = {"comment": "标题", "key": "主要关键字", "keysecondary": "可选过滤器", "content": "内容"}
+    preview_requested = Signal()
+    replace_requested = Signal()
+    entry_activated = Signal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("批量查找替换")
+        self.resize(640, 520)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(10)
+        layout.setContentsMargins(20, 20, 20, 20)
+
+        form = QFormLayout()
+        self.find_input = QLineEdit()
+        self.find_input.setPlaceholderText("要查找的文本")
+        self.replace_input = QLineEdit()
+        self.replace_input.setPlaceholderText("替换为 (正则模式下可用 \\1 引用分组)")
+        form.addRow("查找:", self.find_input)
+        form.addRow("替换为:", self.replace_input)
+        layout.addLayout(form)
+
+        option_layout = QHBoxLayout()
+        self.chk_regex = QCheckBox("正则表达式")
+        self.chk_case = QCheckBox("区分大小写")
+        self.chk_selected = QCheckBox("仅限选中的条目")
+        for chk in (self.chk_regex, self.chk_case, self.chk_selected): option_layout.addWidget(chk)
+        option_layout.addStretch()
+        layout.addLayout(option_layout)
+
+        field_layout = QHBoxLayout()
+        field_layout.addWidget(QLabel("查找范围:"))
+        self.field_checks = {}
+        for field in REPLACE_FIELDS:
+            chk = QCheckBox(self.FIELD_LABELS[field])
+            chk.setChecked(True)
+            self.field_checks[field] = chk
+            field_layout.addWidget(chk)
+        field_layout.addStretch()
+        layout.addLayout(field_layout)
+
+        # 预览：每个条目一行，列出各字段的匹配数，双击跳到该条目
+        self.preview = QTreeWidget()
+        self.preview.setRootIsDecorated(False)
+        self.preview.setHeaderLabels(["条目"] + [self.FIELD_LABELS[f] for f in REPLACE_FIELDS])
+        self.preview.setColumnWidth(0, 240)
+        self.preview.itemDoubleClicked.connect(lambda item, _: self.entry_activated.emit(item.data(0, Qt.UserRole)))
+        layout.addWidget(self.preview)
+        self.summary = QLabel("")
+        layout.addWidget(self.summary)
+
+        btn_layout = QHBoxLayout()
+        self.btn_preview = QPushButton("预览")
+        self.btn_replace = QPushButton("全部替换")
+        btn_close = QPushButton("关闭")
+        btn_close.setObjectName("SecondaryBtn")
+        self.btn_preview.clicked.connect(self.preview_requested)
+        self.btn_replace.clicked.connect(self.replace_requested)
+        btn_close.clicked.connect(self.close)
+        btn_layout.addWidget(self.btn_preview)
+        btn_layout.addWidget(self.btn_replace)
+        btn_layout.addWidget(btn_close)
+        layout.addLayout(btn_layout)
+
+        # 选项一改，之前的预览就不再对应，直接清掉
+        self.find_input.textChanged.connect(self.clear_preview)
+        for chk in (self.chk_regex, self.chk_case, self.chk_selected, *self.field_checks.values()):
+            chk.toggled.connect(self.clear_preview)
+
+    def options(self):
+        fields = [f for f, chk in self.field_checks.items() if chk.isChecked()]
+        return (self.find_input.text(), self.replace_input.text(), self.chk_regex.isChecked(),
+                self.chk_case.isChecked(), fields, self.chk_selected.isChecked())
+
+    def set_busy(self, busy):
+        self.btn_preview.setEnabled(not busy)
+        self.btn_replace.setEnabled(not busy)
+        if busy: self.summary.setText("正在查找...")
+
+    def clear_preview(self):
+        self.preview.clear()
+        self.summary.setText("")
+
+    def show_preview(self, rows):
+        # rows: [(条目ID, 显示名称, {字段: 匹配数})]
+        self.preview.clear()
+        items = []
+        total = 0
+        for key, name, counts in rows:
+            item = QTreeWidgetItem([name] + [""] * len(REPLACE_FIELDS))
+            item.setData(0, Qt.UserRole, key)
+            for col, field in enumerate(REPLACE_FIELDS, 1):
+                if field in counts: item.setData(col, Qt.DisplayRole, counts[field])
+            items.append(item)
+            total += sum(counts.values())
+        self.preview.addTopLevelItems(items)
+        self.summary.setText(f"共 {len(rows)} 个条目、{total} 处匹配" if rows else "没有找到匹配")
+
+class ActivationSimulatorDialog(QDialog):
+    """触发模拟：粘贴一段聊天文本，列出会被触发的条目。停止输入片刻后自动重新模拟，双击结果跳到该条目。"""
+    REASON_LABELS = {"constant": "常驻", "keyword": "关键字", "probability": "未通过概率抽签"}
+    simulate_requested = Signal()
+    options_changed = Signal()
+    entry_activated = Signal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("触发模拟")
+        self.resize(720, 640)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(10)
+        layout.setContentsMargins(20, 20, 20, 20)
+
+        self.chat_input = QPlainTextEdit()
+        self.chat_input.setPlaceholderText("在这里粘贴聊天记录，会按 SillyTavern 的规则匹配各条目的关键字...")
+        layout.addWidget(self.chat_input, 2)
+
+        option_layout = QHBoxLayout()
+        self.chk_case = QCheckBox("默认区分大小写")
+        self.chk_whole = QCheckBox("默认匹配整个单词")
+        self.chk_roll = QCheckBox("按触发概率抽签")
+        self.chk_case.setToolTip("条目的“区分大小写”为空 (使用全局设置) 时采用这里的设置")
+        self.chk_whole.setToolTip("条目的“匹配整个单词”为空 (使用全局设置) 时采用这里的设置")
+        for chk in (self.chk_case, self.chk_whole, self.chk_roll): option_layout.addWidget(chk)
+        option_layout.addStretch()
+        btn_run = QPushButton("重新模拟")
+        btn_run.setObjectName("SecondaryBtn")
+        btn_run.clicked.connect(self.simulate_requested)
+        option_layout.addWidget(btn_run)
+        layout.addLayout(option_layout)
+
+        self.results = QTreeWidget()
+        self.results.setRootIsDecorated(False)
+        self.results.setHeaderLabels(["条目", "触发方式", "命中的关键字", "概率"])
+        self.results.setColumnWidth(0, 260)
+        self.results.setColumnWidth(1, 110)
+        self.results.setColumnWidth(2, 200)
+        self.results.itemDoubleClicked.connect(lambda item, _: self.entry_activated.emit(item.data(0, Qt.UserRole)))
+        layout.addWidget(self.results, 3)
+        self.summary = QLabel("")
+        layout.addWidget(self.summary)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(200)
+        self.timer.timeout.connect(self.simulate_requested)
+        self.chat_input.textChanged.connect(self.timer.start)
+        self.chk_roll.toggled.connect(self.timer.start)
+        self.chk_case.toggled.connect(self.options_changed)
+        self.chk_whole.toggled.connect(self.options_changed)
+
+    def show_results(self, rows, elapsed_ms):
+        # rows: [(条目ID, 显示名称, 触发方式, 命中的关键字, 是否向量化, 触发概率或 None)]，已按列表顺序排好
+        self.results.clear()
+        items = []
+        for key, name, reason, keywords, vectorized, probability in rows:
+            label = self.REASON_LABELS[reason] + (" · 向量化" if vectorized else "")
+            item = QTreeWidgetItem([name, label, ", ".join(keywords), "" if probability is None else f"{probability}%"])
+            item.setData(0, Qt.UserRole, key)
+            items.append(item)
+        self.results.addTopLevelItems(items)
+        fired = sum(1 for row in rows if row[2] != "probability")
+        constant = sum(1 for row in rows if row[2] == "constant")
+        self.summary.setText(f"触发 {fired} 个条目 (其中常驻 {constant} 个) · 用时 {elapsed_ms:.1f} ms")
+
+class EntryReportDialog(QDialog):
+    """分析结果窗口的公共部分：树形控件里的条目把 ID 存在第 0 列，双击跳过去；后台计算时显示 self.progress 进度条。"""
+    entry_activated = Signal(str)
+
+    def on_item_double_clicked(self, item, column):
+        key = item.data(0, Qt.UserRole)
+        if key is not None: self.entry_activated.emit(key)
+
+    def set_progress(self, done, total):
+        self.progress.setVisible(done < total)
+        self.progress.setMaximum(max(total, 1))
+        self.progress.setValue(done)
+
+class ActivationGraphDialog(EntryReportDialog):
+    """递归关系分析：列出互相触发形成循环的条目组，以及通过递归能牵连最多条目的热点。双击条目跳过去。"""
+    refresh_requested = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("递归关系分析")
+        self.resize(760, 680)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(10)
+        layout.setContentsMargins(20, 20, 20, 20)
+
+        top_layout = QHBoxLayout()
+        self.summary = QLabel("")
+        self.summary.setWordWrap(True)
+        top_layout.addWidget(self.summary, 1)
+        self.progress = QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.progress.setFormat("正在扫描正文 %p%")
+        self.progress.hide()
+        top_layout.addWidget(self.progress)
+        btn_refresh = QPushButton("重新分析")
+        btn_refresh.setObjectName("SecondaryBtn")
+        btn_refresh.clicked.connect(self.refresh_requested)
+        top_layout.addWidget(btn_refresh)
+        layout.addLayout(top_layout)
+
+        layout.addWidget(QLabel("牵连最广的条目 (展开查看它的正文直接触发的条目)："))
+        self.hotspots = QTreeWidget()
+        self.hotspots.setHeaderLabels(["条目", "直接触发", "共可触发", "被触发", "递归设置"])
+        self.hotspots.setColumnWidth(0, 260)
+        layout.addWidget(self.hotspots, 3)
+
+        layout.addWidget(QLabel("循环 (组内条目可以互相递归触发)："))
+        self.cycles = QTreeWidget()
+        self.cycles.setHeaderLabels(["条目", "递归设置"])
+        self.cycles.setColumnWidth(0, 360)
+        layout.addWidget(self.cycles, 2)
+
+        for tree in (self.hotspots, self.cycles):
+            tree.itemDoubleClicked.connect(self.on_item_double_clicked)
+
+        # 条目改动后稍等片刻再刷新报告，连续修改只刷新一次
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.refresh_requested)
+
+    @staticmethod
+    def entry_item(key, name, *columns):
+        item = QTreeWidgetItem([name, *columns])
+        item.setData(0, Qt.UserRole, key)
+        return item
+
+    def show_report(self, summary, hotspots, cycles):
+        # hotspots: [(条目ID, 名称, 直接触发数, 共可触发数, 被触发数, 递归设置, [(目标ID, 名称)])]
+        # cycles: [[(条目ID, 名称, 递归设置)]]
+        self.progress.hide()
+        self.summary.setText(summary)
+        self.hotspots.clear()
+        items = []
+        for key, name, direct, reach, incoming, flags, targets in hotspots:
+            item = self.entry_item(key, name, str(direct), str(reach), str(incoming), flags)
+            item.addChildren([self.entry_item(t, t_name) for t, t_name in targets])
+            if direct > len(targets): item.addChild(QTreeWidgetItem([f"…… 另有 {direct - len(targets)} 个"]))
+            items.append(item)
+        self.hotspots.addTopLevelItems(items)
+        self.cycles.clear()
+        items = []
+        for i, members in enumerate(cycles, 1):
+            item = QTreeWidgetItem([f"循环 {i}：{len(members)} 个条目"])
+            item.addChildren([self.entry_item(key, name, flags) for key, name, flags in members])
+            items.append(item)
+        self.cycles.addTopLevelItems(items)
+        if len(items) == 1: items[0].setExpanded(True)
+
+# ================= Token 预算面板 (右侧面板，按插入位置/分组/常驻汇总，编辑时随之刷新) =================
+BUDGET_TOKENIZERS = (  # (显示名称, 分词器, 需要的可选依赖)；没装依赖的选项不显示
+    ("估算 (无需额外依赖)", "estimate", None),
+    ("字符数", "chars", None),
+    ("tiktoken cl100k_base (GPT-3.5/4)", "tiktoken:cl100k_base", "tiktoken"),
+    ("tiktoken o200k_base (GPT-4o)", "tiktoken:o200k_base", "tiktoken"),
+)
+
+class TokenBudgetPanel(QFrame):
+    """Token 预算面板：统计启用条目正文的 token 数，按插入位置、生效方式和分组汇总；常驻条目每次都会插入，用进度条对比预算上限。"""
+    refresh_requested = Signal()
+    tokenizer_changed = Signal(str)
+    limit_changed = Signal(int)
+
+    def __init__(self, tokenizer, limit, parent=None):
+        super().__init__(parent)
+        self.setObjectName("SidePanel")
+        self.setFixedWidth(300)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(15, 15, 15, 15)
+        layout.setSpacing(10)
+
+        layout.addWidget(QLabel("📊 Token 预算"))
+        self.tokenizer_combo = QComboBox()
+        for label, spec, module in BUDGET_TOKENIZERS:
+            if module is None or importlib.util.find_spec(module): self.tokenizer_combo.addItem(label, spec)
+        if importlib.util.find_spec("tokenizers"): self.tokenizer_combo.addItem("本地 tokenizer.json 文件...", "hf:")
+        self.set_tokenizer(tokenizer)
+        self.tokenizer_combo.activated.connect(self.on_tokenizer_activated)
+        layout.addWidget(self.tokenizer_combo)
+
+        limit_layout = QHBoxLayout()
+        limit_layout.addWidget(QLabel("预算上限:"))
+        self.limit = QSpinBox()
+        self.limit.setRange(0, 10000000)
+        self.limit.setSingleStep(256)
+        self.limit.setSpecialValueText("未设置")
+        self.limit.setSuffix(" tokens")
+        self.limit.setValue(limit)
+        self.limit.valueChanged.connect(self.limit_changed)
+        limit_layout.addWidget(self.limit, 1)
+        layout.addLayout(limit_layout)
+
+        self.usage = QProgressBar()
+        self.usage.setToolTip("常驻条目每次都会插入，先占用预算")
+        self.usage.hide()
+        layout.addWidget(self.usage)
+        self.summary = QLabel("")
+        self.summary.setWordWrap(True)
+        layout.addWidget(self.summary)
+        self.current = QLabel("")
+        layout.addWidget(self.current)
+        self.progress = QProgressBar()
+        self.progress.setFormat("正在统计 %p%")
+        self.progress.hide()
+        layout.addWidget(self.progress)
+
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["分类", "条目", "Tokens"])
+        self.tree.setColumnWidth(0, 120)
+        self.tree.setColumnWidth(1, 50)
+        layout.addWidget(self.tree, 1)
+
+        # 条目改动或打字后稍等片刻再刷新，连续修改只刷新一次
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(300)
+        self.timer.timeout.connect(self.refresh_requested)
+
+    def set_tokenizer(self, spec):
+        self.spec = spec
+        index = self.tokenizer_combo.findData(spec)
+        if index < 0:
+            label = f"tokenizer.json: {os.path.basename(spec[3:])}" if spec.startswith("hf:") else spec
+            index = self.tokenizer_combo.findData("hf:")
+            if index < 0: index = self.tokenizer_combo.count()
+            self.tokenizer_combo.insertItem(index, label, spec)
+        self.tokenizer_combo.setCurrentIndex(index)
+
+    def on_tokenizer_activated(self, index):
+        spec = self.tokenizer_combo.itemData(index)
+        if spec == "hf:":
+            path, _ = QFileDialog.getOpenFileName(self, "选择 tokenizer.json", "", "Tokenizer (*.json)")
+            spec = "hf:" + path if path else self.spec
+        changed = spec != self.spec
+        self.set_tokenizer(spec)  # 取消选择文件时恢复原来的选项
+        if changed: self.tokenizer_changed.emit(spec)
+
+    def set_progress(self, done, total):
+        self.progress.setVisible(done < total)
+        self.progress.setMaximum(max(total, 1))
+        self.progress.setValue(done)
+
+    def show_report(self, summary, current, used, sections):
+        # sections: [(标题, [(名称, 条目数, token 数, 提示)])]
+        self.progress.hide()
+        self.summary.setText(summary)
+        self.current.setText(current)
+        limit = self.limit.value()
+        self.usage.setVisible(limit > 0)
+        if limit:
+            self.usage.setMaximum(limit)
+            self.usage.setValue(min(used, limit))
+            self.usage.setFormat(f"常驻 {used:,} / {limit:,}" + (" · 已超出" if used > limit else ""))
+        collapsed = {self.tree.topLevelItem(i).text(0) for i in range(self.tree.topLevelItemCount())
+                     if not self.tree.topLevelItem(i).isExpanded()}
+        self.tree.clear()
+        for title, rows in sections:
+            item = QTreeWidgetItem([title])
+            for name, count, tokens, tip in rows:
+                child = QTreeWidgetItem([name, f"{count:,}", f"{tokens:,}"])
+                for column in (1, 2): child.setTextAlignment(column, Qt.AlignRight | Qt.AlignVCenter)
+                if tip: child.setToolTip(0, tip)
+                item.addChild(child)
+            self.tree.addTopLevelItem(item)
+            item.setExpanded(title not in collapsed)
+
+class DuplicateFinderDialog(EntryReportDialog):
+    """查找近似重复条目：按正文和主要关键字的相似度把条目分组，每组第一条作为基准。
+    选中的条目可以在列表中选中、直接删除，或把关键字并入同组第一条选中的条目后删除；双击条目跳过去。"""
+    find_requested = Signal()
+    options_changed = Signal()
+    select_requested = Signal(list)
+    delete_requested = Signal(list)
+    merge_requested = Signal(list)  # [[保留的条目ID, 并入它的条目ID...]]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("查找近似重复条目")
+        self.resize(680, 600)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(10)
+        layout.setContentsMargins(20, 20, 20, 20)
+
+        option_layout = QHBoxLayout()
+        option_layout.addWidget(QLabel("相似度不低于:"))
+        self.threshold = QSpinBox()
+        self.threshold.setRange(50, 100)
+        self.threshold.setValue(80)
+        self.threshold.setSuffix(" %")
+        option_layout.addWidget(self.threshold)
+        self.chk_fold = QCheckBox("简繁视为相同")
+        self.chk_fold.setChecked(True)
+        option_layout.addWidget(self.chk_fold)
+        option_layout.addStretch()
+        btn_find = QPushButton("查找")
+        btn_find.clicked.connect(self.find_requested)
+        option_layout.addWidget(btn_find)
+        layout.addLayout(option_layout)
+
+        top_layout = QHBoxLayout()
+        self.summary = QLabel("")
+        self.summary.setWordWrap(True)
+        top_layout.addWidget(self.summary, 1)
+        self.progress = QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.progress.setFormat("正在计算签名 %p%")
+        self.progress.hide()
+        top_layout.addWidget(self.progress)
+        layout.addLayout(top_layout)
+
+        self.tree = QTreeWidget()
+        self.tree.setHeaderLabels(["条目", "相似度", "列表位置"])
+        self.tree.setColumnWidth(0, 400)
+        self.tree.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.tree.itemDoubleClicked.connect(self.on_item_double_clicked)
+        layout.addWidget(self.tree)
+
+        btn_layout = QHBoxLayout()
+        btn_extra = QPushButton("选中每组第一条以外的条目")
+        btn_extra.setObjectName("SecondaryBtn")
+        btn_extra.clicked.connect(self.select_extras)
+        btn_select = QPushButton("在列表中选中")
+        btn_select.setObjectName("SecondaryBtn")
+        btn_select.clicked.connect(lambda: self.select_requested.emit(self.selected_keys()))
+        btn_merge = QPushButton("合并")
+        btn_merge.setToolTip("每组选中的条目里保留第一条，把其余条目的关键字和可选过滤器并入它，然后删除其余条目")
+        btn_merge.clicked.connect(lambda: self.merge_requested.emit(self.selected_groups()))
+        btn_delete = QPushButton("删除")
+        btn_delete.clicked.connect(lambda: self.delete_requested.emit(self.selected_keys()))
+        for btn in (btn_extra, btn_select, btn_merge, btn_delete): btn_layout.addWidget(btn)
+        layout.addLayout(btn_layout)
+
+        self.threshold.valueChanged.connect(self.find_requested)
+        self.chk_fold.toggled.connect(self.options_changed)
+        # 条目改动后稍等片刻再重新分组，连续修改只刷新一次
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.find_requested)
+
+    def selected_groups(self):
+        # 选中组标题等于选中整组；每组按显示顺序返回选中的条目
+        groups = []
+        for i in range(self.tree.topLevelItemCount()):
+            group = self.tree.topLevelItem(i)
+            children = [group.child(j) for j in range(group.childCount())]
+            keys = [c.data(0, Qt.UserRole) for c in children if group.isSelected() or c.isSelected()]
+            if keys: groups.append(keys)
+        return groups
+
+    def selected_keys(self):
+        return [key for group in self.selected_groups() for key in group]
+
+    def select_extras(self):
+        self.tree.clearSelection()
+        for i in range(self.tree.topLevelItemCount()):
+            group = self.tree.topLevelItem(i)
+            for j in range(1, group.childCount()): group.child(j).setSelected(True)
+
+    def show_groups(self, summary, groups):
+        # groups: [[(条目ID, 名称, 与第一条的相似度, 行号)]]
+        self.progress.hide()
+        self.summary.setText(summary)
+        self.tree.clear()
+        items = []
+        for i, members in enumerate(groups, 1):
+            item = QTreeWidgetItem([f"第 {i} 组：{len(members)} 个条目", f"≥ {min(m[2] for m in members[1:]):.0%}"])
+            for n, (key, name, similarity, row) in enumerate(members):
+                child = QTreeWidgetItem([name, "基准" if n == 0 else f"{similarity:.0%}", str(row + 1)])
+                child.setData(0, Qt.UserRole, key)
+                item.addChild(child)
+            items.append(item)
+        self.tree.addTopLevelItems(items)
+        for item in items[:50]: item.setExpanded(True)
+
+class KeywordIndexDialog(EntryReportDialog):
+    """关键字索引：输入关键字立即列出以它为主要关键字的条目；下方列出被多个条目共用的关键字，可按各列排序，用来排查触发过多的问题。"""
+    lookup_requested = Signal()
+    refresh_requested = Signal()
+    select_requested = Signal(list)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("关键字索引")
+        self.resize(700, 680)
+        layout = QVBoxLayout(self)
+        layout.setSpacing(10)
+        layout.setContentsMargins(20, 20, 20, 20)
+
+        lookup_layout = QHBoxLayout()
+        self.lookup_input = QLineEdit()
+        self.lookup_input.setPlaceholderText("输入关键字，列出以它为主要关键字的条目")
+        lookup_layout.addWidget(self.lookup_input, 1)
+        btn_select = QPushButton("在列表中选中")
+        btn_select.setObjectName("SecondaryBtn")
+        btn_select.clicked.connect(lambda: self.select_requested.emit(
+            [self.lookup_results.topLevelItem(i).data(0, Qt.UserRole) for i in range(self.lookup_results.topLevelItemCount())]))
+        lookup_layout.addWidget(btn_select)
+        layout.addLayout(lookup_layout)
+        self.lookup_results = QTreeWidget()
+        self.lookup_results.setRootIsDecorated(False)
+        self.lookup_results.setHeaderLabels(["条目", "区分大小写", "列表位置"])
+        self.lookup_results.setColumnWidth(0, 400)
+        layout.addWidget(self.lookup_results, 1)
+
+        report_layout = QHBoxLayout()
+        report_layout.addWidget(QLabel("被多个条目共用的关键字，至少"))
+        self.min_entries = QSpinBox()
+        self.min_entries.setRange(2, 100000)
+        self.min_entries.setSuffix(" 个条目")
+        report_layout.addWidget(self.min_entries)
+        report_layout.addStretch()
+        layout.addLayout(report_layout)
+        self.report = QTreeWidget()
+        self.report.setHeaderLabels(["关键字", "条目数", "其中按子串匹配", "区分大小写"])
+        self.report.setColumnWidth(0, 300)
+        self.report.setSortingEnabled(True)
+        self.report.sortByColumn(1, Qt.DescendingOrder)
+        layout.addWidget(self.report, 2)
+        self.summary = QLabel("")
+        self.summary.setWordWrap(True)
+        layout.addWidget(self.summary)
+
+        for tree in (self.lookup_results, self.report):
+            tree.itemDoubleClicked.connect(self.on_item_double_clicked)
+        self.lookup_input.textChanged.connect(self.lookup_requested)
+        self.min_entries.valueChanged.connect(self.refresh_requested)
+        # 条目改动后稍等片刻再刷新，连续修改只刷新一次
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.lookup_requested)
+        self.timer.timeout.connect(self.refresh_requested)
+
+    def show_lookup(self, rows):
+        # rows: [(条目ID, 名称, 是否区分大小写, 行号)]
+        self.lookup_results.clear()
+        items = []
+        for key, name, case_sensitive, row in rows:
+            item = QTreeWidgetItem([name, "是" if case_sensitive else "", str(row + 1)])
+            item.setData(0, Qt.UserRole, key)
+            items.append(item)
+        self.lookup_results.addTopLevelItems(items)
+
+    def show_report(self, summary, rows):
+        # rows: [(关键词, 是否区分大小写, 按子串匹配的条目数, [(条目ID, 名称)], 条目总数)]
+        self.summary.setText(summary)
+        self.report.setSortingEnabled(False)
+        self.report.clear()
+        items = []
+        for word, case_sensitive, loose, members, count in rows:
+            item = QTreeWidgetItem([word, "", "", "是" if case_sensitive else ""])
+            item.setData(1, Qt.DisplayRole, count)
+            item.setData(2, Qt.DisplayRole, loose)
+            for key, name in members:
+                child = QTreeWidgetItem([name])
+                child.setData(0, Qt.UserRole, key)
+                item.addChild(child)
+            if count > len(members): item.addChild(QTreeWidgetItem([f"…… 另有 {count - len(members)} 个"]))
+            items.append(item)
+        self.report.addTopLevelItems(items)
+        self.report.setSortingEnabled(True)
+
+# ================= 表单字段绑定 (建表单时按控件类型编译好读写闭包，切换条目时直接调用) =================
+POSITION_LABELS = ["角色定义前", "角色定义后", "示例消息前", "示例消息后", "作者注释顶", "作者注释底", "@ D", "锚点 (Outlet)"]  # 下标即 position
+LIST_TEXT_FIELDS = ("key", "keysecondary", "characterFilter")  # 在表单里用逗号分隔显示的列表字段
+TRISTATE_VALUES = (None, True, False)  # 使用全局 / 是 / 否
+STRATEGY_VALUES = (  # 生效策略下拉框的三个选项对应的 constant/vectorized/selective
+    {"constant": False, "vectorized": False, "selective": True},
+    {"constant": True, "vectorized": False, "selective": False},
+    {"constant": False, "vectorized": True, "selective": True},
+)
+
+def compile_field_binding(json_key, widget_type, w):
+    """返回这个字段的 (read, write, clear) 闭包：read() 返回 {字段: 值}；
+    write(entry) 把条目的值填进控件，并返回填好后 read() 会读到的值，供表单比对改动。"""
+    if widget_type in ('text', 'content_editor'):
+        if json_key in LIST_TEXT_FIELDS:
+            parse = lambda text: [k.strip() for k in text.split(',')] if text.strip() else []
+            show = lambda val: ", ".join(val) if isinstance(val, list) else ""
+        else:
+            parse = lambda text: text
+            show = lambda val: str(val) if val is not None else ""
+        get_text = w.text if widget_type == 'text' else w.toPlainText
+        def read(): return {json_key: parse(get_text())}
+        def write(entry):
+            val = entry.get(json_key)
+            if isinstance(val, LazyContent): val = val.load()
+            text = show(val)
+            w.setText(text)
+            # 正文可能很长，直接用填进去的文本作为比对基准，不再从控件里读回
+            return {json_key: parse(text)} if widget_type == 'content_editor' else read()
+        return read, write, w.clear
+    if widget_type in ('bool', 'invert_bool'):
+        invert = widget_type == 'invert_bool'
+        def read(): return {json_key: w.isChecked() != invert}
+        def write(entry):
+            w.setChecked(bool(entry.get(json_key)) != invert)
+            return read()
+        return read, write, lambda: w.setChecked(invert)
+    if widget_type == 'int':
+        def read(): return {json_key: w.value()}
+        def write(entry):
+            val = entry.get(json_key)
+            w.setValue(int(val) if val is not None else 0)
+            return read()
+        return read, write, lambda: w.setValue(0)
+    if widget_type == 'nullable_int':
+        def read():
+            text = w.text().strip()
+            return {json_key: int(text) if text.isdigit() else None}
+        def write(entry):
+            val = entry.get(json_key)
+            w.setText(str(val) if val is not None else "")
+            return read()
+        return read, write, w.clear
+    if widget_type == 'combo':
+        def read(): return {json_key: w.currentIndex()}
+        def write(entry):
+            val = entry.get(json_key)
+            w.setCurrentIndex(int(val) if val is not None else 0)
+            return read()
+        return read, write, lambda: w.setCurrentIndex(0)
+    if widget_type == 'tristate_combo':
+        def read(): return {json_key: TRISTATE_VALUES[max(w.currentIndex(), 0)]}
+        def write(entry):
+            val = entry.get(json_key)
+            w.setCurrentIndex(1 if val is True else 2 if val is False else 0)
+            return read()
+        return read, write, lambda: w.setCurrentIndex(0)
+    if widget_type == 'strategy_combo':
+        def read(): return dict(STRATEGY_VALUES[max(w.currentIndex(), 0)])
+        def write(entry):
+            w.setCurrentIndex(1 if entry.get('constant') else 2 if entry.get('vectorized') else 0)
+            return read()
+        return read, write, lambda: w.setCurrentIndex(0)
+    if widget_type == 'multicheck':
+        def read(): return {json_key: [val for val, cb in w.checkboxes.items() if cb.isChecked()]}
+        def write(entry):
+            val = entry.get(json_key)
+            val_list = val if isinstance(val, list) else []
+            for opt_val, cb in w.checkboxes.items(): cb.setChecked(opt_val in val_list)
+            return read()
+        def clear():
+            for cb in w.checkboxes.values(): cb.setChecked(False)
+        return read, write, clear
+    raise ValueError(f"未知的控件类型: {widget_type}")
+
+# ================= 启动耗时统计 (python main.py --startup-timing) =================
+class StartupTimer:
+    """按阶段记录冷启动耗时，窗口第一次画出来之后把报告输出到 stderr。"""
+
+    def __init__(self, started):
+        self.started = self.last = started
+        self.marks = []
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.marks.append((name, (now - self.last) * 1000, (now - self.started) * 1000))
+        self.last = now
+
+    def report(self):
+        lines = ["启动耗时:"] + [f"  {step:8.1f} ms  累计 {total:8.1f} ms  {name}" for name, step, total in self.marks]
+        print("\n".join(lines), file=sys.stderr)
+
+# ================= 主窗口 =================
+class MainWindow(QMainWindow):
+    GRAPH_HOTSPOT_LIMIT = 200  # 递归关系分析里最多列出的热点条目
+    GRAPH_TARGET_LIMIT = 50    # 每个热点下最多列出的直接触发条目
+    KEYWORD_REPORT_LIMIT = 500  # 关键字索引里最多列出的共用关键字
+    KEYWORD_MEMBER_LIMIT = 100  # 每个共用关键字下最多列出的条目
+
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("SillyTavern 世界书本地编辑器")
+        self.resize(1150, 800)
+
+        self.is_dark_mode = False 
+        self.setStyleSheet(MODERN_BLUE_THEME)
+
+        self.current_file_path = None
+        self.world_info_data = {}
+        self.top_level_extras = {}  # 顶层除 entries 以外的字段，保存时原样写回
+        self.top_level_keys = []    # 顶层字段的原始顺序
+        self._load_task = None
+        self._load_generation = 0
+        self.current_entry_key = None 
+        self.field_map = {} 
+        self._pending_tabs = {}  # 还没构建的标签页 -> (表单布局, 构建函数)，第一次切换过去时才构建
+        self.search_index = EntrySearchIndex()
+        self.save_writer = LorebookWriter()
+        self.journal = ChangeJournal()
+        self.journal.subscribe(self.on_entries_changed)
+        self.undo_stack = UndoStack(self.journal)
+        self.uid_allocator = UidAllocator(self.journal)
+        self._form_values = {}  # 表单载入当前条目时读回的各字段值，保存时只写回与它不同的字段
+        self._edited_fields = set()  # 载入之后用户动过的字段
+        self._filling_form = False  # 程序填表单期间的控件信号不算用户修改
+        self._save_task = None
+        self._save_generation = 0
+        self._convert_task = None
+        self._convert_generation = 0
+        self._replace_dialog = None
+        self._replace_task = None
+        self._replace_generation = 0
+        self.activation_simulator = ActivationSimulator()  # 第一次模拟时才建立关键字自动机，之后随条目改动增量维护
+        self._simulator_dialog = None
+        self._keyword_dialog = None
+        self.graph_build = BackgroundBuild(lambda: self.world_info_data, self)  # 第一次打开递归关系分析时建立
+        self.graph_build.progress.connect(self.on_graph_progress)
+        self.graph_build.failed.connect(self.on_graph_failed)
+        self.graph_build.built.connect(self.show_graph_report)
+        self._graph_dialog = None
+        self.budget_build = BackgroundBuild(lambda: self.world_info_data, self)  # 打开 Token 预算面板时统计
+        self._budget_draft = None  # 按表单里尚未写回的内容计入预算的条目
+        self.duplicate_build = BackgroundBuild(lambda: self.world_info_data, self)  # 第一次查找近似重复时计算签名
+        self.duplicate_build.progress.connect(self.on_duplicate_progress)
+        self.duplicate_build.failed.connect(self.on_duplicate_failed)
+        self.duplicate_build.built.connect(self.show_duplicates)
+        self._duplicate_dialog = None
+        self.settings = QSettings(QSettings.IniFormat, QSettings.UserScope, "SillyTavern-Worldinfo-Editor", "editor")
+        self.set_convert_cache_persistent(self.settings.value("convert/persist_cache", False, type=bool))
+        self._save_revision = 0
+        self._hidden_keys = set()
+        self._search_task = None
+        self._search_generation = 0
+        self.is_modified = False 
+
+        self.create_menu()
+
+        self.load_progress = QProgressBar()
+        self.load_progress.setMaximumWidth(240)
+        self.load_progress.setRange(0, 100)
+        self.load_progress.setFormat("正在读取 %p%")
+        self.load_progress.hide()
+        self.statusBar().addPermanentWidget(self.load_progress)
+
+        main_widget = QWidget()
+        self.setCentralWidget(main_widget)
+        layout = QHBoxLayout(main_widget)
+        layout.setContentsMargins(20, 20, 20, 20)
+        layout.setSpacing(20)
+
+        left_panel = QFrame()
+        left_panel.setObjectName("SidePanel") 
+        left_panel.setFixedWidth(300)
+        left_layout = QVBoxLayout(left_panel)
+        left_layout.setContentsMargins(15, 15, 15, 15)
+        left_layout.setSpacing(12)
+
+        self.search_bar = QLineEdit()
+        self.search_bar.setPlaceholderText("🔍 全局搜索 (标题/词/内容)，支持 key:龙 content:/正则/ order:>100 ...")
+        self.search_bar.setToolTip("直接输入文字: 在标题/主要关键字/过滤器/内容中查找\n"
+                                   "字段:值  按字段查找，字段名与条目 JSON 一致，如 key:龙 group:主线 position:4 disable:true\n"
+                                   "字段:/正则/  正则匹配；数值字段支持 > < >= <=；前缀 - 表示排除，如 -constant:true")
+        left_layout.addWidget(self.search_bar)
+
+        self.list_model = EntryListModel(self)
+        self.list_view = DragListView()
+        self.list_view.setModel(self.list_model)
+        left_layout.addWidget(self.list_view)
+
+        btn_layout1 = QHBoxLayout()
+        self.btn_add = QPushButton("➕ 新增")
+        self.btn_del = QPushButton("❌ 批量删除")
+        self.btn_del.setObjectName("SecondaryBtn") 
+        self.btn_move = QPushButton("📍 批量移至...")
+        self.btn_move.setObjectName("SecondaryBtn")
+        btn_layout1.addWidget(self.btn_add)
+        btn_layout1.addWidget(self.btn_move)
+        btn_layout1.addWidget(self.btn_del)
+        left_layout.addLayout(btn_layout1)
+        
+        btn_layout2 = QHBoxLayout()
+        self.btn_simp = QPushButton("🇨🇳 简")
+        self.btn_trad = QPushButton("🇭🇰 繁")
+        self.btn_simp.setObjectName("SecondaryBtn")
+        self.btn_trad.setObjectName("SecondaryBtn")
+        
+        self.btn_theme = QPushButton("🌙 暗黑模式")
+        self.btn_theme.setObjectName("SecondaryBtn")
+
+        btn_layout2.addWidget(self.btn_simp)
+        btn_layout2.addWidget(self.btn_trad)
+        btn_layout2.addWidget(self.btn_theme)
+        left_layout.addLayout(btn_layout2)
+
+        layout.addWidget(left_panel)
+
+        self.tabs = QTabWidget()
+        self.tabs.setObjectName("MainTabs")
+        layout.addWidget(self.tabs)
+
+        self.setup_tabs()
+        self.tabs.currentChanged.connect(self.ensure_tab_built)
+
+        self.budget_panel = TokenBudgetPanel(self.settings.value("budget/tokenizer", "estimate"),
+                                             self.settings.value("budget/limit", 0, type=int))
+        self.budget_panel.refresh_requested.connect(self.refresh_token_budget)
+        self.budget_build.progress.connect(self.budget_panel.set_progress)
+        self.budget_build.failed.connect(self.on_budget_failed)
+        self.budget_build.built.connect(self.refresh_token_budget)
+        self.budget_panel.tokenizer_changed.connect(self.on_budget_tokenizer_changed)
+        self.budget_panel.limit_changed.connect(self.on_budget_limit_changed)
+        self.budget_panel.setVisible(self.budget_action.isChecked())
+        layout.addWidget(self.budget_panel)
+        
+        self.list_view.selectionModel().currentChanged.connect(self.on_current_changed)
+        # 打字时先防抖，停顿后再把检索丢到线程池里执行
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(lambda: self.filter_list(self.search_bar.text()))
+        self.search_bar.textChanged.connect(lambda _: self.search_timer.start())
+        self.btn_add.clicked.connect(self.add_entry)
+        self.btn_del.clicked.connect(self.delete_entry)
+        
+        self.list_view.rowsDropped.connect(self.on_items_reordered)
+        
+        self.btn_move.clicked.connect(self.move_to_index)
+        self.btn_simp.clicked.connect(lambda: self.convert_chinese('zh-cn'))
+        self.btn_trad.clicked.connect(lambda: self.convert_chinese('zh-tw'))
+        self.btn_theme.clicked.connect(self.toggle_theme)
+
+    def toggle_theme(self):
+        self.is_dark_mode = not self.is_dark_mode
+        if self.is_dark_mode:
+            self.setStyleSheet(DARK_THEME)
+            self.btn_theme.setText("☀️ 日间模式")
+        else:
+            self.setStyleSheet(MODERN_BLUE_THEME)
+            self.btn_theme.setText("🌙 暗黑模式")
+
+    def set_modified(self):
+        if not self.is_modified:
+            self.is_modified = True
+            title = self.windowTitle()
+            if not title.endswith("*"):
+                self.setWindowTitle(title + " *")
+
+    def create_menu(self):
+        menubar = self.menuBar()
+        file_menu = menubar.addMenu("文件 (File)")
+
+        new_action = QAction("新建", self)
+        new_action.setShortcut("Ctrl+N")
+        new_action.triggered.connect(self.new_file)
+        file_menu.addAction(new_action)
+
+        open_action = QAction("打开", self)
+        open_action.setShortcut("Ctrl+O")
+        open_action.triggered.connect(self.open_file_dialog)
+        file_menu.addAction(open_action)
+        
+        save_action = QAction("保存", self)
+        save_action.setShortcut("Ctrl+S")
+        save_action.triggered.connect(self.save_file)
+        file_menu.addAction(save_action)
+        
+        save_as_action = QAction("另存为", self) 
+        save_as_action.setShortcut("Ctrl+Shift+S")
+        save_as_action.triggered.connect(self.save_as_file)
+        file_menu.addAction(save_as_action)
+
+        edit_menu = menubar.addMenu("编辑 (Edit)")
+
+        undo_action = QAction("撤销", self)
+        undo_action.setShortcut("Ctrl+Z")
+        undo_action.triggered.connect(self.undo)
+        edit_menu.addAction(undo_action)
+
+        redo_action = QAction("重做", self)
+        redo_action.setShortcuts(["Ctrl+Y", "Ctrl+Shift+Z"])
+        redo_action.triggered.connect(self.redo)
+        edit_menu.addAction(redo_action)
+
+        edit_menu.addSeparator()
+        replace_action = QAction("批量查找替换...", self)
+        replace_action.setShortcut("Ctrl+H")
+        replace_action.triggered.connect(self.open_bulk_replace)
+        edit_menu.addAction(replace_action)
+
+        merge_action = QAction("合并选中条目", self)
+        merge_action.setToolTip("保留选中的第一个条目，把其余条目的关键字和可选过滤器并入它，再删除其余条目")
+        merge_action.triggered.connect(lambda: self.merge_entries([self.selected_keys()]))
+        edit_menu.addAction(merge_action)
+
+        tools_menu = menubar.addMenu("工具 (Tools)")
+
+        simulate_action = QAction("触发模拟...", self)
+        simulate_action.setShortcut("Ctrl+T")
+        simulate_action.triggered.connect(self.open_activation_simulator)
+        tools_menu.addAction(simulate_action)
+
+        keyword_action = QAction("关键字索引...", self)
+        keyword_action.setShortcut("Ctrl+K")
+        keyword_action.triggered.connect(self.open_keyword_index)
+        tools_menu.addAction(keyword_action)
+
+        graph_action = QAction("递归关系分析...", self)
+        graph_action.triggered.connect(self.open_activation_graph)
+        tools_menu.addAction(graph_action)
+
+        duplicate_action = QAction("查找近似重复条目...", self)
+        duplicate_action.triggered.connect(self.open_duplicate_finder)
+        tools_menu.addAction(duplicate_action)
+
+        tools_menu.addSeparator()
+        self.budget_action = QAction("Token 预算面板", self)
+        self.budget_action.setShortcut("Ctrl+B")
+        self.budget_action.setCheckable(True)
+        self.budget_action.setChecked(self.settings.value("budget/visible", False, type=bool))
+        self.budget_action.toggled.connect(self.toggle_budget_panel)
+        tools_menu.addAction(self.budget_action)
+
+        options_menu = menubar.addMenu("选项 (Options)")
+
+        cache_action = QAction("记住简繁转换结果 (下次启动继续使用)", self)
+        cache_action.setCheckable(True)
+        cache_action.setChecked(self.settings.value("convert/persist_cache", False, type=bool))
+        cache_action.toggled.connect(self.set_convert_cache_persistent)
+        options_menu.addAction(cache_action)
+
+    def add_field(self, layout, label, json_key, widget_type, **kwargs):
+        label_widget = None
+        if widget_type == 'text':
+            w = QLineEdit()
+            w.textChanged.connect(lambda _: self.on_field_edited(json_key))
+            layout.addRow(label, w)
+        elif widget_type == 'content_editor': 
+            w = ContentEditorWidget()
+            w.textChanged.connect(lambda: self.on_field_edited(json_key))
+            layout.addRow(label, w)
+        elif widget_type == 'bool' or widget_type == 'invert_bool':
+            w = QCheckBox(label)
+            w.toggled.connect(lambda _: self.on_field_edited(json_key))
+            layout.addRow("", w)
+        elif widget_type == 'int':
+            w = QSpinBox()
+            w.setRange(kwargs.get('min', 0), kwargs.get('max', 99999))
+            w.valueChanged.connect(lambda _: self.on_field_edited(json_key))
+            layout.addRow(label, w)
+        elif widget_type == 'nullable_int':
+            w = QLineEdit()
+            w.setPlaceholderText("为空则使用全局设置")
+            w.setValidator(QIntValidator(0, 99999, w)) 
+            w.textChanged.connect(lambda _: self.on_field_edited(json_key))
+            layout.addRow(label, w)
+        elif widget_type == 'combo' or widget_type == 'strategy_combo':
+            w = QComboBox()
+            w.addItems(kwargs.get('items', []))
+            w.currentIndexChanged.connect(lambda _: self.on_field_edited(json_key))
+            layout.addRow(label, w)
+        elif widget_type == 'tristate_combo':
+            w = QComboBox()
+            w.addItems(["使用全局 (Global)", "是 (Yes)", "否 (No)"])
+            w.currentIndexChanged.connect(lambda _: self.on_field_edited(json_key))
+            layout.addRow(label, w)
+        elif widget_type == 'multicheck':
+            w = QWidget()
+            h_layout = QHBoxLayout(w)
+            h_layout.setContentsMargins(0, 0, 0, 0)
+            h_layout.setSpacing(15) 
+            w.checkboxes = {}
+            for val, txt in kwargs.get('options', {}).items():
+                cb = QCheckBox(txt)
+                cb.toggled.connect(lambda _: self.on_field_edited(json_key))
+                w.checkboxes[val] = cb
+                h_layout.addWidget(cb)
+            layout.addRow(label, w)
+
+        if label: 
+            label_widget = layout.labelForField(w)
+            if label_widget:
+                label_widget.setObjectName("FormLabel")
+            elif isinstance(w, QCheckBox):
+                w.setObjectName("FormLabel")
+
+        read, write, clear = compile_field_binding(json_key, widget_type, w)
+        self.field_map[json_key] = {'widget': w, 'type': widget_type, 'label_widget': label_widget,
+                                    'read': read, 'write': write, 'clear': clear}
+
+    def toggle_visibility(self, json_key, visible):
+        if json_key in self.field_map:
+            config = self.field_map[json_key]
+            config['widget'].setVisible(visible)
+            if config['label_widget']: config['label_widget'].setVisible(visible)
+
+    def update_position_ui(self):
+        if 'position' not in self.field_map: return
+        idx = self.field_map['position']['widget'].currentIndex()
+        self.toggle_visibility('depth', idx == 6)
+        self.toggle_visibility('role', idx == 6)
+        self.toggle_visibility('outletName', idx == 7)
+
+    def update_recursion_ui(self):
+        if 'delayUntilRecursion' not in self.field_map: return
+        self.toggle_visibility('recursionLevel', self.field_map['delayUntilRecursion']['widget'].isChecked())
+
+    def _create_tab_widget(self):
+        tab = QWidget()
+        layout = QFormLayout(tab)
+        layout.setContentsMargins(25, 25, 25, 25)
+        layout.setSpacing(18) 
+        return tab, layout
+
+    def setup_tabs(self):
+        tab_basic, layout_basic = self._create_tab_widget()
+        self.add_field(layout_basic, "条目标题/备忘录 (Comment):", "comment", "text")
+        self.add_field(layout_basic, "主要关键字 (Keys) [逗号分隔]:", "key", "text") 
+        self.add_field(layout_basic, "可选过滤器 (Optional Filter):", "keysecondary", "text") 
+        self.add_field(layout_basic, "过滤器逻辑:", "selectiveLogic", "combo", items=["AND ANY (包含任一)", "NOT ALL (不包含所有)", "NOT ANY (不包含任一)", "AND ALL (包含所有)"])
+        self.add_field(layout_basic, "条目内容 (Content):", "content", "content_editor") 
+        self.add_field(layout_basic, "自动化 ID (Automation ID):", "automationId", "text") 
+        
+        layout_basic.addRow(QLabel("")) 
+        self.add_field(layout_basic, "✅ 启用此条目 (Enable)", "disable", "invert_bool") 
+        self.add_field(layout_basic, "生效策略 (Strategy):", "strategy", "strategy_combo", items=["条件触发 (🟢 默认)", "常驻 (🔵 始终插入)", "向量化匹配 (🔗 相似度)"]) 
+        self.tabs.addTab(tab_basic, "基础设定")
+        # 其余标签页平时很少打开，先放一个空页，第一次切换过去时再构建表单
+        self.add_lazy_tab("插入与匹配", self.build_insert_tab)
+        self.add_lazy_tab("其他", self.build_other_tab)
+
+    def add_lazy_tab(self, title, build):
+        tab, layout = self._create_tab_widget()
+        self._pending_tabs[tab] = (layout, build)
+        self.tabs.addTab(tab, title)
+
+    def ensure_tab_built(self, index):
+        layout, build = self._pending_tabs.pop(self.tabs.widget(index), (None, None))
+        if build is None: return
+        known = set(self.field_map)
+        build(layout)
+        # 已经打开了条目时，只把新建出来的字段填上当前条目的值
+        if self.current_entry_key in self.world_info_data:
+            self.load_entry_to_form([k for k in self.field_map if k not in known])
+
+    def build_insert_tab(self, layout_insert):
+        self.add_field(layout_insert, "顺序 (Order):", "order", "int") 
+        self.add_field(layout_insert, "触发策略/插入位置:", "position", "combo", items=POSITION_LABELS) 
+        self.add_field(layout_insert, "↳ 深度在 (@ D):", "depth", "int") 
+        self.add_field(layout_insert, "↳ 扮演角色 (Role):", "role", "combo", items=["⚙️ [系统]", "👤 [用户]", "🤖 [AI]"]) 
+        self.add_field(layout_insert, "↳ 锚点名称 (Outlet Name):", "outletName", "text") 
+        
+        layout_insert.addRow(QLabel("")) 
+        self.add_field(layout_insert, "扫描深度 (Scan Depth):", "scanDepth", "nullable_int") 
+        self.add_field(layout_insert, "触发概率 (Trigger %):", "probability", "int", max=100) 
+        self.add_field(layout_insert, "区分大小写 (Case Sensitive)", "caseSensitive", "tristate_combo") 
+        self.add_field(layout_insert, "完整单词/全字匹配 (Match Whole Words)", "matchWholeWords", "tristate_combo") 
+        
+        layout_insert.addRow(QLabel("")) 
+        self.add_field(layout_insert, "包含组 (Group):", "group", "text") 
+        self.add_field(layout_insert, "组权重 (Group Weight):", "groupWeight", "int", max=10000) 
+        self.add_field(layout_insert, "确定优先级 (Prioritize Inclusion)", "groupOverride", "bool") 
+        self.add_field(layout_insert, "组评分 (Use Group Scoring)", "useGroupScoring", "tristate_combo") 
+        
+        layout_insert.addRow(QLabel("")) 
+        self.add_field(layout_insert, "绑定到角色或标签 (Character Filter):", "characterFilter", "text") 
+        self.add_field(layout_insert, "排除 (Exclude Filter)", "characterFilterExclude", "bool") 
+        self.field_map['position']['widget'].currentIndexChanged.connect(self.update_position_ui)
+
+    def build_other_tab(self, layout_adv):
+        self.add_field(layout_adv, "筛选生成触发器 (Triggers):", "triggers", "multicheck", options={"normal": "正常", "continue": "继续", "impersonate": "扮演", "swipe": "滑动", "regenerate": "重新生成", "quiet": "静默"})
+        
+        layout_adv.addRow(QLabel("")) 
+        self.add_field(layout_adv, "黏性 (Sticky):", "sticky", "int") 
+        self.add_field(layout_adv, "冷却 (Cooldown):", "cooldown", "int") 
+        self.add_field(layout_adv, "延迟 (Delay):", "delay", "int") 
+        
+        layout_adv.addRow(QLabel("")) 
+        self.add_field(layout_adv, "不可递归 (不会被其他条目激活) (Exclude Recursion)", "excludeRecursion", "bool")
+        self.add_field(layout_adv, "无视回复限额 (Ignore Budget)", "ignoreBudget", "bool")
+        self.add_field(layout_adv, "防止进一步递归 (Prevent Recursion)", "preventRecursion", "bool") 
+        self.add_field(layout_adv, "延迟到递归", "delayUntilRecursion", "bool") 
+        self.add_field(layout_adv, "↳ 递归等级 (Recursion Level):", "recursionLevel", "int") 
+        
+        layout_adv.addRow(QLabel("")) 
+        self.add_field(layout_adv, "匹配角色描述", "matchCharacterDescription", "bool") 
+        self.add_field(layout_adv, "匹配角色备注", "matchCharacterDepthPrompt", "bool") 
+        self.add_field(layout_adv, "匹配角色性格", "matchCharacterPersonality", "bool") 
+        self.add_field(layout_adv, "匹配情景", "matchScenario", "bool") 
+        self.add_field(layout_adv, "匹配用户设定描述", "matchPersonaDescription", "bool") 
+        self.add_field(layout_adv, "匹配创作者注释", "matchCreatorNotes", "bool") 
+        self.field_map['delayUntilRecursion']['widget'].toggled.connect(self.update_recursion_ui)
+
+    def new_file(self):
+        if not self.check_unsaved_changes(): return
+        self.cancel_loading()
+        self.world_info_data = {}
+        self.top_level_extras, self.top_level_keys = {}, []
+        self.current_file_path = None
+        self.current_entry_key = None
+        self.is_modified = False
+        self.refresh_list()
+        self.clear_form()
+        self.setWindowTitle("SillyTavern 世界书编辑器 - [未命名新文件]")
+
+    def open_file_dialog(self):
+        if not self.check_unsaved_changes(): return
+        file_path, _ = QFileDialog.getOpenFileName(self, "选择世界书文件", "", "JSON Files (*.json);;All Files (*)")
+        if file_path:
+            self.current_file_path = file_path
+            self.load_data(file_path)
+
+    def load_data(self, file_path):
+        # 备份和解析都在线程池里进行，条目按批追加到列表，界面不会卡住
+        self.cancel_loading()
+        self.current_entry_key = None 
+        self.clear_form()
+        self.world_info_data = {}
+        self.top_level_extras, self.top_level_keys = {}, []
+        self.refresh_list()
+        self.is_modified = False 
+        self.setWindowTitle(f"SillyTavern 世界书编辑器 - 正在读取 {file_path} ...")
+        self.load_progress.setValue(0)
+
+        self._load_generation += 1
+        task = LoadTask(self._load_generation, file_path)
+        task.signals.batchReady.connect(self.on_load_batch)
+        task.signals.progress.connect(self.on_load_progress)
+        task.signals.finished.connect(self.on_load_finished)
+        task.signals.failed.connect(self.on_load_failed)
+        self._load_task = task
+        self.set_loading_ui(True)
+        QThreadPool.globalInstance().start(task)
+
+    def is_loading(self):
+        return self._load_task is not None
+
+    def cancel_loading(self):
+        if self._load_task is not None:
+            self._load_task.cancel()
+            self._load_task = None
+            self.set_loading_ui(False)
+        self._load_generation += 1
+
+    def set_loading_ui(self, loading):
+        # 读取过程中新增/删除/转换会和后续到达的条目 ID 冲突，先禁用
+        for btn in (self.btn_add, self.btn_del, self.btn_move, self.btn_simp, self.btn_trad):
+            btn.setEnabled(not loading)
+        self.load_progress.setVisible(loading)
+
+    def on_load_batch(self, generation, batch):
+        if generation != self._load_generation: return
+        new_keys = []
+        for key, entry in batch:
+            # 文件里重复的条目 ID 与 Lorebook.load 一致：保留第一次出现的位置，取最后一次的内容
+            if key not in self.world_info_data: new_keys.append(key)
+            self.world_info_data[key] = entry
+            self.search_index.update(key, entry)
+            self.activation_simulator.update(key, entry)
+            self.graph_build.entry_changed(key, None)
+            self.duplicate_build.entry_changed(key, None)
+            self.uid_allocator.claim(key)
+        self.list_model.append_keys(new_keys)
+
+    def on_load_progress(self, generation, done, total):
+        if generation == self._load_generation and total:
+            self.load_progress.setValue(int(done * 100 / total))
+
+    def on_load_finished(self, generation, extras, top_level_keys):
+        if generation != self._load_generation: return
+        self._load_task = None
+        self.set_loading_ui(False)
+        self.top_level_extras, self.top_level_keys = extras, top_level_keys
+        self.setWindowTitle(f"SillyTavern 世界书编辑器 - {self.current_file_path}")
+        if self.search_bar.text():
+            self.filter_list(self.search_bar.text())
+        if not self.budget_panel.isHidden(): self.budget_panel.timer.start()
+        # 读取途中打开的查找窗口只分组了当时已读到的条目
+        if self._duplicate_dialog is not None and self._duplicate_dialog.isVisible() and self.duplicate_build.result is not None:
+            self._duplicate_dialog.timer.start()
+
+    def on_load_failed(self, generation, message):
+        if generation != self._load_generation: return
+        self._load_task = None
+        self.set_loading_ui(False)
+        # 读到一半的内容不能当作完整文件，避免随后误保存覆盖原文件
+        self.world_info_data = {}
+        self.top_level_extras, self.top_level_keys = {}, []
+        self.current_file_path = None
+        self.refresh_list()
+        self.setWindowTitle("SillyTavern 世界书编辑器 - [未命名新文件]")
+        QMessageBox.critical(self, "读取错误", f"无法读取文件:\n{message}")
+
+    def build_save_data(self):
+        # 条目按列表顺序写出
+        return build_save_data(self.world_info_data, self.list_model.order, self.top_level_extras, self.top_level_keys)
+
+    # ================= [核心修复] 保持刷新列表时滚动条位置不动 =================
+    def refresh_list(self):
+        # 记录当前滚动条位置
+        v_scrollbar = self.list_view.verticalScrollBar()
+        current_scroll = v_scrollbar.value()
+        
+        self.list_model.set_entries(self.world_info_data)
+        self.search_index.rebuild(self.world_info_data)
+        self.activation_simulator.rebuild(self.world_info_data)
+        self.discard_activation_graph()
+        self.discard_token_budget()
+        self.discard_duplicate_finder()
+        self.save_writer.reset()
+        self.journal.reset(self.world_info_data)
+        self.undo_stack.clear()
+        self.uid_allocator.reset(self.world_info_data)
+        self._hidden_keys = set()  # 模型重置后视图会清空所有隐藏行
+        if self.search_bar.text():
+            self.filter_list(self.search_bar.text())
+        
+        # 恢复滚动条位置，防止列表乱跳
+        v_scrollbar.setValue(current_scroll)
+
+    def selected_keys(self):
+        return [self.list_model.key_at(row) for row in self.list_view.selected_rows()]
+
+    def select_keys(self, keys):
+        selection = QItemSelection()
+        last_index = None
+        for key in keys:
+            row = self.list_model.row_of(key)
+            if row < 0: continue
+            last_index = self.list_model.index(row)
+            selection.select(last_index, last_index)
+        self.list_view.selectionModel().select(selection, QItemSelectionModel.ClearAndSelect)
+        if last_index is not None:
+            self.list_view.scrollTo(last_index)
+
+    def filter_list(self, text):
+        if self._search_task is not None:
+            self._search_task.cancel()
+            self._search_task = None
+        self._search_generation += 1
+
+        query, candidates, revision = self.search_index.prepare(text)
+        if query.plain == "":
+            self.apply_visibility(self._hidden_keys, ())
+            return
+        if len(candidates) < len(self.world_info_data):
+            # 增量筛选：不在候选里的条目一定不匹配，直接隐藏
+            self.apply_visibility((), self.world_info_data.keys() - {k for k, _ in candidates})
+
+        task = SearchTask(self._search_generation, query, candidates, revision)
+        task.signals.chunkReady.connect(self.on_search_chunk)
+        task.signals.finished.connect(self.on_search_finished)
+        self._search_task = task
+        QThreadPool.globalInstance().start(task)
+
+    def on_search_chunk(self, generation, matched, missed):
+        if generation == self._search_generation:
+            self.apply_visibility(matched, missed)
+
+    def on_search_finished(self, generation, query, hits, revision):
+        if generation == self._search_generation:
+            self._search_task = None
+            self.search_index.remember(query, hits, revision)
+
+    def apply_visibility(self, show_keys, hide_keys):
+        # 只切换显隐状态发生变化的行
+        for key in [k for k in show_keys if k in self._hidden_keys]:
+            self._hidden_keys.discard(key)
+            row = self.list_model.row_of(key)
+            if row >= 0: self.list_view.setRowHidden(row, False)
+        for key in hide_keys:
+            if key in self._hidden_keys: continue
+            self._hidden_keys.add(key)
+            row = self.list_model.row_of(key)
+            if row >= 0: self.list_view.setRowHidden(row, True)
+
+    def on_items_reordered(self, rows, target_row):
+        self.save_current_ui_to_memory()
+        keys = [self.list_model.key_at(row) for row in rows]
+        if not keys: return
+        selected = set(rows)
+        before_key = None
+        for row in range(target_row, self.list_model.rowCount()):
+            if row not in selected:
+                before_key = self.list_model.key_at(row)
+                break
+        for step in self.list_model.move_keys(keys, before_key):
+            self.journal.move(*step)
+        self.journal.commit()
+
+    def move_to_index(self):
+        selected_rows = self.list_view.selected_rows()
+        if not selected_rows: 
+            QMessageBox.warning(self, "提示", "请先选择要移动的条目！")
+            return
+            
+        selected_keys = [self.list_model.key_at(row) for row in selected_rows]
+        
+        total = self.list_model.rowCount()
+        new_row, ok = QInputDialog.getInt(self, "批量移动", f"您选中了 {len(selected_rows)} 个条目。\n输入它们要插入的目标位置 (1 到 {total}):", selected_rows[0] + 1, 1, total, 1)
+        
+        if ok:
+            self.save_current_ui_to_memory()
+            target_index = new_row - 1
+            
+            # 目标位置按“移除选中条目后”的序号计算：跳过排在落点之前的选中行，
+            # 得到落点处第一个未选中条目的行号，以它为锚点，无需遍历整个列表
+            anchor_row = target_index
+            for row in sorted(selected_rows):
+                if row <= anchor_row: anchor_row += 1
+            before_key = self.list_model.key_at(anchor_row) if anchor_row < total else None
+            for step in self.list_model.move_keys(selected_keys, before_key):
+                self.journal.move(*step)
+            self.journal.commit()
+            
+            # [新增体验优化] 移动后自动滚动并高亮选中的条目
+            self.select_keys(selected_keys)
+
+    def undo(self):
+        self.replay_history(self.undo_stack.undo, "没有可以撤销的操作")
+
+    def redo(self):
+        self.replay_history(self.undo_stack.redo, "没有可以重做的操作")
+
+    def replay_history(self, step, empty_message):
+        # 先把表单里未写回的修改提交成一步，再撤销/重做
+        self.save_current_ui_to_memory()
+        changes = step(self.apply_change)
+        if not changes:
+            self.statusBar().showMessage(empty_message, 3000)
+            return
+        if any(c.kind in ("add", "remove") for c in changes) and self.search_bar.text():
+            self.filter_list(self.search_bar.text())
+        if self.current_entry_key in self.world_info_data:
+            self.load_entry_to_form()
+        else:
+            self.current_entry_key = None
+            self.clear_form()
+        self.select_keys([k for k in dict.fromkeys(c.key for c in changes) if k in self.world_info_data])
+
+    def apply_change(self, change):
+        # 执行一条改动 (撤销时传入的是它的逆操作)，条目和列表同时更新
+        if change.kind == "set":
+            self.journal.set_fields(change.key, {change.field: change.new})
+        elif change.kind == "add":
+            self.journal.add(change.key, change.new, change.row)
+            self.list_model.insert_key(change.row, change.key)
+        elif change.kind == "remove":
+            self.list_model.remove_keys([change.key])
+            self.journal.remove(change.key, change.row)
+            self._hidden_keys.discard(change.key)
+        elif change.kind == "move":
+            self.list_model.move_row(change.old, change.new)
+            self.journal.move(change.key, change.old, change.new)
+
+    def convert_chinese(self, target_lang):
+        selected_keys = self.selected_keys()
+        if not selected_keys:
+            QMessageBox.warning(self, "提示", "请先选择要转换的条目！(支持按住 Ctrl/Shift 多选)")
+            return
+            
+        mode_str = "简体" if target_lang == 'zh-cn' else "繁体"
+        dialog = ConvertDialog(mode_str, self)
+        if dialog.exec() != QDialog.Accepted: return
+            
+        conv_title, conv_keys, conv_content = dialog.get_selection()
+        self.save_current_ui_to_memory()
+
+        # 只把要转换的字段取出来交给后台，条目本身留在界面线程，转换完成后统一写回
+        fields = [f for f, on in zip(CONVERT_FIELDS, (conv_title, conv_keys, conv_keys, conv_content)) if on]
+        items = field_snapshots(self.world_info_data, selected_keys, fields)
+
+        self._convert_generation += 1
+        task = ConvertTask(self._convert_generation, items, target_lang)
+        progress = QProgressDialog(f"正在转换为{mode_str}...", "取消", 0, 0, self)
+        progress.setWindowTitle("简繁转换")
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setMinimumDuration(300)
+        progress.setValue(0)
+        progress.canceled.connect(self.cancel_conversion)
+        def on_progress(generation, done, total):
+            progress.setMaximum(max(total, 1))
+            progress.setValue(done)
+        task.signals.progress.connect(on_progress)
+        task.signals.finished.connect(lambda gen, results: self.apply_conversion(gen, selected_keys, results, target_lang))
+        task.signals.failed.connect(self.on_convert_failed)
+        task.signals.finished.connect(progress.reset)
+        task.signals.failed.connect(progress.reset)
+        self._convert_task = task
+        self._convert_progress = progress
+        QThreadPool.globalInstance().start(task)
+
+    def set_convert_cache_persistent(self, enabled):
+        # 转换缓存默认只在本次运行内有效；开启后保存在设置文件旁边
+        self.settings.setValue("convert/persist_cache", enabled)
+        conversion_cache.path = os.path.join(os.path.dirname(self.settings.fileName()), "convert_cache.json") if enabled else None
+
+    def cancel_conversion(self):
+        # 取消后即使结果已经在队列里也不再写回
+        if self._convert_task is not None:
+            self._convert_task.cancel()
+            self._convert_task = None
+        self._convert_generation += 1
+
+    def on_convert_failed(self, generation, message):
+        if generation != self._convert_generation: return
+        self._convert_task = None
+        QMessageBox.critical(self, "转换失败", f"简繁转换过程中发生错误 (可能是打包时丢失了字典文件)：\n{message}")
+
+    def apply_conversion(self, generation, selected_keys, results, target_lang):
+        if generation != self._convert_generation: return
+        self._convert_task = None
+        converted = dict(results)
+
+        # 先清空选择：存在大量选中行时，每插入一行选择模型都要重新计算一遍
+        self.list_view.clearSelection()
+        new_keys_added = [] # 记录新生成的条目ID
+        for original_key in selected_keys:
+            original_data = self.world_info_data.get(original_key)
+            if original_data is None or original_key not in converted: continue  # 转换期间被删除
+            new_data = converted_entry(original_data, converted[original_key], target_lang)
+
+            new_id = self.uid_allocator.allocate()
+            new_data["uid"] = int(new_id)
+            row = self.list_model.row_of(original_key) + 1
+            self.journal.add(new_id, new_data, row)
+            self.list_model.insert_key(row, new_id)
+            new_keys_added.append(new_id)
+            
+        if not new_keys_added: return
+        self.journal.commit()
+
+        # [新增体验优化] 自动选中最新生成的简繁条目，并智能跟随滚动！
+        self.select_keys(new_keys_added)
+
+    def open_bulk_replace(self):
+        if self._replace_dialog is None:
+            dialog = BulkReplaceDialog(self)
+            dialog.preview_requested.connect(lambda: self.start_replace(preview=True))
+            dialog.replace_requested.connect(lambda: self.start_replace(preview=False))
+            dialog.entry_activated.connect(self.jump_to_entry)
+            dialog.finished.connect(lambda _: self.cancel_replace())
+            self._replace_dialog = dialog
+        dialog = self._replace_dialog
+        dialog.chk_selected.setChecked(len(self.selected_keys()) > 1)
+        dialog.show()
+        dialog.raise_()
+        dialog.find_input.setFocus()
+
+    def start_replace(self, preview):
+        dialog = self._replace_dialog
+        find_text, replacement, regex, case_sensitive, fields, only_selected = dialog.options()
+        if not find_text or not fields: return
+        try:
+            pattern = compile_find_pattern(find_text, regex, case_sensitive)
+        except re.error as e:
+            QMessageBox.warning(dialog, "提示", f"正则表达式有误：{e}")
+            return
+        if not preview:
+            try:
+                if regex: pattern.sub(replacement, "")  # 提前检查替换文本里的分组引用
+            except re.error as e:
+                QMessageBox.warning(dialog, "提示", f"替换文本有误：{e}")
+                return
+
+        # 表单里未写回的修改先提交，后台拿到的快照才是最新的
+        self.save_current_ui_to_memory()
+        keys = self.selected_keys() if only_selected else self.list_model.keys()
+        items = field_snapshots(self.world_info_data, keys, fields)
+        # 写回前核对：后台执行期间条目又被改过，就用最新的内容重新查找替换
+        revision = (self._load_generation, self.journal.revision)
+
+        self.cancel_replace()
+        task = ReplaceTask(self._replace_generation, items, pattern, None if preview else replacement, regex)
+        if preview:
+            task.signals.finished.connect(self.show_replace_preview)
+        else:
+            task.signals.finished.connect(lambda gen, results: self.apply_replace(gen, revision, results))
+        task.signals.failed.connect(self.on_replace_failed)
+        self._replace_task = task
+        dialog.set_busy(True)
+        QThreadPool.globalInstance().start(task)
+
+    def cancel_replace(self):
+        if self._replace_task is not None:
+            self._replace_task.cancel()
+            self._replace_task = None
+            if self._replace_dialog is not None: self._replace_dialog.set_busy(False)
+        self._replace_generation += 1
+
+    def on_replace_failed(self, generation, message):
+        if generation != self._replace_generation: return
+        self._replace_task = None
+        self._replace_dialog.set_busy(False)
+        QMessageBox.critical(self._replace_dialog, "替换失败", f"批量查找替换时发生错误：\n{message}")
+
+    def show_replace_preview(self, generation, results):
+        if generation != self._replace_generation: return
+        self._replace_task = None
+        self._replace_dialog.set_busy(False)
+        self._replace_dialog.show_preview([(key, entry_display_name(key, self.world_info_data[key]), counts)
+                                           for key, counts in results if key in self.world_info_data])
+
+    def apply_replace(self, generation, revision, results):
+        if generation != self._replace_generation: return
+        self._replace_task = None
+        self.save_current_ui_to_memory()
+        if revision != (self._load_generation, self.journal.revision):
+            self.start_replace(preview=False)
+            return
+        self._replace_dialog.set_busy(False)
+
+        # 所有条目的替换作为一组改动提交，一次撤销就能全部还原
+        for key, values in results:
+            self.journal.set_fields(key, values)
+        self.journal.commit()
+        if self.current_entry_key in dict(results): self.load_entry_to_form()
+        self._replace_dialog.clear_preview()
+        self._replace_dialog.summary.setText(f"已在 {len(results)} 个条目中完成替换" if results else "没有找到匹配")
+
+    def open_activation_simulator(self):
+        if self._simulator_dialog is None:
+            dialog = ActivationSimulatorDialog(self)
+            dialog.simulate_requested.connect(self.run_activation_simulation)
+            dialog.options_changed.connect(self.on_simulator_options_changed)
+            dialog.entry_activated.connect(self.jump_to_entry)
+            self._simulator_dialog = dialog
+        self._simulator_dialog.show()
+        self._simulator_dialog.raise_()
+        self._simulator_dialog.chat_input.setFocus()
+
+    def on_simulator_options_changed(self):
+        # 全局默认值影响所有没单独设置的条目，只能整体重建
+        dialog = self._simulator_dialog
+        self.activation_simulator = ActivationSimulator(dialog.chk_case.isChecked(), dialog.chk_whole.isChecked())
+        self.activation_simulator.rebuild(self.world_info_data)
+        self.discard_activation_graph()
+        self.run_activation_simulation()
+        if self._keyword_dialog is not None and self._keyword_dialog.isVisible(): self._keyword_dialog.timer.start()
+
+    def run_activation_simulation(self):
+        dialog = self._simulator_dialog
+        # 表单里还没写回的修改也算进去
+        self.save_current_ui_to_memory()
+        dialog.timer.stop()
+        started = time.perf_counter()
+        results = self.activation_simulator.simulate(dialog.chat_input.toPlainText(),
+                                                     random.Random() if dialog.chk_roll.isChecked() else None)
+        elapsed = (time.perf_counter() - started) * 1000
+        rows = []
+        for key, reason, keywords in sorted(results, key=lambda r: self.list_model.row_of(r[0])):
+            rule = self.activation_simulator.rule(key)
+            rows.append((key, entry_display_name(key, self.world_info_data[key]), reason, keywords, rule.vectorized, rule.probability))
+        dialog.show_results(rows, elapsed)
+
+    def open_keyword_index(self):
+        if self._keyword_dialog is None:
+            dialog = KeywordIndexDialog(self)
+            dialog.lookup_requested.connect(self.lookup_keyword)
+            dialog.refresh_requested.connect(self.refresh_keyword_report)
+            dialog.select_requested.connect(self.select_keys)
+            dialog.entry_activated.connect(self.jump_to_entry)
+            self._keyword_dialog = dialog
+        self._keyword_dialog.show()
+        self._keyword_dialog.raise_()
+        self._keyword_dialog.lookup_input.setFocus()
+        self.refresh_keyword_report()
+        self.lookup_keyword()
+
+    def lookup_keyword(self):
+        # 关键字索引就是触发模拟器里随条目改动增量维护的倒排表，查一次只是两次字典查找
+        dialog = self._keyword_dialog
+        self.save_current_ui_to_memory()
+        word = dialog.lookup_input.text()
+        if not word.strip():
+            dialog.show_lookup([])
+            return
+        simulator = self.activation_simulator
+        rows = {key: self.list_model.row_of(key) for key in simulator.keyword_entries(word)}
+        dialog.show_lookup([(key, entry_display_name(key, self.world_info_data[key]), simulator.rule(key).case_sensitive, row)
+                            for key, row in sorted(rows.items(), key=lambda item: item[1])])
+
+    def refresh_keyword_report(self):
+        dialog = self._keyword_dialog
+        # 表单里还没写回的关键字也算进去
+        self.save_current_ui_to_memory()
+        dialog.timer.stop()
+        started = time.perf_counter()
+        simulator = self.activation_simulator
+        collisions = simulator.keyword_collisions(dialog.min_entries.value())
+        top = heapq.nlargest(self.KEYWORD_REPORT_LIMIT, collisions, key=lambda c: len(c[2]))
+        rows = {key: row for row, key in enumerate(self.list_model.order)}
+        report = []
+        for case_sensitive, word, keys, loose in top:
+            members = heapq.nsmallest(self.KEYWORD_MEMBER_LIMIT, keys, key=rows.__getitem__)
+            report.append((word, case_sensitive, loose, [(key, entry_display_name(key, self.world_info_data[key])) for key in members], len(keys)))
+        keywords, regex_entries = simulator.keyword_counts()
+        elapsed = (time.perf_counter() - started) * 1000
+        summary = f"共 {keywords} 个关键字，其中 {len(collisions)} 个被至少 {dialog.min_entries.value()} 个启用的条目共用"
+        if len(collisions) > len(top): summary += f"，列出最多的 {len(top)} 个"
+        if regex_entries: summary += f"；另有 {regex_entries} 个条目使用正则关键字，不在索引里"
+        dialog.show_report(summary + f" · 用时 {elapsed:.0f} ms", report)
+
+    def open_activation_graph(self):
+        if self._graph_dialog is None:
+            dialog = ActivationGraphDialog(self)
+            dialog.refresh_requested.connect(self.refresh_activation_graph)
+            dialog.entry_activated.connect(self.jump_to_entry)
+            self._graph_dialog = dialog
+        self._graph_dialog.show()
+        self._graph_dialog.raise_()
+        self.refresh_activation_graph()
+
+    def refresh_activation_graph(self):
+        self.save_current_ui_to_memory()
+        self._graph_dialog.timer.stop()
+        if self.graph_build.result is None:
+            self.start_graph_build()
+        else:
+            self.show_graph_report()
+
+    def start_graph_build(self):
+        if self.graph_build.is_building(): return
+        case_sensitive, match_whole_words = self.activation_simulator.case_sensitive, self.activation_simulator.match_whole_words
+        self.graph_build.start(lambda: ActivationGraph(case_sensitive, match_whole_words), trigger_snapshot(self.world_info_data))
+        self._graph_dialog.summary.setText("正在扫描所有条目的正文...")
+        self._graph_dialog.set_progress(0, 1)
+
+    def discard_activation_graph(self):
+        # 换了文件或全局匹配设置后整张图作废，分析窗口开着就重新建
+        self.graph_build.discard()
+        if self._graph_dialog is not None and self._graph_dialog.isVisible():
+            self.start_graph_build()
+
+    def on_graph_progress(self, done, total):
+        self._graph_dialog.set_progress(done, total)
+
+    def on_graph_failed(self, message):
+        self._graph_dialog.set_progress(1, 1)
+        QMessageBox.critical(self._graph_dialog, "分析失败", f"建立递归触发图时发生错误：\n{message}")
+
+    def show_graph_report(self):
+        graph = self.graph_build.result
+        started = time.perf_counter()
+        cycles, reach = graph.analyze()
+        rules = graph.simulator.rules()
+        def name(key): return entry_display_name(key, self.world_info_data[key])
+        def flags(key):
+            rule = rules[key]
+            parts = []
+            if rule.exclude_recursion: parts.append("不可被递归")
+            if rule.prevent_recursion: parts.append("阻止进一步递归")
+            if rule.delay_level is not None: parts.append(f"延迟递归 (层级 {rule.delay_level})")
+            return "、".join(parts)
+        rows = {key: row for row, key in enumerate(self.list_model.order)}
+        by_row = rows.__getitem__
+        hot = heapq.nlargest(self.GRAPH_HOTSPOT_LIMIT, (k for k in reach if reach[k]), key=lambda k: (reach[k], graph.out_degree(k)))
+        hotspots = []
+        for key in hot:
+            targets = sorted(graph.targets(key), key=by_row)
+            hotspots.append((key, name(key), len(targets), reach[key], graph.in_degree(key), flags(key),
+                             [(t, name(t)) for t in targets[:self.GRAPH_TARGET_LIMIT]]))
+        cycle_rows = [[(key, name(key), flags(key)) for key in sorted(cycle, key=by_row)] for cycle in cycles]
+        elapsed = (time.perf_counter() - started) * 1000
+        summary = (f"{graph.edge_count()} 条递归触发关系，{len(cycles)} 个循环，"
+                   f"最多一个条目可牵连 {reach[hot[0]] if hot else 0} 个条目 · 分析用时 {elapsed:.0f} ms")
+        self._graph_dialog.show_report(summary, hotspots, cycle_rows)
+
+    def open_duplicate_finder(self):
+        if self._duplicate_dialog is None:
+            dialog = DuplicateFinderDialog(self)
+            dialog.find_requested.connect(self.find_duplicates)
+            dialog.options_changed.connect(self.on_duplicate_options_changed)
+            dialog.select_requested.connect(self.select_keys)
+            dialog.delete_requested.connect(self.delete_duplicates)
+            dialog.merge_requested.connect(self.merge_entries)
+            dialog.entry_activated.connect(self.jump_to_entry)
+            self._duplicate_dialog = dialog
+        self._duplicate_dialog.show()
+        self._duplicate_dialog.raise_()
+        self.find_duplicates()
+
+    def on_duplicate_options_changed(self):
+        # 简繁折叠会改变所有条目的切片，签名只能整体重算
+        self.discard_duplicate_finder()
+        self.find_duplicates()
+
+    def find_duplicates(self):
+        self.save_current_ui_to_memory()
+        self._duplicate_dialog.timer.stop()
+        if self.duplicate_build.result is None:
+            self.start_duplicate_build()
+        else:
+            self.show_duplicates()
+
+    def start_duplicate_build(self):
+        if self.duplicate_build.is_building(): return
+        fold_chinese = self._duplicate_dialog.chk_fold.isChecked()
+        self.duplicate_build.start(lambda: DuplicateFinder(fold_chinese), duplicate_snapshot(self.world_info_data))
+        self._duplicate_dialog.summary.setText("正在计算所有条目的签名...")
+        self._duplicate_dialog.set_progress(0, 1)
+
+    def discard_duplicate_finder(self):
+        # 换了文件或简繁选项后签名全部作废，查找窗口开着就重新计算
+        self.duplicate_build.discard()
+        if self._duplicate_dialog is not None and self._duplicate_dialog.isVisible():
+            self._duplicate_dialog.tree.clear()
+            self.start_duplicate_build()
+
+    def on_duplicate_progress(self, done, total):
+        self._duplicate_dialog.set_progress(done, total)
+
+    def on_duplicate_failed(self, message):
+        self._duplicate_dialog.set_progress(1, 1)
+        QMessageBox.critical(self._duplicate_dialog, "查找失败", f"计算条目签名时发生错误：\n{message}")
+
+    def show_duplicates(self):
+        finder = self.duplicate_build.result
+        started = time.perf_counter()
+        threshold = self._duplicate_dialog.threshold.value() / 100
+        rows = {key: row for row, key in enumerate(self.list_model.order)}
+        groups = []
+        for members in finder.clusters(threshold):
+            # 组内按列表顺序排列，第一条作为基准；相似度用切片集合精确计算
+            members = sorted(members, key=rows.__getitem__)
+            base = finder.shingles(self.world_info_data[members[0]])
+            groups.append([(key, entry_display_name(key, self.world_info_data[key]),
+                            shingle_similarity(base, finder.shingles(self.world_info_data[key])) if i else 1.0, rows[key])
+                           for i, key in enumerate(members)])
+        groups.sort(key=lambda group: (-len(group), group[0][3]))
+        elapsed = (time.perf_counter() - started) * 1000
+        count = sum(len(group) for group in groups)
+        summary = (f"{len(groups)} 组、共 {count} 个条目彼此相似 · 分组用时 {elapsed:.0f} ms" if groups
+                   else f"没有找到相似度不低于 {threshold:.0%} 的条目")
+        self._duplicate_dialog.show_groups(summary, groups)
+
+    def delete_duplicates(self, keys):
+        # 先在列表里选中，再走普通的批量删除 (确认、一步撤销)
+        if not keys: return
+        self.select_keys(keys)
+        self.delete_entry()
+
+    def merge_entries(self, groups):
+        """每组保留第一个条目，把其余条目的关键字和可选过滤器并入它 (去重、保持顺序)，再删除其余条目；整个合并只算一步撤销。"""
+        self.save_current_ui_to_memory()
+        groups = [[key for key in group if key in self.world_info_data] for group in groups]
+        groups = [group for group in groups if len(group) > 1]
+        if not groups: return
+        removed = [key for group in groups for key in group[1:]]
+        reply = QMessageBox.question(self, '确认', f'把 {len(removed)} 个条目的关键字并入 {len(groups)} 个保留的条目，并删除这些条目吗？',
+                                     QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        if reply != QMessageBox.Yes: return
+        for keep, *others in groups:
+            values = {}
+            for field in ("key", "keysecondary"):
+                merged = list(self.world_info_data[keep].get(field) or [])
+                for other in others:
+                    merged.extend(word for word in self.world_info_data[other].get(field) or [] if word not in merged)
+                if merged != list(self.world_info_data[keep].get(field) or []): values[field] = merged
+            if values: self.journal.set_fields(keep, values)
+        rows = sorted(((self.list_model.row_of(k), k) for k in removed), reverse=True)
+        self.list_model.remove_keys(removed)
+        for row, key in rows:
+            self.journal.remove(key, row)
+        for key in removed:
+            self._hidden_keys.discard(key)
+        if self.current_entry_key in removed:
+            self.current_entry_key = None
+            self.clear_form()
+        self.journal.commit()
+        if self.current_entry_key in (group[0] for group in groups): self.load_entry_to_form()
+        self.select_keys([group[0] for group in groups])
+
+    def toggle_budget_panel(self, visible):
+        self.settings.setValue("budget/visible", visible)
+        self.budget_panel.setVisible(visible)
+        if visible: self.refresh_token_budget()
+
+    def on_budget_tokenizer_changed(self, spec):
+        self.settings.setValue("budget/tokenizer", spec)
+        self.discard_token_budget()
+
+    def on_budget_limit_changed(self, limit):
+        self.settings.setValue("budget/limit", limit)
+        if self.budget_build.result is not None: self.show_token_budget()
+
+    def refresh_token_budget(self):
+        panel = self.budget_panel
+        panel.timer.stop()
+        if panel.isHidden(): return
+        if self.is_loading():
+            panel.summary.setText("文件读取完成后开始统计...")
+        elif self.budget_build.result is None:
+            self.start_budget_build()
+        else:
+            self.apply_budget_draft()
+            self.show_token_budget()
+
+    def start_budget_build(self):
+        if self.budget_build.is_building(): return
+        spec = self.budget_panel.spec
+        self.budget_build.start(lambda: TokenBudget(spec), budget_snapshot(self.world_info_data))
+        self.budget_panel.summary.setText("正在统计所有条目的 token 数...")
+        self.budget_panel.set_progress(0, 1)
+
+    def discard_token_budget(self):
+        # 换了文件或分词器后全部重新统计，面板开着就稍后在后台重建
+        self.budget_build.discard()
+        self._budget_draft = None
+        if not self.budget_panel.isHidden(): self.budget_panel.timer.start()
+
+    def apply_budget_draft(self):
+        # 表单里还没写回的修改先按草稿计入，打字时就能看到变化；切换条目或写回后以条目本身为准
+        key = self.current_entry_key
+        if key not in self.world_info_data or not self._edited_fields: return
+        draft = {f: self.world_info_data[key].get(f) for f in BUDGET_FIELDS}
+        draft.update(self.read_form(self._edited_fields))
+        self.budget_build.result.update(key, draft)
+        self._budget_draft = key
+
+    def drop_budget_draft(self):
+        key, self._budget_draft = self._budget_draft, None
+        if key is None or self.budget_build.result is None: return
+        entry = self.world_info_data.get(key)
+        if entry is not None: self.budget_build.result.update(key, entry)
+
+    def on_budget_failed(self, message):
+        self.budget_panel.set_progress(1, 1)
+        self.budget_panel.summary.setText("")
+        QMessageBox.critical(self, "统计失败", f"统计 token 数时发生错误：\n{message}")
+        if self.budget_panel.spec != "estimate":
+            # 选用的分词器用不了 (没装依赖或文件读不出来)，退回估算
+            self.budget_panel.set_tokenizer("estimate")
+            self.on_budget_tokenizer_changed("estimate")
+
+    def show_token_budget(self):
+        budget = self.budget_build.result
+        def total(kind, value=None): return budget.totals(kind).get(value, (0, 0))
+        count, tokens = total("all")
+        constant, conditional = total("constant", True), total("constant", False)
+        ignored, disabled = total("ignoreBudget"), total("disabled")
+        summary = (f"启用 {count:,} 个条目，共 {tokens:,} tokens\n"
+                   f"常驻 {constant[0]:,} 个 · {constant[1]:,}；条件触发 {conditional[0]:,} 个 · {conditional[1]:,}\n"
+                   f"不计预算 {ignored[0]:,} 个 · {ignored[1]:,}；已禁用 {disabled[0]:,} 个 · {disabled[1]:,}")
+        key = self.current_entry_key
+        current = f"当前条目：{budget.tokens(key):,} tokens" if key in self.world_info_data else ""
+        positions = [(POSITION_LABELS[p] if 0 <= p < len(POSITION_LABELS) else f"位置 {p}", n, t, None)
+                     for p, (n, t) in sorted(budget.totals("position").items())]
+        strategies = [("常驻", *constant, None), ("条件触发", *conditional, None)]
+        groups = [(g, n, t, f"同组条目每次只插入一条，组内最长的一条 {budget.group_peak(g):,} tokens")
+                  for g, (n, t) in sorted(budget.totals("group").items(), key=lambda item: -item[1][1])]
+        self.budget_panel.show_report(summary, current, constant[1],
+                                      [("按插入位置", positions), ("按生效方式", strategies), ("按分组", groups)])
+
+    def jump_to_entry(self, key):
+        row = self.list_model.row_of(key)
+        if row < 0: return  # 已被删除
+        if key in self._hidden_keys:
+            # 被搜索栏过滤掉的条目先清空搜索再跳转
+            self.search_bar.clear()
+            self.filter_list("")
+        self.list_view.setCurrentIndex(self.list_model.index(row))
+        self.select_keys([key])
+
+    def add_entry(self):
+        new_id = self.uid_allocator.allocate()
+
+        new_entry = WorldInfoEntry.new(uid=int(new_id))
+
+        row = self.list_model.rowCount()
+        self.journal.add(new_id, new_entry, row)
+        self.list_model.insert_key(row, new_id)
+        self.journal.commit()
+        index = self.list_model.index(row)
+        self.list_view.setCurrentIndex(index)
+        self.list_view.scrollTo(index)
+        self.on_item_clicked(index)
+
+    def delete_entry(self):
+        keys_to_del = self.selected_keys()
+        if not keys_to_del: 
+            return
+            
+        count = len(keys_to_del)
+        reply = QMessageBox.question(self, '确认', f'确定要删除选中的 {count} 个条目吗？', QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+        
+        if reply == QMessageBox.Yes:
+            # 按行号从后往前记录，撤销时倒序插回即可还原原来的位置
+            rows = sorted(((self.list_model.row_of(k), k) for k in keys_to_del if k in self.world_info_data), reverse=True)
+            self.list_model.remove_keys(keys_to_del)
+            for row, key in rows:
+                self.journal.remove(key, row)
+            for key in keys_to_del:
+                self._hidden_keys.discard(key)
+                    
+            if self.current_entry_key in keys_to_del:
+                self.current_entry_key = None
+                self.clear_form()
+                
+            self.journal.commit()
+
+    def clear_form(self):
+        self._filling_form = True
+        try:
+            for config in self.field_map.values(): config['clear']()
+        finally:
+            self._filling_form = False
+        self._form_values, self._edited_fields = {}, set()
+
+    def on_field_edited(self, json_key):
+        # 表单控件的改动信号：记下改过的字段，写回时只读取这些控件
+        if self._filling_form: return
+        self._edited_fields.add(json_key)
+        self.set_modified()
+        if not self.budget_panel.isHidden(): self.budget_panel.timer.start()
+
+    def read_form(self, fields=None):
+        # 按表单控件读出各字段的值；生效策略拆成 constant/vectorized/selective 三个字段
+        values = {}
+        for json_key in self.field_map if fields is None else fields:
+            values.update(self.field_map[json_key]['read']())
+        return values
+
+    def save_current_ui_to_memory(self):
+        if not self.current_entry_key or self.current_entry_key not in self.world_info_data: return
+        if not self._edited_fields: return
+        # 只读取动过的控件，并且只写回与载入时不同的字段，没动过的字段 (包括文件里原本缺省的字段) 保持原样
+        values = self.read_form(self._edited_fields)
+        self._edited_fields = set()
+        changed = {k: v for k, v in values.items() if k not in self._form_values or self._form_values[k] != v}
+        self._form_values.update(values)
+        if not changed: return
+        self.journal.set_fields(self.current_entry_key, changed)
+        self.journal.commit()
+
+    def on_entries_changed(self, changes):
+        # 改动日志的订阅者：只刷新这一组改动涉及的条目，列表只重绘显示文本变了的行
+        relabeled = {c.key for c in changes if c.field in ("comment", "key")}
+        fields = {}  # 条目 -> 改动的字段，新增或删除时为 None
+        for c in changes:
+            if c.kind == "move": continue
+            if c.kind != "set": fields[c.key] = None
+            elif fields.get(c.key, set()) is not None: fields.setdefault(c.key, set()).add(c.field)
+        for key in fields:
+            entry = self.world_info_data.get(key)
+            if entry is None:
+                self.search_index.remove(key)
+                self.activation_simulator.remove(key)
+            else:
+                self.search_index.update(key, entry)
+                self.activation_simulator.update(key, entry)
+                if key in relabeled: self.list_model.refresh_key(key)
+            self.graph_build.entry_changed(key, fields[key])
+            self.budget_build.entry_changed(key, fields[key])
+            self.duplicate_build.entry_changed(key, fields[key])
+            self.save_writer.invalidate(key)
+        self.set_modified()
+        if self._simulator_dialog is not None and self._simulator_dialog.isVisible():
+            self._simulator_dialog.timer.start()
+        if self._graph_dialog is not None and self._graph_dialog.isVisible() and self.graph_build.result is not None:
+            self._graph_dialog.timer.start()
+        if self._keyword_dialog is not None and self._keyword_dialog.isVisible():
+            self._keyword_dialog.timer.start()
+        if not self.budget_panel.isHidden(): self.budget_panel.timer.start()
+        if self._duplicate_dialog is not None and self._duplicate_dialog.isVisible() and self.duplicate_build.result is not None:
+            self._duplicate_dialog.timer.start()
+
+    def on_current_changed(self, current, previous):
+        # 点击和方向键切换当前行都会走到这里
+        if current.isValid(): self.on_item_clicked(current)
+
+    def on_item_clicked(self, index):
+        self.save_current_ui_to_memory()
+        key = index.data(Qt.UserRole)
+        if key == self.current_entry_key: return
+        self.current_entry_key = key
+        self.load_entry_to_form()
+
+    def load_entry_to_form(self, fields=None):
+        # fields 为空时载入整张表单；延迟构建的标签页建好后只载入它自己的字段
+        entry_data = self.world_info_data[self.current_entry_key]
+        values = {}
+        self._filling_form = True
+        try:
+            for json_key in self.field_map if fields is None else fields:
+                values.update(self.field_map[json_key]['write'](entry_data))
+        finally:
+            self._filling_form = False
+        if fields is None:
+            self._form_values, self._edited_fields = values, set()
+            self.drop_budget_draft()
+        else: self._form_values.update(values)
+        self.update_position_ui()
+        self.update_recursion_ui()
+
+    def save_file(self, wait=False):
+        if not self.current_file_path:
+            return self.save_as_file(wait)
+            
+        if self.is_loading():
+            QMessageBox.warning(self, "提示", "文件仍在读取中，请等待读取完成后再保存。")
+            return False
+
+        self.wait_for_save()
+        self.save_current_ui_to_memory()
+        # 界面线程只取快照，序列化和写盘交给线程池；之后的改动会重新把文档标记为已修改
+        clock, layout = self.save_writer.snapshot(self.build_save_data())
+        self._save_revision = self.journal.revision
+        self._save_generation += 1
+        task = SaveTask(self._save_generation, self.current_file_path, clock, layout)
+        task.signals.finished.connect(self.on_save_finished)
+        self._save_task = task
+        self.is_modified = False
+        self.statusBar().showMessage(f"正在保存 {self.current_file_path} ...")
+        QThreadPool.globalInstance().start(task)
+        if not wait: return True
+        return self.wait_for_save()
+
+    def is_saving(self):
+        return self._save_task is not None
+
+    def wait_for_save(self, notify=False):
+        # 阻塞到当前的保存完成 (退出程序或连续保存时使用)，返回这次保存是否成功
+        task = self._save_task
+        if task is None: return True
+        task.done.wait()
+        return self.on_save_finished(task.generation, notify)
+
+    def on_save_finished(self, generation, notify=True):
+        # 只有用户手动保存且没有被等待时才弹成功提示，其余情况 (退出前保存、连续保存) 只看状态栏
+        task = self._save_task
+        if task is None or task.generation != generation: return False
+        self._save_task = None
+        self.statusBar().clearMessage()
+        if task.error is not None:
+            self.set_modified()
+            QMessageBox.critical(self, "保存失败", f"错误信息:\n{task.error}")
+            return False
+        self.save_writer.remember(task.clock, task.fragments)
+        self.journal.mark_saved(self._save_revision)
+        if task.path == self.current_file_path:
+            self.setWindowTitle(f"SillyTavern 世界书编辑器 - {self.current_file_path}" + (" *" if self.is_modified else ""))
+        self.statusBar().showMessage(f"已保存 {task.path}", 5000)
+        if notify: QMessageBox.information(self, "成功", "世界书文件已成功保存！")
+        return True
+
+    def save_as_file(self, wait=False):
+        file_path, _ = QFileDialog.getSaveFileName(self, "另存为", "", "JSON Files (*.json)")
+        if file_path:
+            self.current_file_path = file_path
+            return self.save_file(wait)
+        return False
+
+    def check_unsaved_changes(self):
+        if not self.is_modified: return True
+        
+        msg_box = QMessageBox(self)
+        msg_box.setWindowTitle("未保存的更改")
+        msg_box.setText("您有未保存的更改。请问要如何处理？")
+        btn_save = msg_box.addButton("保存并退出", QMessageBox.AcceptRole)
+        btn_save_as = msg_box.addButton("另存为...", QMessageBox.AcceptRole)
+        btn_discard = msg_box.addButton("直接退出", QMessageBox.DestructiveRole)
+        btn_cancel = msg_box.addButton("取消", QMessageBox.RejectRole)
+        
+        msg_box.exec()
+        
+        if msg_box.clickedButton() == btn_save: return self.save_file(wait=True)
+        elif msg_box.clickedButton() == btn_save_as: return self.save_as_file(wait=True)
+        elif msg_box.clickedButton() == btn_discard: return True
+        else: return False
+
+    def closeEvent(self, event: QCloseEvent):
+        self.wait_for_save()
+        if self.check_unsaved_changes():
+            try: conversion_cache.save()
+            except OSError: pass  # 缓存写不进去不影响退出
+            event.accept()
+        else: event.ignore()
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # 打包成 exe 后进程池的子进程需要
+    startup = StartupTimer(STARTUP_STARTED) if "--startup-timing" in sys.argv else None
+    if startup: startup.mark("导入模块")
+    app = QApplication(sys.argv)
+    if startup: startup.mark("QApplication")
+    window = MainWindow()
+    if startup: startup.mark("构建主窗口")
+    window.show()
+    if startup:
+        startup.mark("显示窗口")
+        # 事件循环处理完第一批绘制事件后才算真正启动完成
+        QTimer.singleShot(0, lambda: (startup.mark("首次绘制"), startup.report()))
+    sys.exit(app.exec())
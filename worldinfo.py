@@ -0,0 +1,2442 @@
+"""SillyTavern 世界书核心模块：条目记录、读写、检索、改动日志、简繁转换与触发模拟，不依赖 PySide6。
+既供 main.py 的编辑器界面使用，也可以单独在脚本里导入，或者用 python -m worldinfo 在命令行批量处理世界书。"""
+import sys
+import argparse
+import bisect
+import codecs
+import hashlib
+import heapq
+import json
+import mmap
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+
+# ================= 条目记录 (固定字段存进 __slots__ 槽位，未知字段放进附加字典) =================
+# 新建条目时写入的默认值；这些字段 (即表单 field_map 覆盖的字段) 就是条目记录的固定字段
+ENTRY_DEFAULTS = {
+    "uid": 0, "key": [], "keysecondary": [], "comment": "新条目", "content": "",
+    "constant": False, "vectorized": False, "selective": True, "selectiveLogic": 0,
+    "addMemo": True, "order": 100, "position": 0, "disable": False, "ignoreBudget": False, 
+    "excludeRecursion": False, "preventRecursion": False, "delayUntilRecursion": False, "recursionLevel": 0,
+    "matchPersonaDescription": False, "matchCharacterDescription": False, "matchCharacterPersonality": False, 
+    "matchCharacterDepthPrompt": False, "matchScenario": False, "matchCreatorNotes": False, 
+    "probability": 100, "useProbability": True,
+    "depth": 4, "outletName": "", "group": "", "groupOverride": False, "groupWeight": 100, "useGroupScoring": None, 
+    "scanDepth": None, "automationId": "", "role": 0, "sticky": 0, "cooldown": 0, "delay": 0,
+    "characterFilter": [], "characterFilterExclude": False, "triggers": [],
+    "caseSensitive": None, "matchWholeWords": None 
+}
+
+class WorldInfoEntry(MutableMapping):
+    """世界书条目，用法与 dict 相同。
+    固定字段存在槽位里 (没有的字段槽位留空)，文件里其他字段放进 _extra；
+    _order 记录字段在文件里的先后顺序，写回时按原顺序输出，相同的顺序在所有条目间共用一个元组。"""
+    FIELDS = tuple(ENTRY_DEFAULTS)
+    __slots__ = FIELDS + ("_order", "_extra")
+    _FIELD_SET = frozenset(FIELDS)
+    _ORDERS = {}
+
+    def __init__(self, data=()):
+        self._order = ()
+        self._extra = None
+        for k, v in dict(data).items(): self[k] = v
+
+    @classmethod
+    def from_dict(cls, data):
+        entry = cls.__new__(cls)
+        extra = None
+        for k, v in data.items():
+            if k in cls._FIELD_SET:
+                setattr(entry, k, v)
+            else:
+                if extra is None: extra = {}
+                extra[k] = v
+        entry._extra = extra
+        entry._order = cls._ORDERS.setdefault(tuple(data), tuple(data))
+        return entry
+
+    @classmethod
+    def new(cls, **fields):
+        # 按默认值新建条目；列表字段每次都新建，避免条目之间共用同一个列表
+        data = {k: list(v) if isinstance(v, list) else v for k, v in ENTRY_DEFAULTS.items()}
+        data.update(fields)
+        return cls.from_dict(data)
+
+    def __getitem__(self, key):
+        if key in self._FIELD_SET:
+            try: return getattr(self, key)
+            except AttributeError: raise KeyError(key) from None
+        if self._extra is None: raise KeyError(key)
+        return self._extra[key]
+
+    def get(self, key, default=None):
+        if key in self._FIELD_SET: return getattr(self, key, default)
+        return self._extra.get(key, default) if self._extra else default
+
+    def __setitem__(self, key, value):
+        if key in self._FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self._extra is None: self._extra = {}
+            self._extra[key] = value
+        if key not in self._order:
+            order = self._order + (key,)
+            self._order = self._ORDERS.setdefault(order, order)
+
+    def __delitem__(self, key):
+        if key not in self._order: raise KeyError(key)
+        if key in self._FIELD_SET: delattr(self, key)
+        else: del self._extra[key]
+        order = tuple(k for k in self._order if k != key)
+        self._order = self._ORDERS.setdefault(order, order)
+
+    def __contains__(self, key):
+        return key in self._order
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __repr__(self):
+        return f"WorldInfoEntry({self.to_dict()!r})"
+
+    def copy(self):
+        # 结构复制：列表/字典逐层复制，字符串、数值和未读入的正文直接共用
+        return WorldInfoEntry.from_dict({k: copy_json(v) for k, v in self.to_dict().items()})
+
+    def to_dict(self):
+        extra = self._extra or {}
+        return {k: extra[k] if k in extra else getattr(self, k) for k in self._order}
+
+def copy_json(value):
+    if isinstance(value, list): return [copy_json(v) for v in value]
+    if isinstance(value, dict): return {k: copy_json(v) for k, v in value.items()}
+    return value
+
+def entry_display_name(key, entry):
+    display_name = entry.get("comment", "")
+    if not display_name:
+        keys = entry.get("key", [])
+        display_name = ", ".join(keys) if keys else f"未命名条目 {key}"
+    return display_name
+
+# ================= 条目正文按需读取 (大文件只在内存里保留正文在文件里的位置) =================
+LAZY_CONTENT_MIN_BYTES = 32 * 1024 * 1024  # 文件达到这个大小才启用正文按需读取
+
+class LazyContent:
+    """条目正文的占位对象，只记录正文 JSON 字符串 (含引号) 在文件副本里的字节范围。"""
+    __slots__ = ("store", "start", "end")
+
+    def __init__(self, store, start, end):
+        self.store = store
+        self.start = start
+        self.end = end
+
+    def load(self, cache=True):
+        return self.store.read(self.start, self.end, cache)
+
+def field_snapshots(entries, keys, fields):
+    # 在界面线程取出要交给后台处理的字段快照 [(条目ID, {字段: 值})]；关键词字段统一成列表，其余字段统一成字符串
+    items = []
+    for key in keys:
+        entry = entries[key]
+        items.append((key, {f: list(entry.get(f) or []) if f in ("key", "keysecondary") else entry.get(f) or "" for f in fields}))
+    return items
+
+def load_snapshots(items):
+    # 在后台线程里把快照中尚未读入的正文读出来 (不放进正文缓存)
+    return [(key, {f: v.load(cache=False) if isinstance(v, LazyContent) else v for f, v in fields.items()})
+            for key, fields in items]
+
+def json_default(obj):
+    # 供 json.dump(default=...) 使用：条目记录按原字段顺序转成字典，尚未读入的正文解码后写出
+    if isinstance(obj, WorldInfoEntry):
+        return obj.to_dict()
+    if isinstance(obj, LazyContent):
+        return obj.load(cache=False)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class ContentStore:
+    """以只读内存映射打开源文件的备份副本，按需解码条目正文，并缓存最近打开过的正文。"""
+    CACHE_SIZE = 64
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+        # 纯 ASCII 文件说明非 ASCII 字符都被写成了 \uXXXX 转义，检索时要按转义形式匹配
+        self.ascii_escaped = re.search(rb'[\x80-\xff]', self._mm) is None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, start, end, cache=True):
+        with self._lock:
+            text = self._cache.get(start)
+            if text is not None:
+                self._cache.move_to_end(start)
+                return text
+        text = json.loads(self._mm[start:end])
+        if cache:
+            with self._lock:
+                self._cache[start] = text
+                while len(self._cache) > self.CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return text
+
+    def literal_pattern(self, text):
+        """把 (已 casefold 的) 检索词编译成能直接在文件原始字节上匹配其 JSON 转义形式的正则。
+
+        结果只用于预筛选：可能多出少量候选 (例如跨越转义序列的匹配)，调用方需要解码正文后再确认。
+        """
+        ensure_ascii = self.ascii_escaped
+        parts = []
+        for ch in text:
+            variants = {ch, ch.upper(), ch.lower(), ch.title()}
+            if ch == "/": variants.add("\\/")
+            encoded = set()
+            for v in variants:
+                literal = v if v == "\\/" else json.dumps(v, ensure_ascii=ensure_ascii)[1:-1]
+                encoded.add(re.escape(literal.encode("utf-8")))
+            parts.append(encoded.pop() if len(encoded) == 1 else b"(?:" + b"|".join(sorted(encoded)) + b")")
+        return re.compile(b"".join(parts), re.IGNORECASE)
+
+    def find_spans(self, pattern, spans):
+        """spans 为按起点排序的 [(start, end, key)...]；返回原始字节命中 pattern 的那些 key。"""
+        starts = [s for s, _, _ in spans]
+        hits, pos, mm = [], 0, self._mm
+        m = pattern.search(mm, pos)
+        while m:
+            i = bisect.bisect_right(starts, m.start()) - 1
+            if i >= 0 and m.end() <= spans[i][1]:
+                hits.append(spans[i][2])
+                pos = spans[i][1]               # 这个条目已命中，直接跳到它的结尾
+            elif i >= 0 and m.start() < spans[i][1]:
+                pos = m.start() + 1             # 跨出了正文范围，从下一个字节重新找
+            elif i + 1 < len(starts):
+                pos = starts[i + 1]             # 命中落在正文之外，跳到下一段正文
+            else:
+                break
+            m = pattern.search(mm, pos)
+        return hits
+
+# ================= 世界书流式读取 (条目逐条解析，不需要一次性载入整个 JSON) =================
+def _parse_json_string(s, pos):
+    if s[pos:pos + 1] != '"':
+        raise json.JSONDecodeError("Expecting property name enclosed in double quotes", s, pos)
+    return json.decoder.scanstring(s, pos + 1)
+
+class LorebookStreamReader:
+    """按块读取世界书文件，entries 里的条目一条一条地产出。
+
+    entries 以外的顶层字段保存在 extras 里，top_level_keys 记录它们 (包括 entries) 的原始顺序，
+    保存时据此原样写回。传入 content_store 时，条目的 content 会被替换成指向该文件副本的 LazyContent。
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    # 条目对象里 "content" 键后紧跟的字符串；前面是反斜杠说明它只是别的字符串里的文字
+    CONTENT_KEY = re.compile(r'(?<!\\)"content"[ \t\n\r]*:[ \t\n\r]*"')
+
+    def __init__(self, path, chunk_size=1 << 20, content_store=None):
+        self.path = path
+        self.content_store = content_store
+        self.chunk_size = chunk_size
+        self.total_bytes = os.path.getsize(path)
+        self.bytes_read = 0
+        self.extras = {}
+        self.top_level_keys = []
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._file = None
+        self._buf = ""
+        self._pos = 0
+        self._base = 0  # 已经从缓冲区丢弃的字符数，用于报告错误位置
+        self._eof = False
+        self._value_start = 0
+        # 缓冲区里某个字符位置与文件字节偏移的对应关系，只向前推进，整个文件只编码一遍
+        self._cursor_char = 0
+        self._cursor_byte = 0
+
+    def _fill(self, size=None):
+        """把下一块内容接到缓冲区末尾，已到文件末尾时返回 False。"""
+        if self._eof: return False
+        if self._pos:
+            if self.content_store is not None:
+                self._byte_offset(self._pos)
+                self._cursor_char -= self._pos
+            self._buf = self._buf[self._pos:]
+            self._base += self._pos
+            self._pos = 0
+        data = self._file.read(size or self.chunk_size)
+        self.bytes_read += len(data)
+        if not data:
+            self._eof = True
+            self._buf += self._text_decoder.decode(b"", final=True)
+            return False
+        self._buf += self._text_decoder.decode(data)
+        return True
+
+    def _byte_offset(self, char_pos):
+        if char_pos > self._cursor_char:
+            self._cursor_byte += len(self._buf[self._cursor_char:char_pos].encode("utf-8"))
+            self._cursor_char = char_pos
+        return self._cursor_byte
+
+    def _attach_lazy_content(self, entry, start, end):
+        content = entry.get("content") if isinstance(entry, dict) else None
+        if not isinstance(content, str): return
+        m = self.CONTENT_KEY.search(self._buf, start, end)
+        while m:
+            literal_start = m.end() - 1
+            text, literal_end = json.decoder.scanstring(self._buf, m.end())
+            # 解码结果和条目里的正文一致才认定找对了位置，否则保留原字符串
+            if text == content:
+                entry["content"] = LazyContent(self.content_store, self._byte_offset(literal_start), self._byte_offset(literal_end))
+                return
+            m = self.CONTENT_KEY.search(self._buf, literal_end, end)
+
+    def _skip_ws(self):
+        while True:
+            self._pos = self.WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf) or not self._fill(): return
+
+    def _next_char(self):
+        self._skip_ws()
+        if self._pos >= len(self._buf):
+            raise json.JSONDecodeError("Unexpected end of file", self._buf, self._pos)
+        ch = self._buf[self._pos]
+        self._pos += 1
+        return ch
+
+    def _peek_char(self):
+        self._skip_ws()
+        return self._buf[self._pos:self._pos + 1]
+
+    def _read_value(self, parse):
+        self._skip_ws()
+        while True:
+            try:
+                value, end = parse(self._buf, self._pos)
+                # 值恰好结束在缓冲区末尾时 (例如数字) 可能还没读完，继续读一块再解析
+                if end < len(self._buf) or self._eof:
+                    self._value_start, self._pos = self._pos, end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof: raise
+            # 单个值比一块还大时按缓冲区大小倍增读取，避免反复从头解析
+            self._fill(max(self.chunk_size, len(self._buf) - self._pos))
+
+    def _iter_members(self):
+        if self._peek_char() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._read_value(_parse_json_string)
+            if self._next_char() != ":":
+                raise json.JSONDecodeError("Expecting ':' delimiter", self._buf, self._pos - 1)
+            yield key
+            sep = self._next_char()
+            if sep == "}": return
+            if sep != ",":
+                raise json.JSONDecodeError("Expecting ',' delimiter", self._buf, self._pos - 1)
+
+    def entries(self):
+        """逐条产出 (key, entry)。"""
+        try:
+            yield from self._entries()
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON 格式错误 ({e.msg})，位于第 {self._base + e.pos + 1} 个字符附近") from None
+
+    def _entries(self):
+        with open(self.path, "rb") as self._file:
+            if self._file.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8:
+                self._cursor_byte = len(codecs.BOM_UTF8)
+            else:
+                self._file.seek(0)
+            if self._next_char() != "{":
+                raise ValueError("世界书文件的顶层必须是 JSON 对象")
+            for top_key in self._iter_members():
+                self.top_level_keys.append(top_key)
+                if top_key != "entries":
+                    self.extras[top_key] = self._read_value(self._decoder.raw_decode)
+                elif self._peek_char() == "{":
+                    self._pos += 1
+                    for key in self._iter_members():
+                        entry = self._read_value(self._decoder.raw_decode)
+                        if self.content_store is not None:
+                            self._attach_lazy_content(entry, self._value_start, self._pos)
+                        yield key, WorldInfoEntry.from_dict(entry) if isinstance(entry, dict) else entry
+                else:
+                    raise ValueError("entries 字段必须是 JSON 对象")
+            if self._peek_char():
+                raise json.JSONDecodeError("Extra data", self._buf, self._pos)
+
+# ================= 全局检索索引 (缓存每个条目的小写检索文本，按条目增量更新) =================
+# 组成全局检索文本的字段，顺序即拼接顺序；字段检索时按偏移量直接在检索文本里切片匹配
+SEARCH_TEXT_FIELDS = ("comment", "key", "keysecondary", "content")
+# 其余可以用 "字段:值" 检索的字段，与表单 field_map 的 json_key 同名；列按需建立
+SEARCH_COLUMN_TEXT_FIELDS = ("automationId", "outletName", "group", "characterFilter", "triggers")
+SEARCH_COLUMN_SCALAR_FIELDS = (
+    "uid", "selectiveLogic", "disable", "strategy", "constant", "vectorized", "order", "position", "depth", "role",
+    "scanDepth", "probability", "caseSensitive", "matchWholeWords", "groupWeight", "groupOverride", "useGroupScoring",
+    "characterFilterExclude", "sticky", "cooldown", "delay", "excludeRecursion", "ignoreBudget", "preventRecursion",
+    "delayUntilRecursion", "recursionLevel", "matchCharacterDescription", "matchCharacterDepthPrompt",
+    "matchCharacterPersonality", "matchScenario", "matchPersonaDescription", "matchCreatorNotes",
+)
+SEARCH_FIELDS = SEARCH_TEXT_FIELDS + SEARCH_COLUMN_TEXT_FIELDS + SEARCH_COLUMN_SCALAR_FIELDS
+# 形如 -key:"值"、content:/正则/、order:>=100 的查询片段
+QUERY_TOKEN_RE = re.compile(r'(-?)(?:([A-Za-z_]+):(>=|<=|>|<|=)?)?("(?:[^"\\]|\\.)*"|/(?:[^/\\]|\\.)+/|\S+)')
+
+def search_field_value(entry, field):
+    if field == "strategy":
+        return 1 if entry.get("constant") else 2 if entry.get("vectorized") else 0
+    val = entry.get(field)
+    if isinstance(val, list):
+        return ", ".join(str(v) for v in val).casefold()
+    if isinstance(val, str):
+        return val.casefold()
+    return val
+
+def parse_query_scalar(text):
+    low = text.lower()
+    if low == "true": return True
+    if low == "false": return False
+    if low in ("null", "none"): return None
+    try:
+        return int(text)
+    except ValueError:
+        return text.casefold()
+
+class SearchQuery:
+    """编译后的检索条件。plain 不为 None 时就是普通的子串检索 (兼容旧行为，并支持增量筛选)。"""
+    def __init__(self, index, text, plain, terms):
+        self.text = text
+        self.plain = plain
+        self._index = index
+        self._terms = terms
+        self._lazy_candidates = None
+
+    def prefilter(self):
+        # 正文未读入内存的条目先在文件原始字节上整体扫一遍，只解码可能命中的那些 (在工作线程里调用)
+        if self.plain:
+            self._lazy_candidates = self._index.lazy_candidates(self.plain)
+
+    def matches(self, key, haystack):
+        if self.plain is not None:
+            if self.plain in haystack: return True
+            lazy = self._lazy_candidates
+            return (lazy is None or key in lazy) and self._index.lazy_contains(key, self.plain)
+        for term in self._terms:
+            if not term(key, haystack):
+                return False
+        return True
+
+class EntrySearchIndex:
+    # 字段之间用 \0 分隔，查询词里不会出现 \0，保证匹配不会跨字段
+    FIELD_SEP = "\0"
+
+    def __init__(self):
+        self._entries = {}
+        self._haystacks = {}
+        self._bounds = {}   # key -> 各字段在检索文本里的 (起点, 终点)
+        self._columns = {}  # 字段名 -> {key: 值}，第一次用到该字段时才建立
+        self._lazy = {}     # 正文仍是 LazyContent 的条目，正文不进检索文本
+        self._lazy_spans = (None, {})
+        self._last_query = None
+        self._last_hits = None
+        self._revision = 0  # 每次增删改都会递增，用来判断后台检索结果是否已经过期
+
+    @classmethod
+    def build_haystack(cls, entry):
+        parts = (
+            entry.get("comment", "") or "",
+            ", ".join(entry.get("key", []) or []),
+            ", ".join(entry.get("keysecondary", []) or []),
+            "" if isinstance(entry.get("content"), LazyContent) else entry.get("content", "") or "",
+        )
+        # 逐段 casefold 再拼接，这样才能拿到每个字段在检索文本里的准确偏移
+        parts = [p.casefold() for p in parts]
+        bounds, pos = [], 0
+        for p in parts:
+            bounds.append((pos, pos + len(p)))
+            pos += len(p) + 1
+        return cls.FIELD_SEP.join(parts), tuple(bounds)
+
+    def rebuild(self, entries):
+        self._entries = entries
+        self._haystacks, self._bounds, self._lazy = {}, {}, {}
+        for k, e in entries.items():
+            self._haystacks[k], self._bounds[k] = self.build_haystack(e)
+            if isinstance(e.get("content"), LazyContent): self._lazy[k] = e["content"]
+        self._columns = {}
+        self._last_query = self._last_hits = None
+        self._revision += 1
+
+    def update(self, key, entry):
+        haystack, self._bounds[key] = self.build_haystack(entry)
+        self._haystacks[key] = haystack
+        if isinstance(entry.get("content"), LazyContent): self._lazy[key] = entry["content"]
+        else: self._lazy.pop(key, None)
+        for field, column in self._columns.items():
+            column[key] = search_field_value(entry, field)
+        self._revision += 1
+        if self._last_hits is not None:
+            if self._last_query in haystack or self.lazy_contains(key, self._last_query): self._last_hits.add(key)
+            else: self._last_hits.discard(key)
+
+    def remove(self, key):
+        self._haystacks.pop(key, None)
+        self._bounds.pop(key, None)
+        self._lazy.pop(key, None)
+        for column in self._columns.values():
+            column.pop(key, None)
+        self._revision += 1
+        if self._last_hits is not None:
+            self._last_hits.discard(key)
+
+    def lazy_text(self, key):
+        content = self._lazy.get(key)
+        return content.load(cache=False).casefold() if content is not None else ""
+
+    def lazy_contains(self, key, needle):
+        return key in self._lazy and needle in self.lazy_text(key)
+
+    def lazy_candidates(self, needle):
+        """在文件副本的原始字节上一次性扫描所有未读入的正文，返回可能包含 needle 的 key 集合。"""
+        if not self._lazy: return frozenset()
+        revision, spans = self._lazy_spans
+        if revision != self._revision:
+            spans = {}
+            for key, content in list(self._lazy.items()):
+                spans.setdefault(content.store, []).append((content.start, content.end, key))
+            for store_spans in spans.values():
+                store_spans.sort()
+            self._lazy_spans = (self._revision, spans)
+        hits = set()
+        for store, store_spans in spans.items():
+            hits.update(store.find_spans(store.literal_pattern(needle), store_spans))
+        return hits
+
+    def column(self, field):
+        if field not in self._columns:
+            self._columns[field] = {k: search_field_value(e, field) for k, e in self._entries.items()}
+        return self._columns[field]
+
+    def compile(self, text):
+        """把查询文本编译成 SearchQuery，每个查询只编译一次。
+
+        支持 字段:值 (子串)、字段:"带 空格"、字段:/正则/、数值字段的 > < >= <= 比较、
+        布尔/空值 (true/false/null)，以及前缀 - 取反。不带任何字段或正则的查询按整句子串处理。
+        """
+        tokens = QUERY_TOKEN_RE.findall(text)
+        fielded = any(field in SEARCH_FIELDS or (len(value) > 2 and value.startswith("/") and value.endswith("/"))
+                      for _, field, _, value in tokens)
+        if not fielded:
+            return SearchQuery(self, text, text.casefold(), ())
+
+        terms = []
+        for negate, field, op, value in tokens:
+            if field and field not in SEARCH_FIELDS:
+                value, field, op = f"{field}:{op}{value}", "", ""  # 未知字段，整体当普通文本
+            cost, term = self._compile_term(field, op, value)
+            if negate:
+                term = (lambda t: lambda k, h: not t(k, h))(term)
+            terms.append((cost, term))
+        # 先判断便宜的列比较，最后才扫正文，多数条目在前几项就被排除
+        terms.sort(key=lambda t: t[0])
+        return SearchQuery(self, text, None, tuple(term for _, term in terms))
+
+    def _compile_term(self, field, op, value):
+        is_regex = len(value) > 2 and value.startswith("/") and value.endswith("/")
+        if is_regex:
+            try:
+                pattern = re.compile(value[1:-1], re.IGNORECASE)
+            except re.error:
+                pattern = re.compile(re.escape(value.casefold()))
+            test = lambda s, start=0, end=None: pattern.search(s, start, len(s) if end is None else end) is not None
+        else:
+            if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+                value = re.sub(r'\\(.)', r'\1', value[1:-1])
+            needle = value.casefold()
+            test = lambda s, start=0, end=None: s.find(needle, start, len(s) if end is None else end) >= 0
+
+        lazy = self._lazy
+        if not field:
+            return 3 + is_regex, lambda k, h: test(h) or (k in lazy and test(self.lazy_text(k)))
+        if field == "content":
+            i = SEARCH_TEXT_FIELDS.index(field)
+            bounds = self._bounds
+            return 3 + is_regex, lambda k, h: test(self.lazy_text(k)) if k in lazy else test(h, *bounds[k][i])
+        if field in SEARCH_TEXT_FIELDS:
+            i = SEARCH_TEXT_FIELDS.index(field)
+            bounds = self._bounds
+            return 2 + is_regex, lambda k, h: test(h, *bounds[k][i])
+
+        column = self.column(field)
+        if field in SEARCH_COLUMN_TEXT_FIELDS:
+            if op == "=":
+                return 0, lambda k, h: (column.get(k) or "") == value.casefold()
+            return 1 + is_regex, lambda k, h: test(column.get(k) or "")
+        target = parse_query_scalar(value)
+        if op in (">", "<", ">=", "<="):
+            if type(target) is not int:
+                return 0, lambda k, h: False
+            compare = {">": int.__gt__, "<": int.__lt__, ">=": int.__ge__, "<=": int.__le__}[op]
+            return 0, lambda k, h: type(column.get(k)) is int and compare(column.get(k), target)
+        return 0, lambda k, h: column.get(k) == target
+
+    def prepare(self, text):
+        """返回 (SearchQuery, [(key, haystack)...], revision)。普通子串查询是上次查询的延伸时，候选只取上次的结果。"""
+        query = self.compile(text)
+        haystacks = self._haystacks
+        if query.plain and self._last_query and self._last_query in query.plain:
+            candidates = [(k, haystacks[k]) for k in self._last_hits]
+        else:
+            candidates = list(haystacks.items())
+        return query, candidates, self._revision
+
+    def remember(self, query, hits, revision):
+        # 只有在检索期间索引没有被修改过，结果才能作为下一次增量筛选的基础
+        if query and revision == self._revision:
+            self._last_query, self._last_hits = query, set(hits)
+
+    def search(self, text):
+        query, candidates, revision = self.prepare(text)
+        query.prefilter()
+        hits = {k for k, h in candidates if query.matches(k, h)}
+        self.remember(query.plain, hits, revision)
+        return hits
+
+# ================= 改动日志 (记录哪个条目的哪些字段改了，供检索索引、保存缓存、撤销使用) =================
+FIELD_MISSING = object()  # 字段原本不存在时 EntryChange.old 的取值
+
+class EntryChange:
+    """一条改动记录。kind 为 set (改字段) / add (新增条目) / remove (删除条目) / move (调整顺序)。
+    set 的 old/new 是字段新旧值；add/remove 的 new/old 是条目本身，row 是它所在的行；move 的 old/new 是前后行号。"""
+    __slots__ = ("kind", "key", "field", "old", "new", "row")
+
+    def __init__(self, kind, key, field=None, old=None, new=None, row=None):
+        self.kind = kind
+        self.key = key
+        self.field = field
+        self.old = old
+        self.new = new
+        self.row = row
+
+    def inverse(self):
+        if self.kind == "set": return EntryChange("set", self.key, self.field, self.new, self.old)
+        if self.kind == "move": return EntryChange("move", self.key, old=self.new, new=self.old)
+        kind = "remove" if self.kind == "add" else "add"
+        return EntryChange(kind, self.key, old=self.new, new=self.old, row=self.row)
+
+class ChangeJournal:
+    """条目级改动日志，所有对条目的修改都经由这里完成。
+    改动先暂存，commit() 时作为一组交给订阅者；
+    dirty 记录上次读取/保存之后改过的条目 ID -> 字段集合 (新增、删除、移动记为 "*")。"""
+
+    def __init__(self):
+        self.entries = {}
+        self.dirty = {}
+        self.revision = 0
+        self._pending = []
+        self._changed_at = {}
+        self._listeners = []
+
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def reset(self, entries):
+        # 读取或新建文件后调用，之前的改动全部作废
+        self.entries = entries
+        self.dirty.clear()
+        self._pending = []
+        self._changed_at.clear()
+
+    def set_fields(self, key, values):
+        entry = self.entries[key]
+        for field, value in values.items():
+            old = entry.get(field, FIELD_MISSING)
+            if old is value or (type(old) is type(value) and old == value): continue
+            if value is FIELD_MISSING: del entry[field]
+            else: entry[field] = value
+            self._record(EntryChange("set", key, field, old, value))
+
+    def add(self, key, entry, row):
+        self.entries[key] = entry
+        self._record(EntryChange("add", key, new=entry, row=row))
+
+    def remove(self, key, row):
+        self._record(EntryChange("remove", key, old=self.entries.pop(key), row=row))
+
+    def move(self, key, src, dst):
+        self._record(EntryChange("move", key, old=src, new=dst))
+
+    def _record(self, change):
+        self.revision += 1
+        self._pending.append(change)
+        self.dirty.setdefault(change.key, set()).add(change.field or "*")
+        self._changed_at[change.key] = self.revision
+
+    def commit(self):
+        if not self._pending: return []
+        group, self._pending = self._pending, []
+        for listener in self._listeners: listener(group)
+        return group
+
+    def mark_saved(self, revision):
+        # 保存成功后清掉快照之前的脏标记；保存期间又改过的条目仍然算脏
+        for key in [k for k, r in self._changed_at.items() if r <= revision]:
+            del self._changed_at[key]
+            self.dirty.pop(key, None)
+
+UNDO_LIMIT = 100  # 最多可撤销的步数
+
+class UndoStack:
+    """撤销/重做栈。每一步就是改动日志里提交的一组改动，只保存差异而不是整本世界书的快照；
+    撤销时倒序应用每条改动的逆操作，开销与这一步改动的大小成正比。"""
+
+    def __init__(self, journal, limit=UNDO_LIMIT):
+        self.journal = journal
+        self._undo = deque(maxlen=limit)
+        self._redo = []
+        self._replaying = False
+        journal.subscribe(self._on_commit)
+
+    def _on_commit(self, changes):
+        if self._replaying: return
+        self._undo.append(changes)
+        self._redo.clear()
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+
+    def can_undo(self): return bool(self._undo)
+    def can_redo(self): return bool(self._redo)
+
+    def undo(self, apply):
+        # apply(change) 负责真正执行一条改动 (同时更新条目和列表)
+        if not self._undo: return []
+        changes = self._undo.pop()
+        self._replay([c.inverse() for c in reversed(changes)], apply)
+        self._redo.append(changes)
+        return changes
+
+    def redo(self, apply):
+        if not self._redo: return []
+        changes = self._redo.pop()
+        self._replay(changes, apply)
+        self._undo.append(changes)
+        return changes
+
+    def _replay(self, changes, apply):
+        self._replaying = True
+        try:
+            for change in changes: apply(change)
+            self.journal.commit()
+        finally:
+            self._replaying = False
+
+# ================= 条目 ID 分配 (读取时扫描一次，之后随增删维护) =================
+class UidAllocator:
+    """分配新条目的 ID。优先复用删除后空出的最小 ID，没有空位时用最大 ID + 1，每次分配 O(log n)。
+    只有纯数字 (ASCII) 的 ID 参与分配，其他 ID 保持原样，也不会与分配出的 ID 冲突。"""
+
+    def __init__(self, journal=None):
+        self.reset(())
+        if journal is not None: journal.subscribe(self._on_commit)
+
+    @staticmethod
+    def _number(key):
+        return int(key) if isinstance(key, str) and key.isascii() and key.isdigit() else None
+
+    def reset(self, keys):
+        self._owners = {}  # 数字 -> 对应的 ID 集合 ("7" 与 "007" 占用同一个数字)
+        self._free = []    # 空出来的数字 (小根堆，可能含已被重新占用的旧值)
+        self._next = 0
+        for key in keys: self.claim(key)
+
+    def claim(self, key):
+        number = self._number(key)
+        if number is None: return
+        self._owners.setdefault(number, set()).add(key)
+        if number >= self._next: self._next = number + 1
+
+    def release(self, key):
+        number = self._number(key)
+        owners = self._owners.get(number)
+        if not owners: return
+        owners.discard(key)
+        if not owners:
+            del self._owners[number]
+            heapq.heappush(self._free, number)
+
+    def allocate(self):
+        while self._free:
+            number = heapq.heappop(self._free)
+            if number not in self._owners: break
+        else:
+            number = self._next
+        key = str(number)
+        self.claim(key)
+        return key
+
+    def _on_commit(self, changes):
+        # 撤销/重做也会增删条目，通过改动日志同步占用情况
+        for change in changes:
+            if change.kind == "add": self.claim(change.key)
+            elif change.kind == "remove": self.release(change.key)
+
+# ================= 保存 (后台序列化，缓存条目片段，临时文件 + fsync + 原子替换) =================
+LAZY_CONTENT_MARK = "\0lazy-content\0"  # 序列化时临时替代未读入正文的占位字符串
+
+def dump_json(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=json_default)
+
+def serialize_entry(value):
+    # 正文尚未读入时不把它放进片段：片段在正文处断开，写出时再从文件副本里读取
+    content = value.get("content") if isinstance(value, dict) else None
+    if isinstance(content, LazyContent):
+        text = dump_json({**value, "content": LAZY_CONTENT_MARK})
+        mark = dump_json(LAZY_CONTENT_MARK)
+        if text.count(mark) == 1:
+            head, tail = text.split(mark)
+            return head, content, tail
+    return dump_json(value)
+
+def write_lorebook(path, layout, fragments):
+    """按快照写出世界书：先写同目录下的临时文件并 fsync，再原子替换目标文件。
+    没有缓存片段的条目在这里序列化，新片段写入 fragments 供下次保存复用。"""
+    path = os.path.realpath(path)
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write("{")
+            for i, (top_key, value, entry_parts) in enumerate(layout):
+                f.write(("," if i else "") + dump_json(top_key) + ":")
+                if entry_parts is None:
+                    f.write(dump_json(value))
+                    continue
+                f.write("{")
+                for j, (key, fragment, snapshot) in enumerate(entry_parts):
+                    if fragment is None:
+                        fragment = fragments[key] = serialize_entry(snapshot)
+                    f.write(("," if j else "") + dump_json(key) + ":")
+                    if isinstance(fragment, tuple):
+                        head, content, tail = fragment
+                        f.write(head + dump_json(content) + tail)
+                    else:
+                        f.write(fragment)
+                f.write("}")
+            f.write("}")
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+    if hasattr(os, "O_DIRECTORY"):  # 让改名本身也落盘 (Windows 没有这一步)
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try: os.fsync(dir_fd)
+        finally: os.close(dir_fd)
+
+class LorebookWriter:
+    """缓存每个条目序列化后的 JSON 片段，保存时只重新序列化上次保存后改动过的条目。"""
+
+    def __init__(self):
+        self._fragments = {}
+        self._clock = 0       # 每次改动递增，用来判断后台返回的片段是否已经过时
+        self._touched = {}    # 条目 ID -> 最近一次改动时的 _clock
+        self._reset_at = 0
+
+    def reset(self):
+        self._clock += 1
+        self._fragments.clear()
+        self._touched.clear()
+        self._reset_at = self._clock
+
+    def invalidate(self, key):
+        self._clock += 1
+        self._fragments.pop(key, None)
+        self._touched[key] = self._clock
+
+    def snapshot(self, save_data):
+        # 在界面线程调用：没有片段的条目先做浅拷贝，后台线程只接触这份快照
+        layout = []
+        for top_key, value in save_data.items():
+            if top_key != "entries":
+                layout.append((top_key, value, None))
+                continue
+            parts = []
+            for key, entry in value.items():
+                fragment = self._fragments.get(key)
+                snapshot = None if fragment is not None else entry.to_dict() if isinstance(entry, WorldInfoEntry) else entry
+                parts.append((key, fragment, snapshot))
+            layout.append((top_key, None, parts))
+        return self._clock, layout
+
+    def remember(self, clock, fragments):
+        if clock < self._reset_at: return
+        for key, fragment in fragments.items():
+            if self._touched.get(key, 0) <= clock:
+                self._fragments[key] = fragment
+        self._touched = {k: c for k, c in self._touched.items() if c > clock}
+
+# ================= 简繁批量转换 (多进程并行，结果最后一次性写回) =================
+CONVERT_CHUNK_CHARS = 256 * 1024        # 每个子任务大约包含的字符数
+CONVERT_PROCESS_MIN_CHARS = 1024 * 1024  # 总量达到这个字符数才启用进程池，小批量直接在线程里转换
+CONVERT_FIELDS = ("comment", "key", "keysecondary", "content")
+CONVERT_SUFFIX = {"zh-cn": " - 简", "zh-tw": " - 繁"}  # 转换出的新条目在标题后追加的后缀
+_convert_pool = None
+
+def convert_texts(texts, target_lang):
+    # 在子进程里执行 (必须是模块级函数才能被 pickle)；zhconv 载入词典较慢，用到时才导入
+    import zhconv
+    return [zhconv.convert(text, target_lang) for text in texts]
+
+class ConversionCache:
+    """简繁转换结果的 LRU 缓存，以 (原文, 目标语言) 为键，按缓存的总字符数限制大小。
+    同一次运行内的多次转换共用；设置了 path 时首次使用前从磁盘读入，退出时写回。"""
+    MAX_CHARS = 16 * 1024 * 1024
+    FORMAT_VERSION = 1
+
+    def __init__(self):
+        self.path = None
+        self._items = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+
+    def lookup(self, texts, target_lang):
+        hits = {}
+        with self._lock:
+            self._load()
+            for text in texts:
+                converted = self._items.get((text, target_lang))
+                if converted is not None:
+                    self._items.move_to_end((text, target_lang))
+                    hits[text] = converted
+        return hits
+
+    def store(self, pairs, target_lang):
+        with self._lock:
+            for text, converted in pairs:
+                key = (text, target_lang)
+                if key in self._items: continue
+                self._items[key] = converted
+                self._chars += len(text) + len(converted)
+            while self._chars > self.MAX_CHARS and self._items:
+                (text, _), converted = self._items.popitem(last=False)
+                self._chars -= len(text) + len(converted)
+            self._dirty = True
+
+    def _load(self):
+        if self._loaded or not self.path: return
+        self._loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # 缓存文件不存在或已损坏，当作空缓存
+        if data.get("version") != self.FORMAT_VERSION: return
+        for target_lang, text, converted in data.get("items", []):
+            if (text, target_lang) not in self._items:
+                self._items[(text, target_lang)] = converted
+                self._items.move_to_end((text, target_lang), last=False)
+                self._chars += len(text) + len(converted)
+
+    def save(self):
+        with self._lock:
+            if not self.path or not self._dirty: return
+            items = [[lang, text, converted] for (text, lang), converted in self._items.items()]
+            self._dirty = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.FORMAT_VERSION, "items": items}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+conversion_cache = ConversionCache()
+
+def convert_pool():
+    # 进程池按需创建并在多次转换之间复用；统一用 spawn，避免在带线程的 Qt 进程里 fork
+    global _convert_pool
+    if _convert_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _convert_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context("spawn"))
+    return _convert_pool
+
+def discard_convert_pool():
+    global _convert_pool
+    if _convert_pool is not None:
+        _convert_pool.shutdown(wait=False, cancel_futures=True)
+        _convert_pool = None
+
+def convert_chunks(texts):
+    chunk, size = [], 0
+    for text in texts:
+        chunk.append(text)
+        size += len(text)
+        if size >= CONVERT_CHUNK_CHARS:
+            yield chunk
+            chunk, size = [], 0
+    if chunk: yield chunk
+
+def convert_entries(items, target_lang, progress=None, cancelled=None, use_processes=True):
+    """转换 field_snapshots() 取出的快照，返回同样结构的转换结果；cancelled() 为真时中途放弃并返回 None。
+    先去重并查缓存，剩下的文本按字符数切块，量大时分发到进程池，progress(已完成字符数, 总字符数) 逐块汇报进度。"""
+    items = load_snapshots(items)
+    texts = dict.fromkeys(t for _, fields in items for v in fields.values()
+                          for t in (v if isinstance(v, list) else [v]))
+    converted = conversion_cache.lookup(texts, target_lang)
+    missing = [t for t in texts if t not in converted]
+    chunks = list(convert_chunks(missing))
+    total, done = sum(map(len, missing)), 0
+    if progress: progress(done, total)
+    pending = chunks
+    if use_processes and (os.cpu_count() or 1) > 1 and len(chunks) > 1 and total >= CONVERT_PROCESS_MIN_CHARS:
+        from concurrent.futures import as_completed
+        try:
+            futures = {convert_pool().submit(convert_texts, chunk, target_lang): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                if cancelled and cancelled():
+                    for f in futures: f.cancel()
+                    return None
+                chunk = futures[future]
+                pairs = list(zip(chunk, future.result()))
+                converted.update(pairs)
+                conversion_cache.store(pairs, target_lang)
+                done += sum(map(len, chunk))
+                if progress: progress(done, total)
+            pending = []
+        except (OSError, RuntimeError):
+            # 进程池不可用 (例如子进程意外退出)，剩下的改为在当前线程里转换
+            discard_convert_pool()
+            pending = [chunk for chunk in chunks if chunk[0] not in converted]
+    for chunk in pending:
+        if cancelled and cancelled(): return None
+        pairs = list(zip(chunk, convert_texts(chunk, target_lang)))
+        converted.update(pairs)
+        conversion_cache.store(pairs, target_lang)
+        done += sum(map(len, chunk))
+        if progress: progress(done, total)
+    if cancelled and cancelled(): return None
+    return [(key, {f: [converted[t] for t in v] if isinstance(v, list) else converted[v] for f, v in fields.items()})
+            for key, fields in items]
+
+def converted_entry(entry, values, target_lang):
+    # 转换结果不覆盖原条目，而是生成一个带后缀的副本 (uid 由调用方重新分配)
+    new_entry = entry.copy()
+    new_entry.update(values)
+    new_entry["comment"] = (new_entry.get("comment") or "") + CONVERT_SUFFIX[target_lang]
+    return new_entry
+
+# ================= 批量查找替换 (跨条目按字段查找，纯文本或正则，结果一次性写回) =================
+REPLACE_FIELDS = ("comment", "key", "keysecondary", "content")
+REPLACE_CHECK_EVERY = 256  # 每处理这么多条目检查一次是否已取消
+
+def compile_find_pattern(text, regex=False, case_sensitive=False):
+    # 正则写错时抛出 re.error，由调用方提示
+    return re.compile(text if regex else re.escape(text), 0 if case_sensitive else re.IGNORECASE)
+
+def count_matches(items, pattern, cancelled=None):
+    """统计快照里每个条目各字段的匹配数，返回 [(条目ID, {字段: 次数})]，没有匹配的条目不列出；取消时返回 None。"""
+    results = []
+    for i, (key, fields) in enumerate(load_snapshots(items)):
+        if cancelled and i % REPLACE_CHECK_EVERY == 0 and cancelled(): return None
+        counts = {}
+        for field, value in fields.items():
+            n = sum(sum(1 for _ in pattern.finditer(v)) for v in (value if isinstance(value, list) else [value]))
+            if n: counts[field] = n
+        if counts: results.append((key, counts))
+    return results
+
+def replace_matches(items, pattern, replacement, regex=False, cancelled=None):
+    """返回 [(条目ID, {字段: 替换后的值})]，只含真正改变了的字段；取消时返回 None。
+    正则模式下替换文本里可以用 \\1、\\g<name> 引用分组，纯文本模式下按字面插入。"""
+    repl = replacement if regex else (lambda m: replacement)
+    results = []
+    for i, (key, fields) in enumerate(load_snapshots(items)):
+        if cancelled and i % REPLACE_CHECK_EVERY == 0 and cancelled(): return None
+        changed = {}
+        for field, value in fields.items():
+            new = [pattern.sub(repl, v) for v in value] if isinstance(value, list) else pattern.sub(repl, value)
+            if new != value: changed[field] = new
+        if changed: results.append((key, changed))
+    return results
+
+# ================= 触发模拟 (所有关键词编进一个 Aho-Corasick 自动机，扫描一遍聊天文本就知道哪些条目会触发) =================
+SELECTIVE_AND_ANY, SELECTIVE_NOT_ALL, SELECTIVE_NOT_ANY, SELECTIVE_AND_ALL = range(4)
+KEY_REGEX_RE = re.compile(r"^/([\w\W]+?)/([gimsuy]*)$")  # 与 ST 相同：/.../flags 形式的关键词按正则匹配
+KEY_REGEX_FLAGS = {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL}
+JS_WORD_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_")  # JS 正则里 \w 只含这些字符
+
+class KeywordAutomaton:
+    """Aho-Corasick 多模式匹配，按引用计数维护关键词集合。
+    新加的关键词先放在待合并集合里，扫描时用 str.find 单独查找，攒够一批 (按自动机大小的比例) 再整体重建；
+    没人用的关键词只从集合里去掉，自动机里的失效关键词多了才重建。"""
+    PENDING_LIMIT = 64
+
+    def __init__(self):
+        self._refs = {}
+        self._pending = set()
+        self._stale = 0
+        self._goto, self._fail, self._out = [{}], [0], {}
+        self._starts = None  # 匹配任一关键词首字符的正则
+        self._built = set()
+
+    def __len__(self):
+        return len(self._refs)
+
+    def __contains__(self, word):
+        return word in self._refs
+
+    def add(self, word):
+        count = self._refs.get(word, 0)
+        self._refs[word] = count + 1
+        if count: return
+        if word in self._built: self._stale -= 1
+        else: self._pending.add(word)
+
+    def discard(self, word):
+        count = self._refs.get(word, 0)
+        if count > 1:
+            self._refs[word] = count - 1
+            return
+        if not count: return
+        del self._refs[word]
+        if word in self._pending: self._pending.discard(word)
+        else: self._stale += 1
+
+    def rebuild(self):
+        goto, ends = [{}], {}
+        for word in self._refs:
+            node = 0
+            for ch in word:
+                edges = goto[node]
+                child = edges.get(ch)
+                if child is None:
+                    child = edges[ch] = len(goto)
+                    goto.append({})
+                node = child
+            ends[node] = word
+        # 逐层求失效链接，每个节点的输出并上失效节点的输出，扫描时不用再沿链接回溯找输出
+        fail, out = [0] * len(goto), {}
+        level = list(goto[0].values())
+        for node in level:
+            if node in ends: out[node] = (ends[node],)
+        while level:
+            next_level = []
+            for node in level:
+                for ch, child in goto[node].items():
+                    next_level.append(child)
+                    f = fail[node]
+                    while f and ch not in goto[f]: f = fail[f]
+                    f = fail[child] = goto[f].get(ch, 0)
+                    inherited = out.get(f, ())
+                    if child in ends: out[child] = (ends[child],) + inherited
+                    elif inherited: out[child] = inherited
+            level = next_level
+        self._goto, self._fail, self._out = goto, fail, out
+        self._starts = re.compile("[" + "".join(re.escape(ch) for ch in goto[0]) + "]") if goto[0] else None
+        self._built = set(self._refs)
+        self._pending = set()
+        self._stale = 0
+
+    def scan(self, text):
+        """逐个产出 (结束位置, 关键词)，同一个关键词出现几次就产出几次。"""
+        if len(self._pending) > max(self.PENDING_LIMIT, len(self._built) // 8) or self._stale > max(self.PENDING_LIMIT, len(self._refs)):
+            self.rebuild()
+        goto, fail, out, refs = self._goto, self._fail, self._out, self._refs
+        root = goto[0]
+        if root:
+            # 停在根节点时用正则直接跳到下一个可能是关键词开头的字符，跳过的这段不用逐字走自动机
+            next_start = self._starts.search
+            node, i, size = 0, 0, len(text)
+            while i < size:
+                if not node:
+                    m = next_start(text, i)
+                    if m is None: break
+                    i = m.start()
+                    node = root[text[i]]
+                else:
+                    ch = text[i]
+                    while node and ch not in goto[node]: node = fail[node]
+                    node = goto[node].get(ch, 0)
+                words = out.get(node)
+                if words:
+                    for word in words:
+                        if word in refs: yield i + 1, word
+                i += 1
+        for word in self._pending:
+            start = text.find(word)
+            while start >= 0:
+                yield start + len(word), word
+                start = text.find(word, start + 1)
+
+def parse_key_regex(key):
+    # 返回编译好的正则；不是 /.../ 形式或写错了返回 None，按普通关键词处理 (与 ST 一致)
+    m = KEY_REGEX_RE.match(key)
+    if not m: return None
+    flags = 0
+    for f in m.group(2): flags |= KEY_REGEX_FLAGS.get(f, 0)
+    try: return re.compile(m.group(1), flags)
+    except re.error: return None
+
+def word_hits(occurrences, text):
+    # 把 (结束位置, 关键词) 序列整理成 {关键词: 是否有一处前后都不是单词字符 (整词命中)}
+    found = {}
+    size = len(text)
+    for end, word in occurrences:
+        if found.get(word): continue
+        start = end - len(word)
+        found[word] = (start == 0 or text[start - 1] not in JS_WORD_CHARS) and (end == size or text[end] not in JS_WORD_CHARS)
+    return found
+
+class TriggerRule:
+    """一个条目的触发条件。关键词是 (原文, 规范化后的关键词, 正则, 是否要求整词)；正则关键词的第二项为 None。"""
+    __slots__ = ("primary", "secondary", "logic", "case_sensitive", "constant", "vectorized", "probability",
+                 "exclude_recursion", "prevent_recursion", "delay_level")
+
+    def __init__(self, entry, case_sensitive=False, match_whole_words=False):
+        cs = entry.get("caseSensitive")
+        self.case_sensitive = case_sensitive if cs is None else bool(cs)
+        whole = entry.get("matchWholeWords")
+        whole = match_whole_words if whole is None else bool(whole)
+        self.primary = self.compile_keys(entry.get("key"), self.case_sensitive, whole)
+        selective = entry.get("selective")
+        self.secondary = self.compile_keys(entry.get("keysecondary"), self.case_sensitive, whole) if selective or selective is None else ()
+        self.logic = entry.get("selectiveLogic") or SELECTIVE_AND_ANY
+        self.constant = bool(entry.get("constant"))
+        self.vectorized = bool(entry.get("vectorized"))
+        probability = entry.get("probability")
+        use_probability = entry.get("useProbability")
+        self.probability = probability if (use_probability or use_probability is None) and isinstance(probability, (int, float)) and probability < 100 else None
+        self.exclude_recursion = bool(entry.get("excludeRecursion"))
+        self.prevent_recursion = bool(entry.get("preventRecursion"))
+        # 延迟到递归时才触发的条目按 recursionLevel 分层，数字越小越早
+        self.delay_level = (entry.get("recursionLevel") or 1) if entry.get("delayUntilRecursion") else None
+
+    @staticmethod
+    def compile_keys(keys, case_sensitive, whole_words):
+        terms = []
+        for key in keys or []:
+            if not isinstance(key, str) or not key.strip(): continue
+            key = key.strip()
+            regex = parse_key_regex(key)
+            if regex is not None:
+                terms.append((key, None, regex, False))
+                continue
+            word = key if case_sensitive else key.lower()
+            # 含空白的关键词即使要求整词也只按子串匹配 (与 ST 一致)
+            terms.append((key, word, None, whole_words and len(word.split()) == 1))
+        return tuple(terms)
+
+    def words(self):
+        return {t[1] for t in self.primary + self.secondary if t[1] is not None}
+
+    def has_regex(self):
+        return any(t[2] is not None for t in self.primary)
+
+    def find_words(self, text, lowered=None):
+        # 不经过自动机，只在文本里查这个条目自己的关键词，结果格式与 word_hits() 相同
+        haystack = text if self.case_sensitive else (text.lower() if lowered is None else lowered)
+        def occurrences():
+            for word in self.words():
+                start = haystack.find(word)
+                while start >= 0:
+                    yield start + len(word), word
+                    start = haystack.find(word, start + 1)
+        return word_hits(occurrences(), haystack)
+
+    @staticmethod
+    def term_matched(term, hits, text):
+        raw, word, regex, whole = term
+        if regex is not None: return regex.search(text) is not None
+        hit = hits.get(word)
+        return hit is not None and (hit or not whole)
+
+    def secondary_passes(self, hits, text):
+        if not self.secondary: return True
+        secondary = [self.term_matched(t, hits, text) for t in self.secondary]
+        if self.logic == SELECTIVE_AND_ANY: return any(secondary)
+        if self.logic == SELECTIVE_NOT_ALL: return not all(secondary)
+        if self.logic == SELECTIVE_NOT_ANY: return not any(secondary)
+        return all(secondary)
+
+    def evaluate(self, hits, text):
+        """按主要关键字和可选过滤器判断是否触发 (不考虑常驻和概率)，返回命中的关键词，没有触发时返回 None。"""
+        keywords = [t[0] for t in self.primary if self.term_matched(t, hits, text)]
+        if not keywords or not self.secondary_passes(hits, text): return None
+        return keywords + [t[0] for t in self.secondary if self.term_matched(t, hits, text)]
+
+class ActivationSimulator:
+    """给定一段聊天文本，找出会被触发的条目。
+    关键词按是否区分大小写分进两个自动机，扫描一遍文本后只检查命中了主要关键字的条目 (外加常驻和正则关键字条目)；
+    条目改动时只替换这一个条目的规则，不重建整个自动机。第一次模拟时才建立。"""
+
+    def __init__(self, case_sensitive=False, match_whole_words=False):
+        self.case_sensitive = case_sensitive          # 条目 caseSensitive 为 null 时使用的全局设置
+        self.match_whole_words = match_whole_words    # 条目 matchWholeWords 为 null 时使用的全局设置
+        self._entries = {}
+        self._rules = None
+        self._automata = {False: KeywordAutomaton(), True: KeywordAutomaton()}
+        self._triggers = {}        # (是否区分大小写, 关键词) -> 以它为主要关键字的条目
+        self._loose_triggers = {}  # 同上，但只含这个关键字不要求整词匹配的条目
+        self._plain_rules = set()  # 只有普通主要关键字的条目：命中任一主要关键字就触发，不用逐条判断
+        self._constants = set()
+        self._regex_rules = set()  # 主要关键字里有正则的条目，每次都要检查
+
+    def rebuild(self, entries):
+        self._entries = entries
+        self._rules = None
+
+    def _ensure_built(self):
+        if self._rules is not None: return
+        self._rules = {}
+        self._automata = {False: KeywordAutomaton(), True: KeywordAutomaton()}
+        self._triggers, self._loose_triggers = {}, {}
+        self._plain_rules, self._constants, self._regex_rules = set(), set(), set()
+        for key, entry in self._entries.items():
+            self._add_rule(key, entry)
+        for automaton in self._automata.values(): automaton.rebuild()
+
+    def _add_rule(self, key, entry):
+        if not isinstance(entry, MutableMapping) or entry.get("disable"): return
+        rule = TriggerRule(entry, self.case_sensitive, self.match_whole_words)
+        self._rules[key] = rule
+        automaton = self._automata[rule.case_sensitive]
+        for word in rule.words(): automaton.add(word)
+        for raw, word, regex, whole in rule.primary:
+            if word is None: continue
+            self._triggers.setdefault((rule.case_sensitive, word), set()).add(key)
+            if not whole: self._loose_triggers.setdefault((rule.case_sensitive, word), set()).add(key)
+        if rule.constant: self._constants.add(key)
+        if rule.has_regex(): self._regex_rules.add(key)
+        elif not rule.secondary: self._plain_rules.add(key)
+
+    def _drop_rule(self, key):
+        rule = self._rules.pop(key, None)
+        if rule is None: return
+        automaton = self._automata[rule.case_sensitive]
+        for word in rule.words(): automaton.discard(word)
+        for raw, word, regex, whole in rule.primary:
+            if word is None: continue
+            for triggers in (self._triggers, self._loose_triggers):
+                keys = triggers.get((rule.case_sensitive, word))
+                if keys is None: continue
+                keys.discard(key)
+                if not keys: del triggers[(rule.case_sensitive, word)]
+        self._plain_rules.discard(key)
+        self._constants.discard(key)
+        self._regex_rules.discard(key)
+
+    def update(self, key, entry):
+        if self._rules is None: return
+        self._drop_rule(key)
+        self._add_rule(key, entry)
+
+    def remove(self, key):
+        if self._rules is None: return
+        self._drop_rule(key)
+
+    def rule(self, key):
+        self._ensure_built()
+        return self._rules.get(key)
+
+    def rules(self):
+        self._ensure_built()
+        return self._rules
+
+    def keyword_entries(self, word):
+        """以 word 为主要关键字的条目，直接查倒排索引：区分大小写的条目按原文比较，其余条目忽略大小写。"""
+        self._ensure_built()
+        word = word.strip()
+        return self._triggers.get((False, word.lower()), set()) | self._triggers.get((True, word), set())
+
+    def keyword_collisions(self, min_entries=2):
+        """被至少 min_entries 个条目共用的主要关键字 [(是否区分大小写, 关键词, {条目ID}, 其中按子串匹配的条目数)]。"""
+        self._ensure_built()
+        loose = self._loose_triggers
+        return [(cs, word, keys, len(loose.get((cs, word), ()))) for (cs, word), keys in self._triggers.items()
+                if len(keys) >= min_entries]
+
+    def keyword_counts(self):
+        # (索引里的关键词数, 主要关键字含正则、不在索引里的条目数)
+        self._ensure_built()
+        return len(self._triggers), len(self._regex_rules)
+
+    def _scan(self, text, lowered):
+        automata = self._automata
+        return {False: word_hits(automata[False].scan(lowered), lowered) if len(automata[False]) else {},
+                True: word_hits(automata[True].scan(text), text) if len(automata[True]) else {}}
+
+    def triggered(self, text, lowered=None):
+        """关键词触发的条目 {条目ID: 命中的关键词}，不含常驻条目，也不抽签。lowered 可传入已经转成小写的文本。"""
+        self._ensure_built()
+        if lowered is None: lowered = text.lower()
+        found = self._scan(text, lowered)
+        candidates = set(self._regex_rules)
+        for cs, words in found.items():
+            for word in words:
+                candidates.update(self._triggers.get((cs, word), ()))
+        results = {}
+        for key in candidates:
+            rule = self._rules[key]
+            keywords = rule.evaluate(found[rule.case_sensitive], text)
+            if keywords is not None: results[key] = keywords
+        return results
+
+    def triggered_keys(self, text, lowered=None):
+        """同 triggered()，但只返回条目ID 集合。主要关键字按命中的关键词查表判断；
+        带可选过滤器的条目再检查过滤器，过滤器相同的条目只判断一次。"""
+        self._ensure_built()
+        if lowered is None: lowered = text.lower()
+        found = self._scan(text, lowered)
+        satisfied = set()
+        for cs, words in found.items():
+            for word, whole in words.items():
+                satisfied.update((self._triggers if whole else self._loose_triggers).get((cs, word), ()))
+        results = satisfied & self._plain_rules
+        checked = {}
+        for key in (satisfied - self._plain_rules) | self._regex_rules:
+            rule = self._rules[key]
+            hits = found[rule.case_sensitive]
+            if key in self._regex_rules and not any(TriggerRule.term_matched(t, hits, text) for t in rule.primary): continue
+            signature = (rule.case_sensitive, rule.logic, rule.secondary)
+            passed = checked.get(signature)
+            if passed is None: passed = checked[signature] = rule.secondary_passes(hits, text)
+            if passed: results.add(key)
+        return results
+
+    def simulate(self, text, rng=None):
+        """返回 [(条目ID, 触发方式, 命中的关键词)]，触发方式为 constant (常驻) / keyword (关键词) / probability (未通过概率抽签)。
+        rng 为 random.Random 之类的对象时按条目的触发概率抽签，为 None 时视为全部通过。"""
+        triggered = self.triggered(text)
+        results = []
+        for key in self._constants | triggered.keys():
+            rule = self._rules[key]
+            reason = "constant" if rule.constant else "keyword"
+            if rng is not None and rule.probability is not None and rng.random() * 100 > rule.probability:
+                reason = "probability"
+            results.append((key, reason, [] if rule.constant else triggered[key]))
+        return results
+
+# ================= 递归触发图 (哪些条目的正文会触发哪些条目，找出循环和牵连最广的条目) =================
+# 建图用到的字段；后台建图时只复制这些字段，界面线程随后对条目的修改不会影响后台
+TRIGGER_FIELDS = ("key", "keysecondary", "selective", "selectiveLogic", "caseSensitive", "matchWholeWords",
+                  "constant", "vectorized", "probability", "useProbability", "disable", "content",
+                  "excludeRecursion", "preventRecursion", "delayUntilRecursion", "recursionLevel")
+GRAPH_CHECK_EVERY = 256  # 建图时每处理这么多条正文汇报一次进度、检查一次是否已取消
+
+def trigger_snapshot(entries):
+    return {key: {f: copy_json(entry[f]) for f in TRIGGER_FIELDS if f in entry}
+            for key, entry in entries.items() if isinstance(entry, MutableMapping)}
+
+class ActivationGraph:
+    """条目 A 的正文命中条目 B 的关键字，就有一条 A -> B 的边。
+    自己持有一个 ActivationSimulator：建图时把每条正文用关键字自动机扫描一遍，之后改了正文只重扫这一条正文，
+    改了关键字只拿这一个条目的规则去查各条正文。preventRecursion 的条目没有出边，excludeRecursion 和常驻条目没有入边。"""
+    SOURCE_FIELDS = frozenset({"content", "preventRecursion", "disable"})
+    TARGET_FIELDS = frozenset({"key", "keysecondary", "selective", "selectiveLogic", "caseSensitive", "matchWholeWords",
+                               "excludeRecursion", "constant", "disable"})
+
+    def __init__(self, case_sensitive=False, match_whole_words=False):
+        self.simulator = ActivationSimulator(case_sensitive, match_whole_words)
+        self._entries = {}
+        self._texts = None  # 可以作为来源的条目 -> (正文, 小写正文)
+        self._out = {}
+        self._in = {}
+        self._blocked = set()  # 不会被递归触发的条目 (常驻或 excludeRecursion)
+
+    def rebuild(self, entries):
+        self._entries = entries
+        self._texts = None
+        self.simulator.rebuild(entries)
+
+    def build(self, progress=None, cancelled=None):
+        """扫描所有正文建图，progress(已处理条目数, 总数) 汇报进度；cancelled() 为真时放弃并返回 False。"""
+        self._texts, self._out, self._in = {}, {}, {}
+        self._blocked = {key for key, rule in self.simulator.rules().items() if not self._accepts(rule)}
+        total = len(self._entries)
+        for i, (key, entry) in enumerate(self._entries.items()):
+            if i % GRAPH_CHECK_EVERY == 0:
+                if cancelled and cancelled():
+                    self._texts = None
+                    return False
+                if progress: progress(i, total)
+            self._set_source(key, entry)
+        return True
+
+    def _ensure_built(self):
+        if self._texts is None: self.build()
+
+    @staticmethod
+    def _accepts(rule):
+        return rule is not None and not rule.constant and not rule.exclude_recursion
+
+    def _set_source(self, key, entry):
+        # 重新扫描一个条目的正文，替换它的全部出边
+        for target in self._out.pop(key, ()):
+            self._in[target].discard(key)
+        self._texts.pop(key, None)
+        rule = self.simulator.rule(key)
+        if rule is None or rule.prevent_recursion: return
+        text = entry.get("content")
+        if isinstance(text, LazyContent): text = text.load(cache=False)
+        if not text: return
+        lowered = text.lower()
+        self._texts[key] = (text, lowered)
+        targets = self.simulator.triggered_keys(text, lowered) - self._blocked
+        targets.discard(key)
+        if targets: self._out[key] = targets
+        for target in targets:
+            self._in.setdefault(target, set()).add(key)
+
+    def _set_target(self, key):
+        # 拿一个条目的规则重新查一遍所有正文，替换它的全部入边
+        for source in self._in.pop(key, ()):
+            self._out[source].discard(key)
+        rule = self.simulator.rule(key)
+        if not self._accepts(rule):
+            self._blocked.add(key)
+            return
+        self._blocked.discard(key)
+        words = {t[1] for t in rule.primary if t[1] is not None}
+        regex = rule.has_regex()
+        sources = set()
+        for source, (text, lowered) in self._texts.items():
+            if source == key: continue
+            haystack = text if rule.case_sensitive else lowered
+            if not regex and not any(word in haystack for word in words): continue
+            if rule.evaluate(rule.find_words(text, lowered), text) is not None: sources.add(source)
+        if sources: self._in[key] = sources
+        for source in sources:
+            self._out.setdefault(source, set()).add(key)
+
+    def update(self, key, entry, fields=None):
+        # fields 为本次改动涉及的字段，只重算受影响的一侧；为 None 时 (新增条目) 两侧都重算
+        self.simulator.update(key, entry)
+        if self._texts is None: return
+        if fields is None or fields & self.SOURCE_FIELDS: self._set_source(key, entry)
+        if fields is None or fields & self.TARGET_FIELDS: self._set_target(key)
+
+    def remove(self, key):
+        self.simulator.remove(key)
+        if self._texts is None: return
+        self._texts.pop(key, None)
+        self._blocked.discard(key)
+        for target in self._out.pop(key, ()):
+            self._in[target].discard(key)
+        for source in self._in.pop(key, ()):
+            self._out[source].discard(key)
+
+    def targets(self, key):
+        self._ensure_built()
+        return set(self._out.get(key, ()))
+
+    def sources(self, key):
+        self._ensure_built()
+        return set(self._in.get(key, ()))
+
+    def out_degree(self, key):
+        self._ensure_built()
+        return len(self._out.get(key, ()))
+
+    def in_degree(self, key):
+        self._ensure_built()
+        return len(self._in.get(key, ()))
+
+    def edge_count(self):
+        self._ensure_built()
+        return sum(len(t) for t in self._out.values())
+
+    def components(self):
+        """Tarjan 强连通分量 (非递归实现)，按逆拓扑序返回：每个分量都排在它能到达的分量之后。"""
+        self._ensure_built()
+        out = self._out
+        index, low, on_stack, stack, result = {}, {}, set(), [], []
+        counter = 0
+        for root in self.simulator.rules():
+            if root in index: continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(out.get(root, ())))]
+            while work:
+                node, children = work[-1]
+                advanced = False
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(out.get(child, ()))))
+                        advanced = True
+                        break
+                    if child in on_stack and index[child] < low[node]: low[node] = index[child]
+                if advanced: continue
+                work.pop()
+                if work and low[node] < low[work[-1][0]]: low[work[-1][0]] = low[node]
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node: break
+                    result.append(component)
+        return result
+
+    def analyze(self):
+        """返回 (循环列表, {条目ID: 直接或间接能触发的条目数})。
+        循环是互相可达的条目组，按大小排序；可达数量按强连通分量缩点后用整数位图自底向上合并求得。"""
+        components = self.components()
+        component_of = {key: i for i, component in enumerate(components) for key in component}
+        bit = {key: 1 << n for n, key in enumerate(component_of)}
+        masks = []
+        for i, component in enumerate(components):
+            # 逆拓扑序保证后继分量的位图已经算好
+            mask = 0
+            for key in component:
+                mask |= bit[key]
+                for target in self._out.get(key, ()):
+                    j = component_of[target]
+                    if j != i: mask |= masks[j]
+            masks.append(mask)
+        reach = {key: masks[component_of[key]].bit_count() - 1 for key in component_of}
+        cycles = sorted((c for c in components if len(c) > 1), key=len, reverse=True)
+        return cycles, reach
+
+# ================= Token 预算 (按正文哈希缓存每个条目的 token 数，按插入位置/分组/常驻增量汇总) =================
+# 估算分词：连续的拉丁字母、连续的数字、连续的换行各算一段，其余 (汉字、假名、谚文、标点) 每个字符一段
+TOKEN_ESTIMATE_RE = re.compile(r"[^\W\d_\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]+|\d+|\n+|\S")
+BUDGET_FIELDS = ("content", "position", "group", "constant", "disable", "ignoreBudget")  # 后台统计时复制的字段
+BUDGET_CHECK_EVERY = 1024  # 统计时每处理这么多条目汇报一次进度、检查一次是否已取消
+
+def estimate_tokens(text):
+    # 不依赖词表的估算：字母每 4 个约 1 个 token，数字每 3 位 1 个，换行和其余字符各 1 个
+    tokens = 0
+    for run in TOKEN_ESTIMATE_RE.findall(text):
+        n = len(run)
+        if n == 1 or run[0] == "\n": tokens += 1
+        elif run[0].isdigit(): tokens += (n + 2) // 3
+        else: tokens += (n + 3) // 4
+    return tokens
+
+def _tiktoken_counter(name):
+    import tiktoken  # 可选依赖，选用时才导入
+    encoding = tiktoken.get_encoding(name or "cl100k_base")
+    return lambda text: len(encoding.encode_ordinary(text))
+
+def _hf_counter(path):
+    from tokenizers import Tokenizer  # 可选依赖，读取本地的 tokenizer.json
+    tokenizer = Tokenizer.from_file(path)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+# 分词器名称 -> factory(参数)，返回 count(text) -> token 数；用 "名称:参数" 选用，如 tiktoken:o200k_base、hf:/path/tokenizer.json
+TOKENIZERS = {
+    "estimate": lambda arg: estimate_tokens,
+    "chars": lambda arg: len,
+    "tiktoken": _tiktoken_counter,
+    "hf": _hf_counter,
+}
+
+def register_tokenizer(name, factory):
+    TOKENIZERS[name] = factory
+
+def make_tokenizer(spec):
+    name, _, arg = spec.partition(":")
+    if name not in TOKENIZERS: raise ValueError(f"未知的分词器: {name}")
+    try: return TOKENIZERS[name](arg)
+    except ImportError as e: raise ValueError(f"分词器 {name} 需要先安装 {e.name}") from e
+
+def content_digest(text):
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+class TokenCounter:
+    """用选定的分词器数 token，结果按正文哈希做 LRU 缓存：同样的正文 (撤销回去、重复的条目) 不再重数。"""
+    MAX_ITEMS = 65536
+
+    def __init__(self, spec="estimate"):
+        self.spec = spec
+        self._count = make_tokenizer(spec)
+        self._items = OrderedDict()
+
+    def count(self, text, digest=None):
+        if not text: return 0
+        if digest is None: digest = content_digest(text)
+        tokens = self._items.get(digest)
+        if tokens is not None:
+            self._items.move_to_end(digest)
+            return tokens
+        tokens = self._items[digest] = self._count(text)
+        if len(self._items) > self.MAX_ITEMS: self._items.popitem(last=False)
+        return tokens
+
+def budget_snapshot(entries):
+    return {key: {f: copy_json(entry[f]) for f in BUDGET_FIELDS if f in entry}
+            for key, entry in entries.items() if isinstance(entry, MutableMapping)}
+
+class TokenBudget:
+    """每个条目正文的 token 数，以及按插入位置、分组、常驻/条件触发分类的合计。
+    条目改动时只在正文哈希变了的时候重新数这一条，各项合计随之增减，不用重新汇总整本书；第一次查看时才统计。"""
+    FIELDS = frozenset(BUDGET_FIELDS)
+
+    def __init__(self, tokenizer="estimate"):
+        self.counter = TokenCounter(tokenizer)
+        self._entries = {}
+        self._records = None  # 条目 -> (正文哈希, token 数, 插入位置, 分组, 是否常驻, 是否启用, 是否不计预算)
+        self._totals = {}     # (分类, 值) -> [条目数, token 数]，只统计启用的条目，("disabled", None) 单独统计
+        self._members = {}    # 分组 -> 条目
+
+    def rebuild(self, entries):
+        self._entries = entries
+        self._records = None
+
+    def build(self, progress=None, cancelled=None):
+        """统计所有条目，progress(已处理条目数, 总数) 汇报进度；cancelled() 为真时放弃并返回 False。"""
+        self._records, self._totals, self._members = {}, {}, {}
+        total = len(self._entries)
+        for i, (key, entry) in enumerate(self._entries.items()):
+            if i % BUDGET_CHECK_EVERY == 0:
+                if cancelled and cancelled():
+                    self._records = None
+                    return False
+                if progress: progress(i, total)
+            self._set(key, entry, None)
+        return True
+
+    def _ensure_built(self):
+        if self._records is None: self.build()
+
+    def _record(self, entry, old):
+        text = entry.get("content")
+        if isinstance(text, LazyContent): text = text.load(cache=False)
+        if not isinstance(text, str): text = ""
+        digest = content_digest(text)
+        tokens = old[1] if old is not None and old[0] == digest else self.counter.count(text, digest)
+        position = entry.get("position")
+        groups = tuple(dict.fromkeys(g.strip() for g in str(entry.get("group") or "").split(",") if g.strip()))
+        return (digest, tokens, position if isinstance(position, int) else 0, groups,
+                bool(entry.get("constant")), not entry.get("disable"), bool(entry.get("ignoreBudget")))
+
+    @staticmethod
+    def _buckets(record):
+        _, _, position, groups, constant, enabled, ignore = record
+        if not enabled: return [("disabled", None)]
+        buckets = [("all", None), ("position", position), ("constant", constant)] + [("group", g) for g in groups]
+        if ignore: buckets.append(("ignoreBudget", None))
+        return buckets
+
+    def _tally(self, key, record, sign):
+        for bucket in self._buckets(record):
+            total = self._totals.setdefault(bucket, [0, 0])
+            total[0] += sign
+            total[1] += sign * record[1]
+            if not total[0]: del self._totals[bucket]
+        for group in record[3]:
+            members = self._members.setdefault(group, set())
+            if sign > 0: members.add(key)
+            else:
+                members.discard(key)
+                if not members: del self._members[group]
+
+    def _set(self, key, entry, old):
+        record = self._record(entry, old)
+        if old is not None: self._tally(key, old, -1)
+        self._records[key] = record
+        self._tally(key, record, 1)
+
+    def update(self, key, entry, fields=None):
+        # fields 为本次改动涉及的字段，与预算无关的改动直接跳过；正文没变时沿用原来的 token 数
+        if self._records is None or (fields is not None and not fields & self.FIELDS): return
+        self._set(key, entry, self._records.get(key))
+
+    def remove(self, key):
+        if self._records is None: return
+        old = self._records.pop(key, None)
+        if old is not None: self._tally(key, old, -1)
+
+    def tokens(self, key):
+        self._ensure_built()
+        record = self._records.get(key)
+        return record[1] if record is not None else 0
+
+    def totals(self, kind):
+        """返回 {值: (条目数, token 数)}；kind 为 position / group / constant，或 all / ignoreBudget / disabled (值为 None)。"""
+        self._ensure_built()
+        return {value: tuple(total) for (k, value), total in self._totals.items() if k == kind}
+
+    def group_peak(self, group):
+        # 同一分组的条目互斥，每次只插入一条，组内最长的一条决定它最多占用多少预算
+        self._ensure_built()
+        return max((self._records[key][1] for key in self._members.get(group, ())), default=0)
+
+# ================= 近似重复条目 (MinHash 签名 + LSH 分段，近似线性时间找出正文和关键字相近的条目) =================
+DUPLICATE_SHINGLE = 4        # 正文按连续 4 个字符切片
+DUPLICATE_BINS = 128         # 签名长度：每个切片只哈希一次，按哈希低位分进 128 个桶，每桶取最小值 (one permutation hashing)
+DUPLICATE_BIN_BITS = 7
+DUPLICATE_FILL_STEP = 1 << 57  # 空桶借用后面桶的值时按距离加上的偏移，保证借来的值不会和真实值相同
+DUPLICATE_LANE_LOW_BITS = int.from_bytes(b"\1\0" * DUPLICATE_BINS, "little")  # pack_signature() 每个 16 位的最低位
+DUPLICATE_FIELDS = ("content", "key")
+DUPLICATE_CHECK_EVERY = 256  # 计算签名时每处理这么多条目汇报一次进度、检查一次是否已取消
+WHITESPACE_RE = re.compile(r"\s+")
+_chinese_fold = None
+
+def chinese_fold_table():
+    # 繁体字逐字对应到简体字的 str.translate 映射表，让“ - 简”“ - 繁”两份条目的切片相同；zhconv 载入词典较慢，用到时才导入
+    global _chinese_fold
+    if _chinese_fold is None:
+        from zhconv.zhconv import getdict
+        _chinese_fold = {ord(k): v for k, v in getdict("zh-hans").items() if len(k) == 1 and len(v) == 1}
+    return _chinese_fold
+
+def entry_shingles(entry, fold=None):
+    """条目的切片集合：规整空白、统一大小写 (fold 给出时再繁转简) 后的正文 4 字切片，外加每个主要关键字。"""
+    text = entry.get("content")
+    if isinstance(text, LazyContent): text = text.load(cache=False)
+    text = WHITESPACE_RE.sub(" ", text).strip().casefold() if isinstance(text, str) else ""
+    if fold: text = text.translate(fold)
+    n = DUPLICATE_SHINGLE
+    shingles = set(map("".join, zip(*(text[i:] for i in range(n))))) if len(text) >= n else {text} if text else set()
+    for word in entry.get("key") or ():
+        if isinstance(word, str) and word.strip():
+            word = word.strip().casefold()
+            shingles.add("\0" + (word.translate(fold) if fold else word))  # 关键字切片加 \0 前缀，不会和正文切片相同
+    return shingles
+
+def shingle_hash(shingle):
+    # 固定的 64 位哈希 (内置 hash() 每个进程加盐不同，分组结果会随运行变化)
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+
+def minhash_signature(shingles):
+    if not shingles: return None
+    mask = DUPLICATE_BINS - 1
+    bins = {}
+    for h in map(shingle_hash, shingles):
+        value = h >> DUPLICATE_BIN_BITS
+        if value < bins.get(h & mask, 1 << 64): bins[h & mask] = value
+    if len(bins) == DUPLICATE_BINS: return tuple(bins[i] for i in range(DUPLICATE_BINS))
+    # 切片太少时有空桶，按顺序借用后面第一个非空桶的值 (densification)
+    filled = sorted(bins)
+    signature = []
+    for i in range(DUPLICATE_BINS):
+        if i in bins:
+            signature.append(bins[i])
+        else:
+            j = filled[bisect.bisect_left(filled, i) % len(filled)]
+            signature.append(bins[j] + ((j - i) % DUPLICATE_BINS) * DUPLICATE_FILL_STEP)
+    return tuple(signature)
+
+def lsh_bands(threshold):
+    # 签名切成 bands 段、每段 rows 行；两条目至少一段完全相同才比较。取候选阈值 (1/bands)^(1/rows) 略低于目标相似度的最大 rows
+    best = (DUPLICATE_BINS, 1)
+    for rows in range(1, DUPLICATE_BINS + 1):
+        bands = DUPLICATE_BINS // rows
+        if (1 / bands) ** (1 / rows) <= threshold - 0.1: best = (bands, rows)
+    return best
+
+def pack_signature(signature):
+    # 每个值折成 16 位拼进一个大整数，比较两个签名时不用逐项循环；折叠后偶然相同的概率约 1/65536，对相似度估计的影响可以忽略
+    return int.from_bytes(b"".join(((v ^ v >> 48) & 0xFFFF).to_bytes(2, "little") for v in signature), "little")
+
+def packed_agreement(a, b):
+    """两个 pack_signature() 结果里相同的值的个数。"""
+    x = a ^ b
+    x |= x >> 8; x |= x >> 4; x |= x >> 2; x |= x >> 1  # 每个 16 位里只要有一位不同，最低位就是 1
+    return DUPLICATE_BINS - (x & DUPLICATE_LANE_LOW_BITS).bit_count()
+
+def shingle_similarity(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def duplicate_snapshot(entries):
+    return {key: {f: copy_json(entry[f]) for f in DUPLICATE_FIELDS if f in entry}
+            for key, entry in entries.items() if isinstance(entry, MutableMapping)}
+
+class DuplicateFinder:
+    """找出正文和关键字近似重复的条目。每个条目的 MinHash 签名缓存起来，改了正文或主要关键字才重算；
+    查找时按 LSH 分段分桶，同一个桶里的条目和桶里已有的每个组比较一次签名，相似的用并查集连成一组。第一次查找时才计算签名。"""
+    FIELDS = frozenset(DUPLICATE_FIELDS)
+
+    def __init__(self, fold_chinese=True):
+        self.fold_chinese = fold_chinese
+        self._fold = None
+        self._entries = {}
+        self._signatures = None  # 条目 -> (签名, pack_signature() 的结果)；没有正文也没有关键字的条目不参与比较
+
+    def rebuild(self, entries):
+        self._entries = entries
+        self._signatures = None
+
+    def build(self, progress=None, cancelled=None):
+        """计算所有条目的签名，progress(已处理条目数, 总数) 汇报进度；cancelled() 为真时放弃并返回 False。"""
+        self._fold = chinese_fold_table() if self.fold_chinese else None
+        self._signatures = {}
+        total = len(self._entries)
+        for i, (key, entry) in enumerate(self._entries.items()):
+            if i % DUPLICATE_CHECK_EVERY == 0:
+                if cancelled and cancelled():
+                    self._signatures = None
+                    return False
+                if progress: progress(i, total)
+            self._sign(key, entry)
+        return True
+
+    def _ensure_built(self):
+        if self._signatures is None: self.build()
+
+    def _sign(self, key, entry):
+        signature = minhash_signature(entry_shingles(entry, self._fold)) if isinstance(entry, MutableMapping) else None
+        if signature is None: self._signatures.pop(key, None)
+        else: self._signatures[key] = (signature, pack_signature(signature))
+
+    def update(self, key, entry, fields=None):
+        if self._signatures is None or (fields is not None and not fields & self.FIELDS): return
+        self._sign(key, entry)
+
+    def remove(self, key):
+        if self._signatures is not None: self._signatures.pop(key, None)
+
+    def shingles(self, entry):
+        self._ensure_built()
+        return entry_shingles(entry, self._fold)
+
+    def clusters(self, threshold):
+        """返回签名估计相似度不低于 threshold 的条目组 [{条目ID}]，大的组在前。"""
+        self._ensure_built()
+        signatures = self._signatures
+        bands, rows = lsh_bands(threshold)
+        parent = {}
+        def find(key):
+            while parent.get(key, key) != key:
+                parent[key] = parent.get(parent[key], parent[key])
+                key = parent[key]
+            return key
+        limit = threshold * DUPLICATE_BINS
+        compared = set()  # 同一对条目会在多个段里落进同一个桶，只比一次
+        for band in range(bands):
+            start, stop = band * rows, band * rows + rows
+            buckets = {}  # 这一段签名 -> 落进这个桶的各组代表条目
+            for key, (signature, packed) in signatures.items():
+                members = buckets.setdefault(signature[start:stop], [])
+                # 和桶里已有的每个组都比一次：和第一个条目不相似，不代表和后面的组也不相似
+                root, joined = find(key), False
+                for other in members:
+                    other_root = find(other)
+                    if other_root == root:
+                        joined = True
+                    elif (other, key) not in compared:
+                        compared.add((other, key))
+                        if packed_agreement(signatures[other][1], packed) >= limit:
+                            parent[root] = root = other_root
+                            joined = True
+                if not joined: members.append(key)
+        groups = {}
+        for key in parent:
+            groups.setdefault(find(key), set()).add(key)
+        for root, members in groups.items(): members.add(root)
+        return sorted(groups.values(), key=len, reverse=True)
+
+# ================= 条目顺序 (与条目字典分开保存) =================
+class EntryOrder:
+    """条目顺序，与条目字典分开保存。用分块列表实现：按行号取 ID、按 ID 查行号、插入/删除/移动
+    都只改动一个块，再加上按需重算的各块起始行号，单次操作约为 O(块大小 + 块数)。"""
+    BLOCK_SIZE = 512
+
+    def __init__(self, keys=()):
+        self.reset(keys)
+
+    def reset(self, keys):
+        keys = list(keys)
+        size = self.BLOCK_SIZE
+        self._blocks = [keys[i:i + size] for i in range(0, len(keys), size)] or [[]]
+        self._block_of = {k: block for block in self._blocks for k in block}
+        self._len = len(keys)
+        self._starts = None  # 各块的起始行号，结构变化后失效
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for block in self._blocks: yield from block
+
+    def __contains__(self, key):
+        return key in self._block_of
+
+    def __getitem__(self, row):
+        if not 0 <= row < self._len: raise IndexError(row)
+        i, offset = self._locate(row)
+        return self._blocks[i][offset]
+
+    def _ensure_starts(self):
+        if self._starts is None:
+            starts, total = [], 0
+            for block in self._blocks:
+                starts.append(total)
+                total += len(block)
+            self._starts = starts
+            self._block_index = {id(block): i for i, block in enumerate(self._blocks)}
+
+    def _locate(self, row):
+        self._ensure_starts()
+        i = bisect.bisect_right(self._starts, row) - 1
+        return i, row - self._starts[i]
+
+    def index(self, key):
+        block = self._block_of.get(key)
+        if block is None: return -1
+        self._ensure_starts()
+        return self._starts[self._block_index[id(block)]] + block.index(key)
+
+    def insert(self, row, key):
+        if row >= self._len:
+            i, offset = len(self._blocks) - 1, len(self._blocks[-1])
+        else:
+            i, offset = self._locate(row)
+        block = self._blocks[i]
+        block.insert(offset, key)
+        self._block_of[key] = block
+        self._len += 1
+        if len(block) > 2 * self.BLOCK_SIZE:
+            tail = block[self.BLOCK_SIZE:]
+            del block[self.BLOCK_SIZE:]
+            for k in tail: self._block_of[k] = tail
+            self._blocks.insert(i + 1, tail)
+        self._starts = None
+
+    def extend(self, keys):
+        for key in keys: self.insert(self._len, key)
+
+    def pop(self, row):
+        i, offset = self._locate(row)
+        block = self._blocks[i]
+        key = block.pop(offset)
+        del self._block_of[key]
+        self._len -= 1
+        if not block and len(self._blocks) > 1:
+            del self._blocks[i]
+        self._starts = None
+        return key
+
+    def move(self, src, dst):
+        self.insert(dst, self.pop(src))
+
+# ================= 世界书文档 (读取、整理、校验、合并，不依赖界面) =================
+def build_save_data(entries, order, extras, top_level_keys):
+    # 按读取时的顶层字段顺序写回，entries 以外的字段原样保留；条目按 order 的顺序写出
+    ordered = {k: entries[k] for k in order}
+    save_data = {}
+    for key in top_level_keys or ["entries"]:
+        save_data[key] = ordered if key == "entries" else extras[key]
+    save_data.setdefault("entries", ordered)
+    return save_data
+
+class Lorebook:
+    """一本世界书：条目字典 + 条目顺序 + entries 以外的顶层字段，供命令行和脚本使用。"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.order = []
+        self.extras = {}
+        self.top_level_keys = []
+
+    @classmethod
+    def load(cls, path, content_store=None):
+        book = cls(path)
+        reader = LorebookStreamReader(path, content_store=content_store)
+        for key, entry in reader.entries():
+            if key not in book.entries: book.order.append(key)
+            book.entries[key] = entry
+        book.extras, book.top_level_keys = reader.extras, reader.top_level_keys
+        return book
+
+    def records(self):
+        # 只含结构正常的条目 (文件里可能混有 null 之类的非对象条目)
+        return {k: self.entries[k] for k in self.order if isinstance(self.entries[k], WorldInfoEntry)}
+
+    def save_data(self):
+        return build_save_data(self.entries, self.order, self.extras, self.top_level_keys)
+
+    def save(self, path=None):
+        _, layout = LorebookWriter().snapshot(self.save_data())
+        write_lorebook(path or self.path, layout, {})
+
+    def reorder(self, fields, reverse=False):
+        # 稳定排序：数值在前、文本其次、缺失的值排在最后
+        def sort_value(entry, field):
+            value = entry.get(field) if isinstance(entry, WorldInfoEntry) else None
+            if isinstance(value, list): value = ", ".join(map(str, value))
+            if isinstance(value, (int, float)): return (0, value, "")
+            return (2, 0, "") if value is None else (1, 0, str(value))
+        self.order.sort(key=lambda k: tuple(sort_value(self.entries[k], f) for f in fields), reverse=reverse)
+
+    def convert(self, target_lang, fields=CONVERT_FIELDS, replace=False, use_processes=True):
+        # 默认和界面一样在原条目后面插入带后缀的转换副本；replace=True 时直接改写原条目
+        records = self.records()
+        results = convert_entries(field_snapshots(records, records, fields), target_lang, use_processes=use_processes)
+        if replace:
+            for key, values in results:
+                for field, value in values.items(): records[key][field] = value
+            return len(results)
+        converted = dict(results)
+        uids = UidAllocator()
+        uids.reset(self.entries)
+        order = []
+        for key in self.order:
+            order.append(key)
+            if key not in converted: continue
+            new_key = uids.allocate()
+            new_entry = converted_entry(records[key], converted[key], target_lang)
+            new_entry["uid"] = int(new_key)
+            self.entries[new_key] = new_entry
+            order.append(new_key)
+        self.order = order
+        return len(results)
+
+    def replace(self, pattern, replacement, regex=False, fields=REPLACE_FIELDS):
+        records = self.records()
+        results = replace_matches(field_snapshots(records, records, fields), pattern, replacement, regex)
+        for key, values in results:
+            for field, value in values.items(): records[key][field] = value
+        return len(results)
+
+# 各字段应有的类型，按新建条目的默认值推断；null 表示沿用全局设置，任何字段都允许
+ENTRY_FIELD_TYPES = {f: (bool,) if isinstance(v, bool) else (int, float) if isinstance(v, int) else (type(v),)
+                     for f, v in ENTRY_DEFAULTS.items() if v is not None}
+ENTRY_FIELD_TYPES["characterFilter"] = (list, dict)  # 新版 ST 写成 {isExclude, names, tags}
+
+def validate_lorebook(book):
+    """检查条目结构、uid 与条目 ID 是否一致、uid 是否重复以及字段类型，返回 [(条目ID, 问题描述)]。"""
+    problems = []
+    uid_owner = {}
+    for key in book.order:
+        entry = book.entries[key]
+        if not isinstance(entry, WorldInfoEntry):
+            problems.append((key, "条目不是 JSON 对象"))
+            continue
+        uid = entry.get("uid", FIELD_MISSING)
+        if uid is FIELD_MISSING:
+            problems.append((key, "缺少 uid"))
+        elif isinstance(uid, bool) or not isinstance(uid, int):
+            problems.append((key, f"uid 应为整数，实际为 {dump_json(uid)}"))
+        else:
+            if str(uid) != key: problems.append((key, f"uid {uid} 与条目 ID 不一致"))
+            if uid in uid_owner: problems.append((key, f"uid {uid} 与条目 {uid_owner[uid]} 重复"))
+            else: uid_owner[uid] = key
+        for field, types in ENTRY_FIELD_TYPES.items():
+            value = entry.get(field)
+            if value is None or field == "uid": continue
+            if not isinstance(value, types) or (bool not in types and isinstance(value, bool)):
+                problems.append((key, f"字段 {field} 的类型应为 {'/'.join(t.__name__ for t in types)}，实际为 {type(value).__name__}"))
+            elif field in ("key", "keysecondary") and not all(isinstance(k, str) for k in value):
+                problems.append((key, f"字段 {field} 里含有非字符串的关键词"))
+    return problems
+
+def merge_lorebooks(books):
+    """按顺序合并多本世界书，返回 (合并结果, [(来源文件, 原ID, 新ID)])。
+    条目 ID 冲突时用 UidAllocator 重新编号并同步 uid；entries 以外的顶层字段取自第一本。"""
+    merged = Lorebook()
+    if books:
+        merged.extras, merged.top_level_keys = dict(books[0].extras), list(books[0].top_level_keys)
+    uids = UidAllocator()
+    for book in books:
+        for key in book.order: uids.claim(key)
+    renamed = []
+    for book in books:
+        for key in book.order:
+            entry = book.entries[key]
+            if key in merged.entries:
+                new_key = uids.allocate()
+                if isinstance(entry, WorldInfoEntry) and "uid" in entry: entry["uid"] = int(new_key)
+                renamed.append((book.path, key, new_key))
+                key = new_key
+            merged.entries[key] = entry
+            merged.order.append(key)
+    return merged, renamed
+
+# ================= 命令行 (python -m worldinfo) =================
+def _output_path(path, args):
+    if args.in_place: return path
+    os.makedirs(args.output_dir, exist_ok=True)
+    return os.path.join(args.output_dir, os.path.basename(path))
+
+def _cli_convert(path, args):
+    book = Lorebook.load(path)
+    count = book.convert(args.to, args.fields, args.replace, use_processes=not args.parallel_files)
+    book.save(_output_path(path, args))
+    return [f"{path}: 转换了 {count} 个条目"], 0
+
+def _cli_search(path, args):
+    book = Lorebook.load(path)
+    records = book.records()
+    index = EntrySearchIndex()
+    index.rebuild(records)
+    hits = index.search(args.query)
+    if args.count: return [f"{path}\t{len(hits)}"], 0 if hits else 1
+    return [f"{path}\t{key}\t{entry_display_name(key, records[key])}" for key in book.order if key in hits], 0 if hits else 1
+
+def _cli_simulate(path, args):
+    book = Lorebook.load(path)
+    records = book.records()
+    simulator = ActivationSimulator(args.case_sensitive, args.match_whole_words)
+    simulator.rebuild(records)
+    activated = {key: (reason, keywords) for key, reason, keywords in
+                 simulator.simulate(args.chat_text, random.Random() if args.roll else None)}
+    lines = []
+    for key in book.order:
+        if key not in activated: continue
+        reason, keywords = activated[key]
+        lines.append(f"{path}\t{key}\t{reason}\t{entry_display_name(key, records[key])}\t{', '.join(keywords)}")
+    return lines, 0 if activated else 1
+
+def _cli_graph(path, args):
+    book = Lorebook.load(path)
+    records = book.records()
+    graph = ActivationGraph(args.case_sensitive, args.match_whole_words)
+    graph.rebuild(records)
+    graph.build()
+    cycles, reach = graph.analyze()
+    rows = {key: row for row, key in enumerate(book.order)}
+    def name(key): return entry_display_name(key, records[key])
+    lines = [f"{path}: {graph.edge_count()} 条递归触发关系，{len(cycles)} 个循环"]
+    for cycle in cycles:
+        lines.append(f"{path}\t循环\t" + " -> ".join(name(key) for key in sorted(cycle, key=rows.__getitem__)))
+    hot = sorted((key for key in reach if reach[key]), key=lambda key: (-reach[key], rows[key]))[:args.top]
+    for key in hot:
+        lines.append(f"{path}\t{key}\t{name(key)}\t直接触发 {graph.out_degree(key)}\t共可触发 {reach[key]}\t被触发 {graph.in_degree(key)}")
+    return lines, 1 if cycles else 0
+
+def _cli_budget(path, args):
+    book = Lorebook.load(path)
+    budget = TokenBudget(args.tokenizer)
+    budget.rebuild(book.records())
+    def total(kind, value=None): return budget.totals(kind).get(value, (0, 0))
+    rows = [("启用", total("all")), ("常驻", total("constant", True)), ("条件触发", total("constant", False)),
+            ("不计预算", total("ignoreBudget")), ("已禁用", total("disabled"))]
+    rows += [(f"位置 {position}", t) for position, t in sorted(budget.totals("position").items())]
+    rows += [(f"分组 {group}", t) for group, t in sorted(budget.totals("group").items(), key=lambda i: -i[1][1])]
+    return [f"{path}\t{name}\t{count}\t{tokens}" for name, (count, tokens) in rows], 0
+
+def _cli_duplicates(path, args):
+    book = Lorebook.load(path)
+    records = book.records()
+    finder = DuplicateFinder(not args.no_fold)
+    finder.rebuild(records)
+    rows = {key: row for row, key in enumerate(book.order)}
+    lines = []
+    for i, members in enumerate(sorted((sorted(c, key=rows.__getitem__) for c in finder.clusters(args.threshold)),
+                                       key=lambda c: (-len(c), rows[c[0]])), 1):
+        base = finder.shingles(records[members[0]])
+        for key in members:
+            similarity = shingle_similarity(base, finder.shingles(records[key]))
+            lines.append(f"{path}\t{i}\t{key}\t{similarity:.0%}\t{entry_display_name(key, records[key])}")
+    return lines, 1 if lines else 0
+
+def _cli_keywords(path, args):
+    book = Lorebook.load(path)
+    records = book.records()
+    simulator = ActivationSimulator(args.case_sensitive, args.match_whole_words)
+    simulator.rebuild(records)
+    if args.lookup is not None:
+        hits = simulator.keyword_entries(args.lookup)
+        return [f"{path}\t{key}\t{entry_display_name(key, records[key])}" for key in book.order if key in hits], 0 if hits else 1
+    collisions = sorted(simulator.keyword_collisions(args.min_entries), key=lambda c: (-len(c[2]), c[1]))
+    return [f"{path}\t{word}\t{len(keys)}\t{loose}\t{'区分大小写' if cs else ''}"
+            for cs, word, keys, loose in collisions[:args.top]], 0
+
+def _cli_reorder(path, args):
+    book = Lorebook.load(path)
+    book.reorder(args.by, args.reverse)
+    book.save(_output_path(path, args))
+    return [f"{path}: 已按 {','.join(args.by)} 重新排序 {len(book.order)} 个条目"], 0
+
+def _cli_replace(path, args):
+    book = Lorebook.load(path)
+    count = book.replace(args.pattern, args.replacement, args.regex, args.fields)
+    book.save(_output_path(path, args))
+    return [f"{path}: 替换了 {count} 个条目"], 0
+
+def _cli_validate(path, args):
+    problems = validate_lorebook(Lorebook.load(path))
+    return [f"{path}: 条目 {key}: {message}" for key, message in problems], 1 if problems else 0
+
+def _run_file(handler, path, args):
+    # 单个文件的处理结果 (输出行, 错误行, 退出码)；在进程池里执行时同样适用
+    try:
+        lines, status = handler(path, args)
+        return lines, [], status
+    except (OSError, ValueError) as e:
+        return [], [f"{path}: {e}"], 2
+
+def _run_files(handler, args):
+    jobs = min(args.jobs or os.cpu_count() or 1, len(args.files))
+    args.parallel_files = jobs > 1  # 文件之间已经并行，单个文件的转换不再另开进程池
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_run_file, [handler] * len(args.files), args.files, [args] * len(args.files)))
+    else:
+        results = (_run_file(handler, path, args) for path in args.files)
+    status = 0
+    for lines, errors, code in results:
+        for line in lines: print(line)
+        for line in errors: print(line, file=sys.stderr)
+        status = max(status, code)
+    return status
+
+def _cli_merge(args):
+    try:
+        books = [Lorebook.load(path) for path in args.files]
+        merged, renamed = merge_lorebooks(books)
+        merged.save(args.output)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    for path, old_key, new_key in renamed:
+        print(f"{path}: 条目 {old_key} 与已有条目冲突，改为 {new_key}")
+    print(f"已合并 {len(books)} 个文件，共 {len(merged.order)} 个条目 -> {args.output}")
+    return 0
+
+def _field_list(text):
+    return [f.strip() for f in text.split(",") if f.strip()]
+
+def _text_fields(text):
+    # 简繁转换和批量替换都只处理标题、关键词和正文这几个文本字段
+    fields = _field_list(text)
+    unknown = [f for f in fields if f not in CONVERT_FIELDS]
+    if unknown: raise argparse.ArgumentTypeError(f"不支持的字段: {','.join(unknown)}")
+    return fields
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m worldinfo", description="SillyTavern 世界书命令行批量处理工具")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="同时处理的文件数，默认等于 CPU 核数")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def output_options(command):
+        target = command.add_mutually_exclusive_group(required=True)
+        target.add_argument("-o", "--output-dir", help="结果写到这个目录 (文件名不变)")
+        target.add_argument("--in-place", action="store_true", help="直接覆盖原文件")
+
+    convert = commands.add_parser("convert", help="简繁转换")
+    convert.add_argument("files", nargs="+")
+    convert.add_argument("--to", required=True, choices=sorted(CONVERT_SUFFIX), help="zh-cn 转简体，zh-tw 转繁体")
+    convert.add_argument("--fields", type=_text_fields, default=list(CONVERT_FIELDS),
+                         help=f"要转换的字段，逗号分隔，默认 {','.join(CONVERT_FIELDS)}")
+    convert.add_argument("--replace", action="store_true", help="直接改写原条目，而不是生成带后缀的新条目")
+    output_options(convert)
+    convert.set_defaults(handler=_cli_convert)
+
+    replace = commands.add_parser("replace", help="在所有条目里批量查找替换")
+    replace.add_argument("find", help="要查找的文本")
+    replace.add_argument("replacement", help="替换为")
+    replace.add_argument("files", nargs="+")
+    replace.add_argument("--regex", action="store_true", help="按正则表达式查找，替换文本里可用 \\1 引用分组")
+    replace.add_argument("--case-sensitive", action="store_true", help="区分大小写")
+    replace.add_argument("--fields", type=_text_fields, default=list(REPLACE_FIELDS),
+                         help=f"查找的字段，逗号分隔，默认 {','.join(REPLACE_FIELDS)}")
+    output_options(replace)
+    replace.set_defaults(handler=_cli_replace)
+
+    search = commands.add_parser("search", help="按编辑器的检索语法查找条目")
+    search.add_argument("query", help='例如 key:龙 content:/正则/ position:4 -disable:true')
+    search.add_argument("files", nargs="+")
+    search.add_argument("-c", "--count", action="store_true", help="只输出每个文件的命中数")
+    search.set_defaults(handler=_cli_search)
+
+    simulate = commands.add_parser("simulate", help="模拟一段聊天文本会触发哪些条目")
+    simulate.add_argument("files", nargs="+")
+    simulate.add_argument("--chat", default="-", help="聊天文本文件，默认从标准输入读取")
+    simulate.add_argument("--case-sensitive", action="store_true", help="条目未单独设置时区分大小写")
+    simulate.add_argument("--match-whole-words", action="store_true", help="条目未单独设置时只匹配整词")
+    simulate.add_argument("--roll", action="store_true", help="按条目的触发概率随机抽签")
+    simulate.set_defaults(handler=_cli_simulate)
+
+    graph = commands.add_parser("graph", help="分析条目之间的递归触发关系，发现循环时退出码为 1")
+    graph.add_argument("files", nargs="+")
+    graph.add_argument("--top", type=int, default=20, help="列出可牵连条目最多的前 N 个条目")
+    graph.add_argument("--case-sensitive", action="store_true", help="条目未单独设置时区分大小写")
+    graph.add_argument("--match-whole-words", action="store_true", help="条目未单独设置时只匹配整词")
+    graph.set_defaults(handler=_cli_graph)
+
+    budget = commands.add_parser("budget", help="统计条目正文的 token 数，按插入位置、分组和常驻汇总")
+    budget.add_argument("files", nargs="+")
+    budget.add_argument("--tokenizer", default="estimate",
+                        help="分词器：estimate (默认，估算)、chars、tiktoken:cl100k_base、hf:路径/tokenizer.json")
+    budget.set_defaults(handler=_cli_budget)
+
+    duplicates = commands.add_parser("duplicates", help="按正文和主要关键字查找近似重复的条目，找到时退出码为 1")
+    duplicates.add_argument("files", nargs="+")
+    duplicates.add_argument("--threshold", type=float, default=0.8, help="相似度下限 (0~1)，默认 0.8")
+    duplicates.add_argument("--no-fold", action="store_true", help="不把繁体和简体视为相同")
+    duplicates.set_defaults(handler=_cli_duplicates)
+
+    keywords = commands.add_parser("keywords", help="列出被多个条目共用的主要关键字，或用 --lookup 查以某个关键字触发的条目")
+    keywords.add_argument("files", nargs="+")
+    keywords.add_argument("--lookup", help="只列出以这个关键字为主要关键字的条目")
+    keywords.add_argument("--min-entries", type=int, default=2, help="至少被这么多个条目共用才列出，默认 2")
+    keywords.add_argument("--top", type=int, default=50, help="最多列出前 N 个关键字，默认 50")
+    keywords.add_argument("--case-sensitive", action="store_true", help="条目未单独设置时区分大小写")
+    keywords.add_argument("--match-whole-words", action="store_true", help="条目未单独设置时只匹配整词")
+    keywords.set_defaults(handler=_cli_keywords)
+
+    reorder = commands.add_parser("reorder", help="按字段给条目排序")
+    reorder.add_argument("files", nargs="+")
+    reorder.add_argument("--by", type=_field_list, required=True, help="排序字段，逗号分隔，例如 order,comment")
+    reorder.add_argument("--reverse", action="store_true", help="倒序")
+    output_options(reorder)
+    reorder.set_defaults(handler=_cli_reorder)
+
+    validate = commands.add_parser("validate", help="检查条目结构、uid 和字段类型，发现问题时退出码为 1")
+    validate.add_argument("files", nargs="+")
+    validate.set_defaults(handler=_cli_validate)
+
+    merge = commands.add_parser("merge", help="把多个世界书合并成一个，冲突的条目 ID 自动重新编号")
+    merge.add_argument("files", nargs="+")
+    merge.add_argument("-o", "--output", required=True, help="合并结果的文件路径")
+    merge.set_defaults(handler=None)
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "duplicates" and not 0 < args.threshold <= 1:
+        parser.error(f"--threshold 应在 0 (不含) 到 1 之间，收到 {args.threshold}")
+    if args.command == "merge": return _cli_merge(args)
+    if args.command == "replace":
+        try:
+            args.pattern = compile_find_pattern(args.find, args.regex, args.case_sensitive)
+        except re.error as e:
+            print(f"正则表达式有误: {e}", file=sys.stderr)
+            return 2
+    if args.command == "simulate":
+        if args.chat == "-":
+            args.chat_text = sys.stdin.read()
+        else:
+            with open(args.chat, encoding="utf-8") as f: args.chat_text = f.read()
+    try:
+        return _run_files(args.handler, args)
+    except BrokenPipeError:
+        # 输出接到 head 之类提前退出的管道时安静地结束
+        sys.stdout = open(os.devnull, "w")
+        return 0
+    finally:
+        discard_convert_pool()
+
+if __name__ == "__main__":
+    sys.exit(main())